@@ -1,16 +1,36 @@
-from flask import Flask, request, render_template, jsonify, send_file
+from flask import Flask, Request, g, request, render_template, jsonify, send_file, Response, stream_with_context
 import requests
 import PyPDF2
 import os
 import json
+import logging
+import uuid
 import tempfile
 import base64
 import re
 import time
+import threading
 from io import BytesIO
 import webbrowser
 import urllib.parse
+import zipfile
 from openai import OpenAI
+from jobs import Batch, JobQueue, QueueFullError
+from cache import LRUCache, ResultCache, content_hash
+from flowchart import Flowchart, is_mermaid_statement, parse_mermaid
+from chunking import split_into_chunks, map_chunks, reduce_step_lists
+from extraction import PageExtractor
+from revisions import apply_step_edits, changed_pages, diff_pages, format_changes, number_lines
+from neardup import NearDuplicateIndex, signature as text_signature, similarity as text_similarity
+from drawio import drawio_url, to_drawio_xml
+from links import mermaid_live_url
+import logs
+import metrics
+from metrics import Counter, Gauge, Histogram
+from render import RenderError, render_png, render_svg
+from ratelimit import RateLimiter, backoff_delay, error_status, is_retryable
+from uploads import SpooledUpload, spool
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # Load environment variables from .env file for local development
 try:
@@ -20,18 +40,56 @@ except ImportError:
     # dotenv not available in production, environment variables will be set by platform
     pass
 
+# Uploaded files are streamed into a SpooledUpload: kept in memory up to
+# UPLOAD_SPOOL_KB, written to a temp file in UPLOAD_TMP_DIR beyond that, and
+# hashed on the way in. Memory per upload stays flat, so MAX_UPLOAD_MB can
+# be raised for large documents
+UPLOAD_SPOOL_KB = int(os.getenv('UPLOAD_SPOOL_KB', 1024))
+UPLOAD_TMP_DIR = os.getenv('UPLOAD_TMP_DIR', '')  # Empty uses the system temp directory
+
+class UploadRequest(Request):
+    """Request whose uploaded files stream into hashed, size-capped SpooledUploads"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledUpload(filename=filename, **upload_options())
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', 16)) * 1024 * 1024  # Per request, batches included
 
-# Add error handling for better debugging
-import logging
-if os.environ.get('FLASK_ENV') == 'production':
-    logging.basicConfig(level=logging.INFO)
-else:
-    logging.basicConfig(level=logging.DEBUG)
+def upload_options():
+    """SpooledUpload settings: size cap, in-memory limit and temp directory"""
+    return {'max_size': app.config['MAX_CONTENT_LENGTH'], 'spool_size': UPLOAD_SPOOL_KB * 1024,
+            'directory': UPLOAD_TMP_DIR or None}
+
+def spooled_upload(file):
+    """The SpooledUpload behind an uploaded FileStorage (other streams are copied into one)"""
+    if isinstance(file.stream, SpooledUpload):
+        return file.stream
+    return spool(file.stream, file.filename, **upload_options())
+
+# Structured logging: JSON lines (LOG_FORMAT=text for local development)
+# written by a background thread, tagged with request and job IDs.
+# LOG_LEVEL=DEBUG adds per-call details such as prompt sizes
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Records beyond this are dropped, not waited on
+
+logs.setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE)
+log = logging.getLogger('storyboard')
 
 # AI API configuration - UPDATED TO USE xAI API (X.AI)
 XAI_API_KEY = os.getenv('XAI_API_KEY')  # Get from environment variables only
+XAI_MODEL = os.getenv('XAI_MODEL', 'grok-beta')
+XAI_BASE_URL = os.getenv('XAI_BASE_URL', 'https://api.x.ai/v1')  # Point at a mock server for benchmarks
+
+# Bump whenever the pipeline prompts change so cached results are not reused
+PROMPT_VERSION = '1'
+
+# 'chain' runs three dependent LLM calls, 'structured' asks once for JSON
+# and derives the Mermaid code locally. Can be overridden per request.
+PIPELINE_MODES = ('chain', 'structured')
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'chain')
 
 # Initialize xAI client
 try:
@@ -39,37 +97,221 @@ try:
         raise ValueError("XAI_API_KEY environment variable is required")
     client = OpenAI(
         api_key=XAI_API_KEY,
-        base_url="https://api.x.ai/v1"
+        base_url=XAI_BASE_URL,
+        max_retries=0  # Retries are handled by call_xai_api behind the rate limiter
     )
-    print(f"🚀 xAI client initialized successfully")
+    log.info("xAI client initialized", extra={'base_url': XAI_BASE_URL, 'model': XAI_MODEL})
 except Exception as e:
-    print(f"❌ Failed to initialize xAI client: {e}")
+    log.error("Failed to initialize xAI client: %s", e)
     client = None
 
+# Outbound xAI limits shared by every request in this process: concurrent
+# calls, requests/minute and tokens/minute (0 disables a limit)
+XAI_MAX_CONCURRENCY = int(os.getenv('XAI_MAX_CONCURRENCY', 4))
+XAI_REQUESTS_PER_MINUTE = int(os.getenv('XAI_REQUESTS_PER_MINUTE', 60))
+XAI_TOKENS_PER_MINUTE = int(os.getenv('XAI_TOKENS_PER_MINUTE', 0))
+XAI_MAX_BACKOFF = float(os.getenv('XAI_MAX_BACKOFF', 30))  # seconds
+
+llm_limiter = RateLimiter(
+    max_concurrency=XAI_MAX_CONCURRENCY,
+    requests_per_minute=XAI_REQUESTS_PER_MINUTE,
+    tokens_per_minute=XAI_TOKENS_PER_MINUTE
+)
+
+# Background job queue - size these to the LLM quota, not to the web worker count
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 20))
+JOB_TIMEOUT = int(os.getenv('JOB_TIMEOUT', 300))  # seconds per job
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', 3600))  # seconds results stay pollable
+
+job_queue = JobQueue(
+    workers=JOB_WORKERS,
+    max_queue=JOB_QUEUE_SIZE,
+    job_timeout=JOB_TIMEOUT,
+    result_ttl=JOB_RESULT_TTL
+)
+
+# Batch uploads fan out over their own, wider pool; LLM concurrency is still
+# bounded by the shared xAI limiter below. Both queues share one single-flight
+# registry, so an upload and a batch file with the same PDF share one job
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 8))
+BATCH_QUEUE_SIZE = int(os.getenv('BATCH_QUEUE_SIZE', 200))
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', 50))
+BATCH_MAX_UNZIPPED_MB = int(os.getenv('BATCH_MAX_UNZIPPED_MB', 200))  # Guards against zip bombs
+
+batch_queue = JobQueue(
+    workers=BATCH_WORKERS,
+    max_queue=BATCH_QUEUE_SIZE,
+    job_timeout=JOB_TIMEOUT,
+    result_ttl=JOB_RESULT_TTL,
+    flights=job_queue.flights
+)
+
+# Whole-pipeline result cache keyed on the PDF bytes, prompt version and model
+RESULT_CACHE_PATH = os.getenv('RESULT_CACHE_PATH', os.path.join('cache', 'results.sqlite3'))
+RESULT_CACHE_MEMORY_SIZE = int(os.getenv('RESULT_CACHE_MEMORY_SIZE', 128))
+RESULT_CACHE_DISK_SIZE = int(os.getenv('RESULT_CACHE_DISK_SIZE', 10000))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 7 * 24 * 3600))  # seconds, 0 disables expiry
+
+result_cache = ResultCache(
+    path=RESULT_CACHE_PATH or None,
+    max_memory_entries=RESULT_CACHE_MEMORY_SIZE,
+    max_disk_entries=RESULT_CACHE_DISK_SIZE,
+    ttl=RESULT_CACHE_TTL or None
+)
+
+# Near-duplicates: a document whose extracted text is at least
+# NEARDUP_THRESHOLD similar (estimated Jaccard similarity of its word 3-grams)
+# to an already converted one is converted as usual, and its result offers
+# that document's key (near_duplicate). Uploads with reuse=1 take the offer
+# instead: they get the cached flowchart without a new LLM run, so a changed
+# date or header line does not cost a regeneration. 0 disables the lookup
+NEARDUP_THRESHOLD = float(os.getenv('NEARDUP_THRESHOLD', 0.9))
+NEARDUP_MAX_ENTRIES = int(os.getenv('NEARDUP_MAX_ENTRIES', 100000))
+
+# Revised documents: an upload that names the result key of its previous
+# version (previous=<result_key>) has only its changed pages sent to the LLM,
+# in one call that returns edits to the earlier steps and a patch to the
+# earlier flowchart graph. Revisions less than REVISION_THRESHOLD similar to
+# the named version (0: no minimum) and diffs longer than
+# REVISION_MAX_DIFF_CHARS get a full conversion instead
+REVISION_THRESHOLD = float(os.getenv('REVISION_THRESHOLD', 0))
+REVISION_MAX_DIFF_CHARS = int(os.getenv('REVISION_MAX_DIFF_CHARS', 6000))
+
+near_duplicates = NearDuplicateIndex(
+    path=RESULT_CACHE_PATH or None,
+    threshold=NEARDUP_THRESHOLD,
+    max_entries=NEARDUP_MAX_ENTRIES
+)
+
+def result_cache_key(pdf, mode):
+    """Cache key for a whole pipeline run over the given PDF (bytes or a SpooledUpload)"""
+    if isinstance(pdf, SpooledUpload):
+        # Same key as for the bytes, from the hash computed while the upload streamed in
+        return pdf.content_hash(PROMPT_VERSION, XAI_MODEL, mode)
+    return content_hash(pdf, PROMPT_VERSION, XAI_MODEL, mode)
+
+# PDF extraction: 'auto' benchmarks the installed backends (PyPDF2, pypdf,
+# pdfminer.six, pypdfium2) on the first extraction and uses the fastest; a
+# named backend skips the benchmark. Large documents are extracted
+# page-parallel in a process pool, pages are cached by content hash, and
+# extraction stops once MAX_DOCUMENT_CHARS characters have been read
+EXTRACT_BACKEND = os.getenv('EXTRACT_BACKEND', 'auto')
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', min(4, os.cpu_count() or 1)))
+EXTRACT_PARALLEL_MIN_PAGES = int(os.getenv('EXTRACT_PARALLEL_MIN_PAGES', 16))
+EXTRACT_PAGE_CACHE_SIZE = int(os.getenv('EXTRACT_PAGE_CACHE_SIZE', 2048))
+MAX_DOCUMENT_CHARS = int(os.getenv('MAX_DOCUMENT_CHARS', 300000))
+
+page_extractor = PageExtractor(
+    backend=EXTRACT_BACKEND,
+    workers=EXTRACT_WORKERS,
+    parallel_min_pages=EXTRACT_PARALLEL_MIN_PAGES,
+    cache_size=EXTRACT_PAGE_CACHE_SIZE
+)
+
+# Long documents: characters per chunk sent to step extraction, chunk calls
+# in flight at once, and the size the merged step list is reduced to
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 6000))
+CHUNK_CONCURRENCY = int(os.getenv('CHUNK_CONCURRENCY', 4))
+MERGED_STEPS_MAX_CHARS = int(os.getenv('MERGED_STEPS_MAX_CHARS', 8000))
+
+# Per-stage LLM memo: identical (system prompt, prompt, model, temperature,
+# max_tokens) requests are answered locally instead of re-calling xAI
+LLM_MEMO_SIZE = int(os.getenv('LLM_MEMO_SIZE', 512))
+LLM_MEMO_TTL = int(os.getenv('LLM_MEMO_TTL', 24 * 3600))  # seconds, 0 disables expiry
+
+llm_memo = LRUCache(max_size=LLM_MEMO_SIZE, ttl=LLM_MEMO_TTL or None)
+
+# Local SVG/PNG rendering (/render/<job_or_hash>.svg): outputs are cached by
+# Mermaid text hash, bounded by entry count and total size
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', 256))
+RENDER_CACHE_MAX_MB = int(os.getenv('RENDER_CACHE_MAX_MB', 64))
+RENDER_VERSION = '1'  # Bump when render.py output changes
+RENDER_FORMATS = {'svg': 'image/svg+xml', 'png': 'image/png'}
+
+render_cache = LRUCache(max_size=RENDER_CACHE_SIZE, max_bytes=RENDER_CACHE_MAX_MB * 1024 * 1024 or None)
+
+# Mermaid Live links carry the whole chart; longer links than this are
+# replaced by a /share/<hash> page, as browsers, chat tools and proxies
+# truncate multi-KB URLs
+MERMAID_LIVE_MAX_URL = int(os.getenv('MERMAID_LIVE_MAX_URL', 4000))
+DRAWIO_MAX_URL = int(os.getenv('DRAWIO_MAX_URL', 4000))  # Longer draw.io links become the .drawio download
+
+def store_mermaid(mermaid_code):
+    """Keep Mermaid code in the result cache under its hash so it can be rendered later"""
+    mermaid_hash = content_hash(mermaid_code)
+    result_cache.put('mermaid:' + mermaid_hash, mermaid_code)
+    return mermaid_hash
+
+def load_mermaid(mermaid_hash):
+    return result_cache.get('mermaid:' + mermaid_hash)
+
+# Prometheus metrics (/metrics). Counts kept by the caches, queues and rate
+# limiter are read at scrape time rather than tracked twice
+def _cache_counts():
+    stats = {'llm_memo': llm_memo.stats(), 'render': render_cache.stats(), 'page': page_extractor.page_cache.stats(),
+             'near_duplicate': near_duplicates.stats()}
+    result = result_cache.stats()
+    # Disk hits are misses of the in-memory tier
+    stats['result'] = dict(result, hits=result['hits'] + result['disk_hits'], misses=result['misses'] - result['disk_hits'])
+    return stats
+
+def _retry_counts():
+    stats = llm_limiter.stats()
+    return {'throttled': stats['throttled'], 'error': stats['retries'] - stats['throttled']}
+
+http_requests_in_flight = Gauge('storyboard_http_requests_in_flight', 'HTTP requests being served')
+http_request_seconds = Histogram('storyboard_http_request_seconds', 'HTTP request latency',
+                                 ['endpoint', 'method', 'status'])
+pipeline_stage_seconds = Histogram('storyboard_pipeline_stage_seconds',
+                                   'Time spent per pipeline stage (extract, generate, mermaid_cleanup, total)',
+                                   ['stage'])
+llm_request_seconds = Histogram('storyboard_llm_request_seconds', 'xAI call latency per pipeline stage', ['stage'])
+llm_requests_total = Counter('storyboard_llm_requests_total', 'xAI calls by stage and outcome (ok, error, memo)',
+                             ['stage', 'outcome'])
+llm_tokens_total = Counter('storyboard_llm_tokens_total', 'Tokens used by xAI calls, from response.usage when reported',
+                           ['stage', 'direction'])
+Counter('storyboard_llm_retries_total', 'Retried xAI calls', ['reason'], callback=_retry_counts)
+Gauge('storyboard_llm_in_flight', 'xAI calls in flight', callback=lambda: llm_limiter.stats()['in_flight'])
+Gauge('storyboard_llm_waiting', 'xAI calls waiting for a rate limit slot', callback=lambda: llm_limiter.stats()['waiting'])
+Counter('storyboard_cache_hits_total', 'Cache hits', ['cache'],
+        callback=lambda: {name: stats['hits'] for name, stats in _cache_counts().items()})
+Counter('storyboard_cache_misses_total', 'Cache misses', ['cache'],
+        callback=lambda: {name: stats['misses'] for name, stats in _cache_counts().items()})
+Gauge('storyboard_cache_hit_ratio', 'Cache hit ratio since startup', ['cache'],
+      callback=lambda: {name: round(stats['hits'] / ((stats['hits'] + stats['misses']) or 1), 4)
+                        for name, stats in _cache_counts().items()})
+Counter('storyboard_log_records_dropped_total', 'Log records dropped because the log queue was full',
+        callback=lambda: logs.stats().get('dropped', 0))
+Gauge('storyboard_jobs_queued', 'Jobs waiting for a worker', ['queue'],
+      callback=lambda: {'upload': job_queue.stats()['queued'], 'batch': batch_queue.stats()['queued']})
+Gauge('storyboard_jobs_running', 'Jobs being processed', ['queue'],
+      callback=lambda: {'upload': job_queue.stats()['running'], 'batch': batch_queue.stats()['running']})
+revisions_total = Counter('storyboard_revisions_total',
+                          'Revised documents by outcome (patched, unchanged, missing, dissimilar, too_large, failed)', ['outcome'])
+uploads_coalesced_total = Counter('storyboard_uploads_coalesced_total',
+                                  'Uploads that joined a running conversion of the same PDF', ['endpoint'])
+
+def extract_pages_from_pdf(pdf_file, max_chars=None):
+    """Extract the text of each page of an uploaded PDF file (bytes, SpooledUpload or file object)
+
+    Stops after the page that brings the total past max_chars.
+    """
+    if isinstance(pdf_file, SpooledUpload):
+        pdf = pdf_file.source  # A spooled file is memory-mapped by path, not read in
+    else:
+        pdf = pdf_file if isinstance(pdf_file, bytes) else pdf_file.read()
+    with pipeline_stage_seconds.time(stage='extract'):
+        return page_extractor.extract_pages(pdf, max_chars)
+
 def extract_text_from_pdf(pdf_file):
     """Extract text from uploaded PDF file"""
-    try:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        print(f"Error extracting text from PDF: {e}")
+    pages = extract_pages_from_pdf(pdf_file)
+    if pages is None:
         return None
+    return ''.join(page + "\n" for page in pages)
 
-def call_xai_api(prompt, max_retries=3, for_mermaid=False):
-    """Make API call to xAI API - Powerful Grok models"""
-    print(f"🤖 Using xAI API - Grok Models!")
-    print(f" Prompt length: {len(prompt)} characters")
-    
-    if not client:
-        print("❌ xAI client not initialized")
-        return None
-    
-    # Dynamic system prompt based on request type
-    if for_mermaid:
-        system_content = """You are an expert Mermaid flowchart generator. Create clear, well-structured flowcharts from the provided content.
+MERMAID_SYSTEM_PROMPT = """You are an expert Mermaid flowchart generator. Create clear, well-structured flowcharts from the provided content.
 
 Guidelines:
 - Return only Mermaid syntax (no explanations or markdown blocks)
@@ -80,9 +322,8 @@ Guidelines:
 - Use proper Mermaid syntax: A[Step] --> B[Next Step] and A{Decision?} --> |Yes| B[Action]
 
 Generate the best possible flowchart that captures the essence and flow of the procedure."""
-        temperature = 0.6  # Balanced for creativity and precision
-    else:
-        system_content = """You are a laboratory procedure analyst. Extract clear, organized procedures from the provided content.
+
+PROCEDURE_SYSTEM_PROMPT = """You are a laboratory procedure analyst. Extract clear, organized procedures from the provided content.
 
 Key Focus:
 - Use only information from the provided content
@@ -93,41 +334,133 @@ Key Focus:
 - Include observations only if specifically mentioned in the content
 
 Create a comprehensive procedure that follows the natural flow described in the content."""
-        temperature = 0.7  # Higher for creative descriptions
+
+LLM_MAX_TOKENS = 4000
+
+def build_llm_request(for_mermaid=False, system_prompt=None, temperature=None, max_tokens=None):
+    """Return (system prompt, temperature, max_tokens) for an LLM call"""
+    # Dynamic system prompt based on request type
+    if for_mermaid:
+        system_content = MERMAID_SYSTEM_PROMPT
+        default_temperature = 0.6  # Balanced for creativity and precision
+    else:
+        system_content = PROCEDURE_SYSTEM_PROMPT
+        default_temperature = 0.7  # Higher for creative descriptions
+    if system_prompt:
+        system_content = system_prompt
+    if temperature is None:
+        temperature = default_temperature
+    return system_content, temperature, max_tokens or LLM_MAX_TOKENS
+
+def record_llm_call(stage, seconds, usage, estimated_prompt_tokens, content):
+    """Record latency and token metrics of a successful xAI call; returns the total tokens used"""
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or estimated_prompt_tokens
+    completion_tokens = getattr(usage, 'completion_tokens', None) or len(content or '') // 4
+    llm_request_seconds.observe(seconds, stage=stage)
+    llm_requests_total.inc(stage=stage, outcome='ok')
+    llm_tokens_total.inc(prompt_tokens, stage=stage, direction='prompt')
+    llm_tokens_total.inc(completion_tokens, stage=stage, direction='completion')
+    return getattr(usage, 'total_tokens', None) or prompt_tokens + completion_tokens
+
+def call_xai_api(prompt, max_retries=3, for_mermaid=False, use_memo=True, on_token=None,
+                 system_prompt=None, temperature=None, max_tokens=None, stage='other'):
+    """Make API call to xAI API - Powerful Grok models
+
+    When on_token is given the completion is streamed and on_token is called
+    with each text delta as it arrives; the full text is still returned.
+    system_prompt, temperature and max_tokens override the defaults picked
+    by for_mermaid. stage labels the call in the metrics.
+    """
+    if not client:
+        log.error("xAI client not initialized")
+        return None
+    
+    system_content, temperature, max_tokens = build_llm_request(for_mermaid, system_prompt, temperature, max_tokens)
+    
+    memo_key = content_hash(system_content, prompt, XAI_MODEL, str(temperature), str(max_tokens))
+    if use_memo:
+        memoized = llm_memo.get(memo_key)
+        if memoized is not None:
+            log.debug("LLM memo hit", extra={'stage': stage})
+            llm_requests_total.inc(stage=stage, outcome='memo')
+            if on_token:
+                on_token(memoized)
+            return memoized
+    
+    # Rough token estimate (~4 characters per token) used to reserve
+    # tokens-per-minute budget; corrected with the real usage afterwards
+    prompt_tokens = (len(system_content) + len(prompt)) // 4
+    estimated_tokens = prompt_tokens + min(max_tokens, 1000)
     
     for attempt in range(max_retries):
         try:
-            print(f"🌐 Making API call to xAI (attempt {attempt + 1}/{max_retries})")
-            
-            # Use xAI's chat completions API with dynamic system prompt
-            response = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_content
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                model="grok-beta",  # xAI's Grok model
-                temperature=temperature,
-                max_tokens=4000
-            )
+            with llm_limiter.slot(estimated_tokens) as waited:
+                if waited > 1:
+                    log.info("Waited for an xAI rate limit slot", extra={'stage': stage, 'wait_s': round(waited, 3)})
+                log.debug("Calling xAI", extra={'stage': stage, 'attempt': attempt + 1, 'prompt_chars': len(prompt)})
+                call_started = time.perf_counter()
+                
+                # Use xAI's chat completions API with dynamic system prompt
+                response = client.chat.completions.create(
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": system_content
+                        },
+                        {
+                            "role": "user",
+                            "content": prompt
+                        }
+                    ],
+                    model=XAI_MODEL,  # xAI's Grok model
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    # The final streamed chunk then carries the token usage
+                    **({'stream': True, 'stream_options': {'include_usage': True}} if on_token else {})
+                )
+                
+                if on_token:
+                    parts = []
+                    usage = None
+                    for chunk in response:
+                        usage = getattr(chunk, 'usage', None) or usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            parts.append(delta)
+                            on_token(delta)
+                    content = ''.join(parts)
+                else:
+                    content = response.choices[0].message.content
+                    usage = getattr(response, 'usage', None)
+                call_seconds = time.perf_counter() - call_started
+                used_tokens = record_llm_call(stage, call_seconds, usage, prompt_tokens, content)
             
-            print("✅ xAI API call successful!")
-            content = response.choices[0].message.content
-            print(f"📄 Response preview: {content[:100]}...")
+            llm_limiter.record_usage(used_tokens, estimated_tokens)
+            log.info("xAI call done", extra={'stage': stage, 'attempt': attempt + 1,
+                                             'duration_s': round(call_seconds, 3), 'tokens': used_tokens})
+            log.debug("xAI response preview: %.100s", content)
+            if content:
+                llm_memo.put(memo_key, content)
             return content
             
         except Exception as e:
-            print(f"❌ xAI API Error (attempt {attempt + 1}/{max_retries}): {e}")
+            log.warning("xAI call failed: %s", e, extra={'stage': stage, 'attempt': attempt + 1,
+                                                         'status': error_status(e)})
+            llm_requests_total.inc(stage=stage, outcome='error')
+            if not is_retryable(e):
+                log.error("xAI error is not retryable", extra={'stage': stage})
+                return None
             if attempt < max_retries - 1:
-                time.sleep(1)  # Short delay before retry
+                throttled = error_status(e) == 429
+                llm_limiter.record_retry(throttled=throttled)
+                delay = backoff_delay(attempt, e, max_delay=XAI_MAX_BACKOFF)
+                log.info("Retrying xAI call", extra={'stage': stage, 'delay_s': round(delay, 3), 'throttled': throttled})
+                time.sleep(delay)
                 continue
             else:
-                print("❌ All xAI API retry attempts failed")
+                log.error("All xAI retry attempts failed", extra={'stage': stage})
                 return None
     
     return None
@@ -142,198 +475,113 @@ def generate_mermaid_live_url(mermaid_code):
         elif clean_code.startswith('```'):
             clean_code = clean_code.replace('```', '').strip()
         
-        # Base64 encode for Mermaid Live
-        import base64
-        encoded = base64.b64encode(clean_code.encode('utf-8')).decode('utf-8')
-        return f"https://mermaid.live/edit#pako:{encoded}"
+        # Deflated state JSON, as Mermaid Live's own share links
+        return mermaid_live_url(clean_code)
     except Exception as e:
-        print(f"Error generating Mermaid Live URL: {e}")
+        log.warning("Error generating Mermaid Live URL: %s", e)
         return "https://mermaid.live/"
 
+def generate_drawio_xml(mermaid_code):
+    """draw.io XML for Mermaid code, laid out locally; cached with the rendered images"""
+    render_key = content_hash(RENDER_VERSION, 'drawio', mermaid_code)
+    xml = render_cache.get(render_key)
+    if xml is None:
+        xml = to_drawio_xml(parse_mermaid(mermaid_code, errors=[]))
+        render_cache.put(render_key, xml)
+    return xml
+
 def generate_drawio_url(mermaid_code):
-    """Generate draw.io URL - simplified approach"""
-    # For reliability, just open Draw.io and let user paste manually
-    return "https://app.diagrams.net/?splash=0&ui=kennedy&iconfont=1&p=mermaiddiagram"
+    """Generate a draw.io URL that opens the converted diagram directly"""
+    try:
+        return drawio_url(generate_drawio_xml(mermaid_code))
+    except Exception as e:
+        log.warning("Error generating draw.io URL: %s", e)
+        return "https://app.diagrams.net/?splash=0&ui=kennedy&iconfont=1&p=mermaiddiagram"
+
+# Mermaid post-processing patterns, compiled once at import
+_EXPLANATORY_TEXT = re.compile('here is|this is|the following|note:|explanation|'
+                               'however|to better|we can use|this represents')
+_TAG_ARROW = re.compile(r'\|>|<\|(?!>)')  # |> first, as if replaced before <|
+_MERMAID_FENCE = re.compile(r'```(?:mermaid)?[ \t]*\n(.*?)\n[ \t]*```', re.DOTALL)
+_FLOWCHART_HEADER = re.compile(r'^\s*(?:flowchart|graph)\b', re.MULTILINE)
+_LINK_TOKEN = re.compile(r'--|==|-\.')
+
+def clean_mermaid_lines(mermaid_code):
+    """Strip lines, blank out explanatory text and fix |> arrows, keeping line numbers stable"""
+    lines = []
+    for line in mermaid_code.split('\n'):
+        line = line.strip()
+        # Skip explanatory text lines
+        if _EXPLANATORY_TEXT.search(line.lower()):
+            line = ''
+        elif '|>' in line or '<|' in line:
+            # Fix the specific |> arrow issue that causes TAGEND errors
+            line = _TAG_ARROW.sub(' --> ', line)
+        lines.append(line)
+    return lines
+
+def validate_mermaid(mermaid_code):
+    """Return the syntax errors in Mermaid code (MermaidSyntaxError list), without any network call
+
+    Line numbers refer to the lines of mermaid_code. Explanatory text and slips the parser repairs by itself are not errors.
+    """
+    errors = []
+    parse_mermaid('\n'.join(clean_mermaid_lines(mermaid_code)), errors)
+    return errors
 
 def validate_and_fix_mermaid(mermaid_code):
-    """Validate and fix common Mermaid syntax errors"""
+    """Validate and fix common Mermaid syntax errors
+
+    The code is parsed into a Flowchart, dropping explanatory text and any
+    statement that does not parse, and serialized back to clean Mermaid.
+    Returns an empty string if nothing usable is left.
+    """
     try:
-        import re
-        
-        lines = mermaid_code.strip().split('\n')
-        fixed_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Skip explanatory text lines
-            if any(phrase in line.lower() for phrase in [
-                'here is', 'this is', 'the following', 'note:', 'explanation', 
-                'however', 'to better', 'we can use', 'this represents'
-            ]):
-                continue
-            
-            # Fix common Mermaid syntax issues
-            if 'flowchart' in line:
-                fixed_lines.append(line)
-                continue
-            
-            # Fix the specific |> arrow issue that causes TAGEND errors
-            line = re.sub(r'\|>', ' --> ', line)
-            line = re.sub(r'<\|', ' --> ', line)
-            
-            # Fix incomplete arrows
-            line = re.sub(r'--([^>-])', r' --> \1', line)
-            
-            # Clean up edge label syntax
-            line = re.sub(r'\|\s*([^|]*?)\s*\|(?=[A-Z])', r'|"\1"| ', line)
-            
-            # Simplify complex labels that might cause issues
-            # Replace problematic characters in labels
-            def fix_label(match):
-                node = match.group(1)
-                label = match.group(2)
-                # Remove or replace problematic characters
-                label = label.replace('|', ' or ')
-                label = label.replace('>', '')
-                label = label.replace('<', '')
-                label = label.replace(':', '')
-                label = label.replace('&', 'and')
-                label = label.replace('/', ' or ')
-                return f'{node}[{label}]'
-            
-            # Fix node labels
-            line = re.sub(r'([A-Z][0-9]*)\[([^\]]+)\]', fix_label, line)
-            
-            # Fix decision node labels
-            def fix_decision_label(match):
-                node = match.group(1)
-                label = match.group(2)
-                label = label.replace('|', ' or ')
-                label = label.replace('>', '')
-                label = label.replace('<', '')
-                label = label.replace(':', '')
-                label = label.replace('&', 'and')
-                label = label.replace('/', ' or ')
-                return f'{node}{{{label}}}'
-            
-            line = re.sub(r'([A-Z][0-9]*)\{([^\}]+)\}', fix_decision_label, line)
-            
-            # Ensure proper spacing around arrows
-            line = re.sub(r'\s*-->\s*', ' --> ', line)
-            
-            # Only add lines that look like valid Mermaid syntax
-            if ('-->' in line or 
-                line.startswith(('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K')) or
-                'flowchart' in line):
-                fixed_lines.append(line)
-        
-        # Ensure we start with flowchart directive
-        if fixed_lines and not any('flowchart' in line for line in fixed_lines[:3]):
-            fixed_lines.insert(0, 'flowchart TD')
-        
-        result = '\n'.join(fixed_lines)
-        return result.strip()
+        errors = []
+        chart = parse_mermaid('\n'.join(clean_mermaid_lines(mermaid_code)), errors)
+        for error in errors:
+            log.warning("Dropped Mermaid statement: %s", error.message, extra={'line': error.line})
+        if not chart.nodes:
+            return ''
+        return chart.to_mermaid()
         
     except Exception as e:
-        print(f"Error validating Mermaid code: {e}")
+        log.exception("Error validating Mermaid code: %s", e)
         return mermaid_code
 
 def extract_mermaid_code(response_text):
-    """Extract only the Mermaid code from Groq's response, removing all explanatory text"""
+    """Extract only the Mermaid code from the LLM response, removing all explanatory text"""
     try:
-        import re
-        
-        # First, try to find all mermaid code blocks in the response
-        code_blocks = []
-        
-        # Pattern 1: Find ```mermaid blocks
-        mermaid_pattern = r'```mermaid\s*\n(.*?)\n```'
-        matches = re.findall(mermaid_pattern, response_text, re.DOTALL)
-        for match in matches:
-            clean_code = match.strip()
-            if clean_code and 'flowchart' in clean_code:
-                code_blocks.append(clean_code)
+        # Fenced code blocks that contain a flowchart
+        code_blocks = [block.strip() for block in _MERMAID_FENCE.findall(response_text)
+                       if _FLOWCHART_HEADER.search(block)]
         
-        # Pattern 2: Find standalone flowchart blocks (without ```mermaid wrapper)
+        # Otherwise take each flowchart header plus the statements that follow it,
+        # up to the first line that is not Mermaid (usually explanatory text)
         if not code_blocks:
-            lines = response_text.split('\n')
-            current_block = []
-            in_flowchart = False
-            
-            for line in lines:
+            current = None
+            for line in response_text.split('\n') + ['']:
                 stripped = line.strip()
-                
-                # Start capturing when we find flowchart
-                if not in_flowchart and 'flowchart TD' in stripped:
-                    in_flowchart = True
-                    current_block = [stripped]
-                    continue
-                
-                # If we're in a flowchart block
-                if in_flowchart:
-                    # Stop conditions: empty line followed by explanatory text, or obvious explanatory phrases
-                    if (not stripped or 
-                        any(phrase in stripped.lower() for phrase in [
-                            'however', 'this mermaid', 'here is', 'the diagram', 'to better', 
-                            'we can use', 'this represents', 'making it easier', 'clearly represents',
-                            'more detailed', 'even more detailed', 'version:', 'diagram:'
-                        ])):
-                        if current_block:
-                            code_blocks.append('\n'.join(current_block))
-                            current_block = []
-                        in_flowchart = False
-                        continue
-                    
-                    # Valid mermaid syntax lines
-                    if (stripped and (
-                        '-->' in stripped or
-                        stripped.startswith(('[', '{')) or
-                        '|' in stripped or
-                        stripped.endswith((']', '}')) or
-                        any(node in stripped for node in ['A[', 'B[', 'C[', 'D[', 'E[', 'F[', 'G[', 'H[', 'I[', 'J[', 'K['])
-                    )):
-                        current_block.append(stripped)
-            
-            # Add the last block if it exists
-            if current_block and in_flowchart:
-                code_blocks.append('\n'.join(current_block))
+                if _FLOWCHART_HEADER.match(stripped):
+                    current = [stripped]
+                    code_blocks.append(current)
+                elif current is not None and stripped and not stripped.startswith('```'):
+                    # Broken statements with a link are kept too, for repair_mermaid
+                    if is_mermaid_statement(stripped) or _LINK_TOKEN.search(stripped):
+                        current.append(stripped)
+                    else:
+                        current = None
+            code_blocks = ['\n'.join(block) for block in code_blocks if len(block) > 1]
         
-        # Choose the best code block (usually the most detailed one)
+        # Prefer the longest block as it's usually the most detailed
         if code_blocks:
-            # Prefer the longest block as it's usually the most detailed
-            best_block = max(code_blocks, key=len)
-            return best_block.strip()
-        
-        # Fallback: try to extract the first flowchart we find
-        lines = response_text.split('\n')
-        for i, line in enumerate(lines):
-            if 'flowchart TD' in line:
-                result_lines = [line.strip()]
-                # Take the next lines that look like mermaid syntax
-                for j in range(i + 1, len(lines)):
-                    next_line = lines[j].strip()
-                    if (next_line and (
-                        '-->' in next_line or
-                        next_line.startswith(('[', '{')) or
-                        '|' in next_line or
-                        next_line.endswith((']', '}')) or
-                        any(node in next_line for node in ['A[', 'B[', 'C[', 'D[', 'E['])
-                    )):
-                        result_lines.append(next_line)
-                    elif not next_line or any(phrase in next_line.lower() for phrase in ['however', 'this', 'here']):
-                        break
-                
-                if len(result_lines) > 1:  # Only return if we have more than just the flowchart line
-                    return '\n'.join(result_lines)
+            return max(code_blocks, key=len)
         
         # Last resort: return the original text cleaned up
         return response_text.strip()
         
     except Exception as e:
-        print(f"Error extracting mermaid code: {e}")
+        log.exception("Error extracting mermaid code: %s", e)
         return response_text.strip()
 
 @app.route('/')
@@ -344,11 +592,69 @@ def index():
 def health_check():
     return jsonify({'status': 'healthy', 'message': 'Storyboard Generator is running'}), 200
 
+@app.route('/stats')
+def stats():
+    """Runtime statistics for capacity planning"""
+    return jsonify({
+        'jobs': job_queue.stats(),
+        'batch_jobs': batch_queue.stats(),
+        'result_cache': result_cache.stats(),
+        'near_duplicates': near_duplicates.stats(),
+        'extraction': page_extractor.stats(),
+        'llm_memo': llm_memo.stats(),
+        'render_cache': render_cache.stats(),
+        'xai_limiter': llm_limiter.stats(),
+        'mermaid_repair': mermaid_repair_snapshot(),
+        'logging': logs.stats()
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.REGISTRY.expose(), content_type=metrics.CONTENT_TYPE)
+
+_REQUEST_ID = re.compile(r'^[\w.-]{1,64}$')
+
+def request_id_for(requested=None):
+    """The caller's X-Request-ID if it looks sane, else a new ID"""
+    return requested if requested and _REQUEST_ID.match(requested) else uuid.uuid4().hex[:16]
+
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    http_requests_in_flight.inc()
+    # Every log record of this request (and of jobs it queues) carries the
+    # request ID; callers may pass their own in X-Request-ID
+    g.request_id = request_id_for(request.headers.get('X-Request-ID'))
+    g.log_context = logs.bind(request_id=g.request_id)
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_requests_in_flight.dec()
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        duration = time.perf_counter() - started
+        http_request_seconds.observe(duration, endpoint=endpoint, method=request.method, status=response.status_code)
+        log.debug("Request done", extra={'endpoint': endpoint, 'method': request.method,
+                                         'status': response.status_code, 'duration_s': round(duration, 4)})
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request(error=None):
+    # Requests that raised never reach after_request
+    if g.pop('request_started', None) is not None:
+        http_requests_in_flight.dec()
+    log_context = g.pop('log_context', None)
+    if log_context:
+        logs.unbind(log_context)
+
 @app.route('/test-api')
 def test_api():
     """Test endpoint to check if xAI API is working"""
-    print("🧪 Testing xAI API key...")
-    test_response = call_xai_api("Hello, please respond with 'xAI API is working perfectly!'", for_mermaid=False)
+    test_response = call_xai_api("Hello, please respond with 'xAI API is working perfectly!'", for_mermaid=False, use_memo=False, stage='test')
     if test_response:
         return jsonify({
             'success': True, 
@@ -361,35 +667,314 @@ def test_api():
             'error': 'xAI API test failed - check logs'
         })
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file uploaded'}), 400
+@app.route('/validate', methods=['POST'])
+def validate_route():
+    """Check Mermaid code locally and report syntax errors by line"""
+    data = request.get_json(silent=True) or {}
+    mermaid_code = data.get('mermaid') or request.form.get('mermaid')
+    if not mermaid_code:
+        return jsonify({'error': 'No Mermaid code provided'}), 400
     
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    errors = validate_mermaid(mermaid_code)
+    return jsonify({
+        'valid': not errors,
+        'errors': [{'line': e.line_number, 'message': e.message, 'text': e.line} for e in errors]
+    })
+
+class PipelineError(Exception):
+    """Error raised by the generation pipeline, carrying an HTTP status code"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+def emit_event(job, event, **data):
+    """Record a progress event on the job, if the pipeline is running as one"""
+    if job:
+        job.emit(event, data)
+
+def token_callback(job, stage):
+    """Return an on_token callback streaming LLM output into the job's events"""
+    if not job:
+        return None
+    return lambda text: job.emit('token', {'stage': stage, 'text': text})
+
+def generate_flowchart(pdf, job=None, mode=None, reuse_similar=False, previous=None):
+    """Run the full PDF -> steps -> description -> Mermaid pipeline
+
+    pdf is the PDF's bytes or a SpooledUpload. mode selects between the three-call 'chain' and the single-call
+    'structured' pipeline (defaults to PIPELINE_MODE). When run as a job,
+    stage_start / token / stage_done events are emitted so clients can render
+    each stage as soon as it is available. A near-duplicate of an earlier
+    document is offered in the result (and a near_duplicate event); with
+    reuse_similar the earlier document's cached result is returned instead.
+    previous is the result key of an earlier version of this document, whose
+    flowchart is then patched for the changed pages.
+    """
+    mode = mode if mode in PIPELINE_MODES else PIPELINE_MODE
+    started = time.perf_counter()
     
-    if not file.filename.lower().endswith('.pdf'):
-        return jsonify({'error': 'Please upload a PDF file'}), 400
+    # Extract text from PDF
+    emit_event(job, 'stage_start', stage='extract')
+    pages = extract_pages_from_pdf(pdf, MAX_DOCUMENT_CHARS)
+    pdf_text = ''.join(page + "\n" for page in pages) if pages else None
+    if not pdf_text or not pdf_text.strip():
+        raise PipelineError('Could not extract text from PDF', 400)
     
-    try:
-        # Extract text from PDF
-        print("📄 Extracting text from PDF...")
-        pdf_text = extract_text_from_pdf(file)
-        if not pdf_text:
-            return jsonify({'error': 'Could not extract text from PDF'}), 400
-        
-        print(f"✅ Extracted {len(pdf_text)} characters from PDF")
-        
-        # Limit text size to avoid API limits
-        if len(pdf_text) > 6000:  # Reduced limit for better reliability
-            pdf_text = pdf_text[:6000] + "..."
-            print(f"⚠️  Text truncated to {len(pdf_text)} characters due to API limits")
-        
-        # Step 1: Generate steps from storyboard using xAI
-        print("🤖 Step 1: Generating steps from storyboard...")
-        step1_prompt = f"""Analyze this laboratory storyboard content and extract a clear, organized procedure.
+    extracted = time.perf_counter()
+    log.info("Stage done", extra={'stage': 'extract', 'duration_s': round(extracted - started, 3),
+                                  'pages': len(pages), 'characters': len(pdf_text)})
+    if len(pdf_text) >= MAX_DOCUMENT_CHARS:
+        log.warning("Stopped extraction at MAX_DOCUMENT_CHARS", extra={'pages': len(pages), 'max_chars': MAX_DOCUMENT_CHARS})
+    emit_event(job, 'stage_done', stage='extract', characters=len(pdf_text), pages=len(pages))
+    
+    fingerprint = text_fingerprint(pdf_text)
+    similar = find_near_duplicate(fingerprint, mode)
+    if similar and reuse_similar:
+        return serve_near_duplicate(similar, mode, started, extracted)
+    if similar:
+        emit_event(job, 'near_duplicate', key=similar[1], similarity=similar[0])
+    if previous:
+        # A revision of an earlier version: one small call patches its flowchart
+        revision = plan_revision(previous, pages, fingerprint)
+        chart = revision and run_revision(revision, job)
+        if chart:
+            return offer_near_duplicate(
+                assemble_result(pdf, mode, chart, started, extracted, fingerprint, pages, revision['info']), similar)
+    
+    # Long documents are split into chunks whose steps are extracted in
+    # parallel and merged, instead of truncating the text
+    steps_response = None
+    if len(pdf_text) > CHUNK_SIZE:
+        steps_response = extract_steps_chunked(pages, job)
+    
+    chart = None
+    pipeline_mode = mode
+    if mode == 'structured':
+        chart = run_structured_pipeline(steps_response or pdf_text, job)
+        if chart is None:
+            log.warning("Structured generation failed, falling back to the three-step chain")
+            pipeline_mode = 'chain'
+    if chart is None:
+        chart = run_chain_pipeline(pdf_text, job, steps_response=steps_response)
+    # Cached under the requested mode, so the next upload in that mode finds it
+    return offer_near_duplicate(
+        assemble_result(pdf, mode, chart, started, extracted, fingerprint, pages, pipeline_mode=pipeline_mode), similar)
+
+def text_fingerprint(pdf_text):
+    """Signature of the extracted text for near-duplicate lookups, or None when they are disabled"""
+    return text_signature(pdf_text) if NEARDUP_THRESHOLD > 0 else None
+
+def find_near_duplicate(fingerprint, mode):
+    """(similarity, key, cached result) of the most similar earlier document above NEARDUP_THRESHOLD, or None"""
+    if NEARDUP_THRESHOLD <= 0:
+        return None
+    for similarity, key in near_duplicates.query(fingerprint, tag=mode):
+        cached = result_cache.get(key)
+        if cached is None:
+            near_duplicates.remove(key)  # Expired from the result cache
+            continue
+        return round(similarity, 3), key, cached
+    return None
+
+def serve_near_duplicate(similar, mode, started, extracted):
+    """A near-duplicate's cached result as this document's, for uploads that asked to reuse it
+
+    The result is returned with near_duplicate and this run's timings added;
+    it is not cached under this document's key, so an upload of this document
+    without reuse still gets its own conversion and cache entry.
+    """
+    similarity, key, cached = similar
+    total = time.perf_counter() - started
+    pipeline_stage_seconds.observe(total, stage='total')
+    log.info("Near-duplicate reused", extra={'mode': mode, 'similarity': similarity})
+    result = dict(cached, near_duplicate={'key': key, 'similarity': similarity, 'served': True}, timings={
+        'extract': round(extracted - started, 3),
+        'generate': 0.0,
+        'total': round(total, 3)
+    })
+    result.pop('revision', None)  # Describes how the cached result was made, not this document
+    return result
+
+def offer_near_duplicate(result, similar):
+    """A copy of result offering the near-duplicate found for it (near_duplicate.key), or result if none"""
+    if not similar:
+        return result
+    similarity, key, _ = similar
+    # A copy: the offer is not part of the cached result, and may not hold for later uploads
+    return dict(result, near_duplicate={'key': key, 'similarity': similarity, 'served': False})
+
+def plan_revision(previous_key, pages, fingerprint=None):
+    """{'previous', 'changes', 'info'} to patch the result cached under previous_key for these pages, or None
+
+    None (a full conversion) when that result or its page texts are no longer
+    cached, when the document is less than REVISION_THRESHOLD similar to it,
+    or when the diff is longer than REVISION_MAX_DIFF_CHARS.
+    """
+    previous = result_cache.get(previous_key)
+    previous_pages = result_cache.get('pages:' + previous_key)
+    if previous is None or previous_pages is None:
+        revisions_total.inc(outcome='missing')
+        log.info("Previous version no longer cached, converting in full", extra={'previous': previous_key})
+        return None
+    fingerprint = fingerprint or text_signature(''.join(page + '\n' for page in pages))
+    previous_fingerprint = text_signature(''.join(page + '\n' for page in previous_pages))
+    score = text_similarity(fingerprint, previous_fingerprint) if fingerprint and previous_fingerprint else 0.0
+    info = {'previous': previous_key, 'similarity': round(score, 3)}
+    if score < REVISION_THRESHOLD:
+        revisions_total.inc(outcome='dissimilar')
+        log.info("Document too different from the previous version, converting in full", extra=info)
+        return None
+    changes = diff_pages(previous_pages, pages)
+    text = format_changes(changes)
+    info['changed_pages'] = changed_pages(changes)
+    if len(text) > REVISION_MAX_DIFF_CHARS:
+        revisions_total.inc(outcome='too_large')
+        log.info("Revision diff too large, converting in full", extra={'diff_chars': len(text), **info})
+        return None
+    return {'previous': previous, 'changes': text, 'info': info}
+
+def run_revision(revision, job=None):
+    """(steps, description, mermaid_code) of the previous result patched for the changed pages, or None"""
+    previous = revision['previous']
+    if not revision['changes']:
+        # Same text on every page, e.g. a re-saved file: nothing to ask the LLM
+        revisions_total.inc(outcome='unchanged')
+        revision['info'].update(step_changes=0, graph_changes=0)
+        return previous['steps'], previous['flowchart_description'], previous['mermaid_code']
+    emit_event(job, 'stage_start', stage='revision')
+    response = call_xai_api(
+        build_revision_prompt(previous, revision['changes']),
+        system_prompt=STRUCTURED_SYSTEM_PROMPT,
+        temperature=STRUCTURED_TEMPERATURE,
+        on_token=token_callback(job, 'revision'),
+        stage='revision'
+    )
+    chart = revised_chart(revision, response)
+    if chart:
+        steps, description, mermaid_code = chart
+        emit_event(job, 'stage_done', stage='steps', text=steps)
+        emit_event(job, 'stage_done', stage='description', text=description)
+        emit_event(job, 'stage_done', stage='mermaid', text=mermaid_code)
+        emit_event(job, 'stage_done', stage='revision', changed_pages=revision['info']['changed_pages'])
+    return chart
+
+def build_revision_prompt(previous, changes):
+    """Prompt with just the changed text and the previous steps and flowchart, asking for edits to both"""
+    return f"""A laboratory storyboard was revised. Below are the changes to its text as a unified diff ("-" lines were removed, "+" lines were added), and the procedure steps, description and flowchart made from the previous version.
+
+Changes:
+{changes}
+
+Current steps (by line number):
+{number_lines(previous['steps'])}
+
+Current description:
+{previous['flowchart_description']}
+
+Current flowchart:
+{previous['mermaid_code']}
+
+Update the steps, description and flowchart for these changes only. Return exactly this JSON structure:
+{{
+  "remove_steps": [4],
+  "replace_steps": [{{"line": 5, "text": "Step as it reads now"}}],
+  "insert_steps": [{{"after": 6, "text": "New step"}}],
+  "description": "",
+  "remove_nodes": ["C"],
+  "nodes": [{{"id": "C", "label": "New or changed label", "shape": "rect"}}],
+  "remove_edges": [{{"from": "B", "to": "C"}}],
+  "edges": [{{"from": "B", "to": "D", "label": ""}}]
+}}
+
+Step edits refer to the line numbers above ("after": 0 inserts at the start). Give "description" only if the current one no longer holds, else leave it empty. Reuse the existing node IDs and list only what changes; leave the lists empty if nothing is affected (for example a new date or header). Use "rect" for actions, "diamond" for decisions and "stadium" for start/end nodes."""
+
+def revised_chart(revision, response):
+    """Apply the step edits and graph patch in a revision answer to the previous result; None if it is unusable
+
+    The description is replaced when the answer gives a new one.
+    """
+    patch = parse_json_object(response)
+    if patch is None:
+        revisions_total.inc(outcome='failed')
+        log.warning("Unusable revision answer, converting in full")
+        return None
+    previous = revision['previous']
+    chart = parse_mermaid(previous['mermaid_code'], [])
+    applied = chart.apply_patch(patch)
+    if not chart.edges:
+        revisions_total.inc(outcome='failed')
+        log.warning("Revision patch left an empty flowchart, converting in full")
+        return None
+    steps, step_changes = apply_step_edits(previous['steps'], patch)
+    description = str(patch.get('description') or '').strip() or previous['flowchart_description']
+    revision['info'].update(step_changes=step_changes, graph_changes=applied)
+    revisions_total.inc(outcome='patched')
+    log.info("Revision patched", extra=revision['info'])
+    return steps, description, validate_and_fix_mermaid(chart.to_mermaid())
+
+def assemble_result(pdf, mode, chart, started, extracted, fingerprint=None, pages=None, revision=None,
+                    pipeline_mode=None):
+    """Add visualization URLs and timings to a generated chart and cache the result
+
+    The result is cached and indexed under the requested mode; pipeline_mode
+    is the mode that actually produced the chart, if different (a structured
+    request that fell back to the chain). fingerprint, if given, is indexed
+    so near-duplicates of this document can reuse the result, and pages are
+    kept so a later revision naming this result can be diffed against them.
+    revision describes a chart patched from an earlier version.
+    """
+    steps_response, flowchart_response, mermaid_response = chart
+    generated = time.perf_counter()
+    
+    # Generate URLs for visualization
+    mermaid_hash = store_mermaid(mermaid_response)
+    drawio_download_url = f'/drawio/{mermaid_hash}.drawio'
+    drawio_url = generate_drawio_url(mermaid_response)
+    drawio_url_length = len(drawio_url)
+    if drawio_url_length > DRAWIO_MAX_URL:
+        log.info("draw.io URL too long, linking the .drawio download instead", extra={'url_length': drawio_url_length})
+        drawio_url = drawio_download_url
+    mermaid_live_url = generate_mermaid_live_url(mermaid_response)
+    mermaid_live_url_length = len(mermaid_live_url)
+    if mermaid_live_url_length > MERMAID_LIVE_MAX_URL:
+        log.info("Mermaid Live URL too long, using a share link", extra={'url_length': mermaid_live_url_length})
+        mermaid_live_url = f'/share/{mermaid_hash}'
+    
+    result = {
+        'steps': steps_response,
+        'flowchart_description': flowchart_response,
+        'mermaid_code': mermaid_response,
+        'drawio_url': drawio_url,
+        'drawio_url_length': drawio_url_length,
+        'drawio_download_url': drawio_download_url,
+        'mermaid_live_url': mermaid_live_url,
+        'mermaid_live_url_length': mermaid_live_url_length,
+        'mermaid_hash': mermaid_hash,
+        'svg_url': f'/render/{mermaid_hash}.svg',
+        'png_url': f'/render/{mermaid_hash}.png',
+        'pipeline_mode': pipeline_mode or mode,
+        'timings': {
+            'extract': round(extracted - started, 3),
+            'generate': round(generated - extracted, 3),
+            'total': round(time.perf_counter() - started, 3)
+        }
+    }
+    pipeline_stage_seconds.observe(generated - extracted, stage='generate')
+    pipeline_stage_seconds.observe(result['timings']['total'], stage='total')
+    if revision:
+        result['revision'] = revision
+    log.info("Pipeline done", extra={'mode': result['pipeline_mode'], 'timings': result['timings']})
+    key = result_cache_key(pdf, mode)
+    result_cache.put(key, result)
+    near_duplicates.add(key, fingerprint, tag=mode)
+    if pages:
+        result_cache.put('pages:' + key, pages)
+    return result
+
+def build_steps_prompt(content):
+    """Step 1 prompt: extract an organized procedure from storyboard text"""
+    return f"""Analyze this laboratory storyboard content and extract a clear, organized procedure.
 
 Requirements:
 - Use only information from the storyboard content provided
@@ -400,19 +985,109 @@ Requirements:
 - Be detailed but practical
 
 Storyboard content:
-{pdf_text}
+{content}
 
 Extract a comprehensive procedure that follows the natural flow described in the storyboard."""
+
+def build_consolidate_prompt(text):
+    """Reduce prompt: merge partial procedures from consecutive chunks into one"""
+    return f"""Combine these partial procedures, extracted from consecutive parts of one laboratory storyboard, into a single organized procedure.
+
+Requirements:
+- Keep the original order of the steps
+- Remove duplicated safety, setup and cleanup steps
+- Preserve decision points and alternative methods
+- Do not add information that is not in the partial procedures
+
+Partial procedures:
+{text}"""
+
+def extract_steps_chunked(pages, job=None):
+    """Map step extraction over page chunks concurrently and merge the partial step lists"""
+    chunks = split_into_chunks(pages, CHUNK_SIZE)
+    stage_started = time.perf_counter()
+    emit_event(job, 'stage_start', stage='steps', chunks=len(chunks))
+    
+    def extract_chunk(chunk):
+        if job:
+            job.check_deadline()
+        steps = call_xai_api(build_steps_prompt(chunk), stage='steps')
+        emit_event(job, 'chunk_done', stage='steps', ok=bool(steps))
+        return steps
+    
+    def consolidate(text):
+        return call_xai_api(build_consolidate_prompt(text), stage='consolidate')
+    
+    partials = map_chunks(extract_chunk, chunks, CHUNK_CONCURRENCY)
+    if not any(partials):
+        raise PipelineError('Failed to generate steps from xAI API. Please check your API key.', 500)
+    
+    steps_response = reduce_step_lists(partials, consolidate, MERGED_STEPS_MAX_CHARS, CHUNK_CONCURRENCY)
+    log.info("Stage done", extra={'stage': 'steps', 'duration_s': round(time.perf_counter() - stage_started, 3),
+                                  'chunks': len(chunks), 'chunks_ok': sum(1 for p in partials if p)})
+    emit_event(job, 'stage_done', stage='steps', text=steps_response)
+    return steps_response
+
+def run_chain_pipeline(pdf_text, job=None, steps_response=None):
+    """Three dependent LLM calls: steps -> flowchart description -> Mermaid
+
+    Step 1 is skipped when steps_response was already produced (e.g. by
+    chunked extraction of a long document).
+    """
+    if job:
+        job.check_deadline()
+    
+    if steps_response is None:
+        # Limit text size to avoid API limits
+        if len(pdf_text) > CHUNK_SIZE:
+            pdf_text = pdf_text[:CHUNK_SIZE] + "..."
+            log.info("Text truncated due to API limits", extra={'characters': len(pdf_text)})
         
-        steps_response = call_xai_api(step1_prompt)
+        # Step 1: Generate steps from storyboard using xAI
+        stage_started = time.perf_counter()
+        emit_event(job, 'stage_start', stage='steps')
+        steps_response = call_xai_api(build_steps_prompt(pdf_text), on_token=token_callback(job, 'steps'), stage='steps')
         if not steps_response:
-            return jsonify({'error': 'Failed to generate steps from xAI API. Please check your API key.'}), 500
+            raise PipelineError('Failed to generate steps from xAI API. Please check your API key.', 500)
         
-        print("✅ Step 1 completed: Generated steps")
-        
-        # Step 2: Create flowchart description using xAI
-        print("🤖 Step 2: Creating flowchart representation...")
-        step2_prompt = f"""Create a flowchart description that represents this laboratory procedure clearly and logically.
+        log.info("Stage done", extra={'stage': 'steps', 'duration_s': round(time.perf_counter() - stage_started, 3)})
+        emit_event(job, 'stage_done', stage='steps', text=steps_response)
+    
+    if job:
+        job.check_deadline()
+    
+    # Step 2: Create flowchart description using xAI
+    stage_started = time.perf_counter()
+    emit_event(job, 'stage_start', stage='description')
+    flowchart_response = call_xai_api(build_description_prompt(steps_response), on_token=token_callback(job, 'description'),
+                                      stage='description')
+    if not flowchart_response:
+        raise PipelineError('Failed to generate flowchart description from xAI API', 500)
+    
+    log.info("Stage done", extra={'stage': 'description', 'duration_s': round(time.perf_counter() - stage_started, 3)})
+    emit_event(job, 'stage_done', stage='description', text=flowchart_response)
+    
+    if job:
+        job.check_deadline()
+    
+    # Step 3: Get mermaid code using xAI with special Mermaid-focused prompt
+    stage_started = time.perf_counter()
+    emit_event(job, 'stage_start', stage='mermaid')
+    mermaid_response = call_xai_api(build_mermaid_prompt(flowchart_response), for_mermaid=True,
+                                    on_token=token_callback(job, 'mermaid'), stage='mermaid')
+    if not mermaid_response:
+        raise PipelineError('Failed to generate mermaid code from xAI API', 500)
+    
+    mermaid_response = finalize_mermaid(mermaid_response)
+    
+    log.info("Stage done", extra={'stage': 'mermaid', 'duration_s': round(time.perf_counter() - stage_started, 3)})
+    emit_event(job, 'stage_done', stage='mermaid', text=mermaid_response)
+    
+    return steps_response, flowchart_response, mermaid_response
+
+def build_description_prompt(steps):
+    """Step 2 prompt: turn the extracted steps into a flowchart description"""
+    return f"""Create a flowchart description that represents this laboratory procedure clearly and logically.
 
 Focus on:
 - Clear visual flow from start to finish
@@ -422,19 +1097,13 @@ Focus on:
 - Include observations only if mentioned in the original content
 
 Steps from storyboard:
-{steps_response}
+{steps}
 
 Create a flowchart description that captures the logical flow and any decision points in the procedure."""
-        
-        flowchart_response = call_xai_api(step2_prompt)
-        if not flowchart_response:
-            return jsonify({'error': 'Failed to generate flowchart description from xAI API'}), 500
-        
-        print("✅ Step 2 completed: Generated flowchart description")
-        
-        # Step 3: Get mermaid code using xAI with special Mermaid-focused prompt
-        print("🤖 Step 3: Generating Mermaid code...")
-        step3_prompt = f"""Convert this flowchart description to clean Mermaid syntax.
+
+def build_mermaid_prompt(description):
+    """Step 3 prompt: convert the flowchart description to Mermaid"""
+    return f"""Convert this flowchart description to clean Mermaid syntax.
 
 Requirements:
 - Start with 'flowchart TD'
@@ -445,43 +1114,518 @@ Requirements:
 - Follow the flowchart description provided
 
 Flowchart description to convert:
-{flowchart_response}
+{description}
 
 Generate clean Mermaid code that represents this flowchart."""
-        
-        mermaid_response = call_xai_api(step3_prompt, for_mermaid=True)
-        if not mermaid_response:
-            return jsonify({'error': 'Failed to generate mermaid code from xAI API'}), 500
-        
-        # Clean the response to extract only the Mermaid code
-        mermaid_response = extract_mermaid_code(mermaid_response)
-        
-        # Validate and fix Mermaid syntax
-        mermaid_response = validate_and_fix_mermaid(mermaid_response)
-        
-        print("✅ Step 3 completed: Generated Mermaid code")
-        
-        # Generate URLs for visualization
-        print("🔗 Generating visualization URLs...")
-        drawio_url = generate_drawio_url(mermaid_response)
-        mermaid_live_url = generate_mermaid_live_url(mermaid_response)
-        
-        print("🎉 All steps completed successfully!")
-        
+
+def finalize_mermaid(response_text, repair=True):
+    """Extract the Mermaid code from an LLM response and fix common syntax errors"""
+    # Clean the response to extract only the Mermaid code
+    mermaid_code = extract_mermaid_code(response_text)
+    
+    # Ask for fixes of the statements that do not parse, instead of regenerating
+    if repair:
+        mermaid_code = repair_mermaid(mermaid_code)
+    
+    # Validate and fix Mermaid syntax
+    with pipeline_stage_seconds.time(stage='mermaid_cleanup'):
+        return validate_and_fix_mermaid(mermaid_code)
+
+MERMAID_REPAIR_ATTEMPTS = int(os.getenv('MERMAID_REPAIR_ATTEMPTS', 2))  # 0 disables LLM repair
+MERMAID_REPAIR_MAX_LINES = int(os.getenv('MERMAID_REPAIR_MAX_LINES', 30))  # Larger breakages are just dropped
+MERMAID_REPAIR_MAX_TOKENS = 800
+MERMAID_REPAIR_TEMPERATURE = 0.2
+
+MERMAID_REPAIR_SYSTEM_PROMPT = """You fix syntax errors in individual Mermaid flowchart statements. You answer only with the corrected statements, one per line, each prefixed with its line number and a colon."""
+
+_REPAIRED_LINE = re.compile(r'^\s*(\d+)\s*[:.)]\s?(.*)$')
+
+mermaid_repair_stats = {'charts': 0, 'calls': 0, 'lines_fixed': 0, 'lines_dropped': 0}
+_mermaid_repair_lock = threading.Lock()
+
+def build_repair_prompt(lines, errors):
+    """Repair prompt with only the offending lines, their errors and the known node IDs"""
+    chart = parse_mermaid('\n'.join(lines), [])
+    node_ids = ', '.join(list(chart.nodes)[:80])
+    broken = '\n'.join(f'{error.line_number}: {error.line}' for error in errors)
+    problems = '\n'.join(f'{error.line_number}: {error.message}' for error in errors)
+    return f"""These statements from a Mermaid flowchart (flowchart {chart.direction}) have syntax errors.
+
+Broken statements:
+{broken}
+
+Parser errors:
+{problems}
+
+Existing node IDs: {node_ids or 'none'}
+
+Rewrite each broken statement as valid Mermaid flowchart syntax, keeping its meaning and reusing the existing node IDs. Quote labels that contain special characters, e.g. A["Mix A/B: 5 mL"]. Answer with one line per broken statement in the form "<line number>: <fixed statement>"; leave the statement empty to delete a line that is not part of the flowchart."""
+
+def apply_mermaid_repairs(lines, errors, response_text):
+    """Replace the broken lines with the repaired ones from response_text; returns the number replaced"""
+    broken = {error.line_number for error in errors if error.line_number}
+    replaced = 0
+    for line in (response_text or '').replace('```mermaid', '').replace('```', '').split('\n'):
+        match = _REPAIRED_LINE.match(line)
+        if match and int(match.group(1)) in broken:
+            lines[int(match.group(1)) - 1] = match.group(2).strip()
+            broken.discard(int(match.group(1)))
+            replaced += 1
+    return replaced
+
+def repairable_mermaid_errors(mermaid_code):
+    """(lines, errors) if the code has a small number of fixable errors, else (lines, [])"""
+    lines = clean_mermaid_lines(mermaid_code)
+    errors = [error for error in validate_mermaid(mermaid_code) if error.line_number]
+    if len(errors) > MERMAID_REPAIR_MAX_LINES:
+        log.warning("Too many broken Mermaid statements to repair, dropping them", extra={'errors': len(errors)})
+        return lines, []
+    return lines, errors
+
+def record_mermaid_repair(initial_errors, remaining_errors, calls):
+    with _mermaid_repair_lock:
+        mermaid_repair_stats['charts'] += 1
+        mermaid_repair_stats['calls'] += calls
+        mermaid_repair_stats['lines_fixed'] += initial_errors - remaining_errors
+        mermaid_repair_stats['lines_dropped'] += remaining_errors
+
+def mermaid_repair_snapshot():
+    with _mermaid_repair_lock:
+        return dict(mermaid_repair_stats)
+
+def repair_mermaid(mermaid_code, max_attempts=None):
+    """Fix statements the local validator rejects with small LLM calls on just those lines
+
+    Each attempt sends only the still-broken lines; lines that cannot be
+    repaired within max_attempts (MERMAID_REPAIR_ATTEMPTS) are left for
+    validate_and_fix_mermaid to drop.
+    """
+    max_attempts = MERMAID_REPAIR_ATTEMPTS if max_attempts is None else max_attempts
+    lines, errors = repairable_mermaid_errors(mermaid_code)
+    if not errors or max_attempts <= 0:
+        return mermaid_code
+    
+    initial = len(errors)
+    calls = 0
+    for attempt in range(max_attempts):
+        response = call_xai_api(build_repair_prompt(lines, errors), system_prompt=MERMAID_REPAIR_SYSTEM_PROMPT,
+                                temperature=MERMAID_REPAIR_TEMPERATURE, max_tokens=MERMAID_REPAIR_MAX_TOKENS,
+                                stage='repair')
+        calls += 1
+        if not response or not apply_mermaid_repairs(lines, errors, response):
+            break
+        errors = validate_mermaid('\n'.join(lines))
+        if not errors:
+            break
+    
+    record_mermaid_repair(initial, len(errors), calls)
+    log.info("Mermaid repair done", extra={'fixed': initial - len(errors), 'broken': initial, 'calls': calls})
+    return '\n'.join(lines)
+
+STRUCTURED_SYSTEM_PROMPT = """You are a laboratory procedure analyst and flowchart designer. You always answer with a single JSON object and nothing else."""
+STRUCTURED_TEMPERATURE = 0.3  # Low for well-formed JSON
+
+def parse_json_object(response_text):
+    """Parse the JSON object in an LLM answer, or return None"""
+    if not response_text:
+        return None
+    text = response_text.strip()
+    # Tolerate code fences or stray text around the JSON object
+    first, last = text.find('{'), text.rfind('}')
+    if first == -1 or last <= first:
+        return None
+    try:
+        data = json.loads(text[first:last + 1])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def parse_structured_response(response_text):
+    """Parse the JSON object returned by the structured prompt, or return None"""
+    data = parse_json_object(response_text)
+    if not data or not isinstance(data.get('graph'), dict):
+        return None
+    return data
+
+def run_structured_pipeline(pdf_text, job=None):
+    """Single LLM call returning steps, description and a node/edge graph as JSON
+
+    The Mermaid code is derived locally from the graph. Returns None when the
+    model's answer cannot be used so the caller can fall back to the chain.
+    """
+    emit_event(job, 'stage_start', stage='structured')
+    response = call_xai_api(
+        build_structured_prompt(pdf_text),
+        system_prompt=STRUCTURED_SYSTEM_PROMPT,
+        temperature=STRUCTURED_TEMPERATURE,
+        on_token=token_callback(job, 'structured'),
+        stage='structured'
+    )
+    chart = chart_from_structured_response(response)
+    if chart is None:
+        return None
+    
+    steps, description, mermaid_code = chart
+    emit_event(job, 'stage_done', stage='steps', text=steps)
+    emit_event(job, 'stage_done', stage='description', text=description)
+    emit_event(job, 'stage_done', stage='mermaid', text=mermaid_code)
+    emit_event(job, 'stage_done', stage='structured')
+    return chart
+
+def build_structured_prompt(content):
+    """Single-call prompt asking for steps, description and a node/edge graph as JSON"""
+    return f"""Analyze this laboratory storyboard content and return a JSON object describing its procedure as a flowchart.
+
+Requirements:
+- Use only information from the storyboard content provided
+- Start with safety procedures if mentioned
+- Include all steps in logical order: Safety → Setup → Main Procedure → Cleanup
+- Preserve any decision points or alternative methods mentioned
+- Include observations only if specifically mentioned in the storyboard
+
+Return exactly this JSON structure:
+{{
+  "steps": ["First step", "Second step"],
+  "description": "A short description of the flowchart and its decision points",
+  "graph": {{
+    "nodes": [{{"id": "A", "label": "Start", "shape": "stadium"}}, {{"id": "B", "label": "Is it safe?", "shape": "diamond"}}],
+    "edges": [{{"from": "A", "to": "B", "label": ""}}]
+  }}
+}}
+
+Use "rect" for actions, "diamond" for decisions and "stadium" for start/end nodes. Label decision edges (for example "Yes"/"No").
+
+Storyboard content:
+{content}"""
+
+def chart_from_structured_response(response):
+    """Turn a structured JSON answer into (steps, description, mermaid_code), or None"""
+    data = parse_structured_response(response)
+    if not data:
+        return None
+    
+    chart = Flowchart.from_dict(data['graph'])
+    if not chart.edges:
+        return None
+    
+    steps = data.get('steps') or []
+    if isinstance(steps, list):
+        steps = '\n'.join(f"{i}. {step}" for i, step in enumerate(steps, 1))
+    description = str(data.get('description') or '')
+    mermaid_code = chart.to_mermaid()
+    
+    log.info("Structured generation done", extra={'nodes': len(chart.nodes), 'edges': len(chart.edges)})
+    return steps, description, mermaid_code
+
+def run_flowchart_job(job, pdf, mode=None, reuse_similar=False, previous=None):
+    """Job queue entry point for generate_flowchart; the job owns (and removes) a SpooledUpload"""
+    logs.bind(job_id=job.id)  # Jobs run in their own copy of the submitting request's context
+    try:
+        # An identical job may have finished between the upload's cache check and this one starting
+        cached = result_cache.get(result_cache_key(pdf, mode if mode in PIPELINE_MODES else PIPELINE_MODE))
+        if cached:
+            log.info("Result cache hit", extra={'job_id': job.id})
+            return cached
+        return generate_flowchart(pdf, job=job, mode=mode, reuse_similar=reuse_similar, previous=previous)
+    finally:
+        if isinstance(pdf, SpooledUpload):
+            pdf.discard()
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    if not file.filename.lower().endswith('.pdf'):
+        return jsonify({'error': 'Please upload a PDF file'}), 400
+    
+    mode = request.form.get('mode') or request.args.get('mode') or PIPELINE_MODE
+    if mode not in PIPELINE_MODES:
+        return jsonify({'error': f"Unknown pipeline mode '{mode}'"}), 400
+    # reuse=1: answer with a near-identical PDF's cached result instead of converting this one
+    reuse = (request.form.get('reuse') or request.args.get('reuse') or '').lower() in ('1', 'true', 'yes')
+    # previous=<result_key>: this PDF revises that result's document; patch its flowchart
+    previous = request.form.get('previous') or request.args.get('previous') or None
+    if previous and result_cache.get('pages:' + previous) is None:
+        return jsonify({'error': 'Unknown or expired previous result'}), 400
+    
+    # Already spooled and hashed while the request streamed in; the job takes
+    # it over, as the request's files are closed when the request ends
+    upload = spooled_upload(file)
+    
+    # Identical PDFs are served straight from the result cache
+    key = result_cache_key(upload, mode)
+    cached = result_cache.get(key)
+    if cached:
+        log.info("Result cache hit", extra={'upload': file.filename})
         return jsonify({
             'success': True,
-            'steps': steps_response,
-            'flowchart_description': flowchart_response,
-            'mermaid_code': mermaid_response,
-            'drawio_url': drawio_url,
-            'mermaid_live_url': mermaid_live_url
+            'job_id': None,
+            'status': 'done',
+            'cached': True,
+            'result_key': key,
+            'result': cached
         })
-        
+    
+    # Single flight: while the same PDF is being converted (a whole class
+    # uploading one handout), later uploads follow that job instead of
+    # starting another extraction and LLM pipeline. Runs that may answer
+    # with a near-duplicate's result only join each other, and revisions
+    # only join revisions of the same previous result
+    flight_key = key + ':reuse' if reuse else key
+    if previous:
+        flight_key += ':previous:' + previous
+    try:
+        # Also joins a batch job for the same PDF
+        job, created = job_queue.submit_once(flight_key, run_flowchart_job, upload.detach(), mode=mode,
+                                             reuse_similar=reuse, previous=previous)
+    except QueueFullError as e:
+        upload.discard()
+        log.warning("Upload rejected: %s", e)
+        return jsonify({'error': 'Server is busy, please try again shortly'}), 503
+    if not created:
+        upload.discard()
+        uploads_coalesced_total.inc(endpoint='upload')
+        log.info("Joined running job", extra={'job_id': job.id, 'upload': file.filename})
+    else:
+        log.info("Queued job", extra={'job_id': job.id, 'upload': file.filename, 'size': upload.size,
+                                      'spooled': upload.on_disk})
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'coalesced': not created,
+        'result_key': key,
+        'status_url': f'/jobs/{job.id}',
+        'events_url': f'/jobs/{job.id}/events'
+    }), 202
+
+class BatchError(Exception):
+    """Raised when a batch upload cannot be accepted"""
+
+def read_batch_files(files):
+    """Return [(filename, SpooledUpload)] for uploaded PDFs and the PDFs inside uploaded zips
+
+    The caller owns the returned uploads and discards them when done.
+    """
+    documents = []
+    unzipped = 0
+    try:
+        for file in files:
+            name = file.filename or ''
+            if name.lower().endswith('.pdf'):
+                documents.append((name, spooled_upload(file).detach()))
+            elif name.lower().endswith('.zip'):
+                try:
+                    archive = zipfile.ZipFile(spooled_upload(file))
+                except zipfile.BadZipFile:
+                    raise BatchError(f'{name} is not a valid zip file')
+                with archive:
+                    for info in archive.infolist():
+                        member = info.filename
+                        if info.is_dir() or not member.lower().endswith('.pdf') or member.startswith('__MACOSX/'):
+                            continue
+                        unzipped += info.file_size
+                        if unzipped > BATCH_MAX_UNZIPPED_MB * 1024 * 1024:
+                            raise BatchError(f'Zip contents exceed {BATCH_MAX_UNZIPPED_MB}MB')
+                        # Unpacked straight into a spooled file; the cap also
+                        # catches members larger than their header claims
+                        options = dict(upload_options(), max_size=info.file_size)
+                        with archive.open(info) as stream:
+                            documents.append((f'{name}/{member}', spool(stream, member, **options)))
+            elif name:
+                raise BatchError(f'{name} is not a PDF or zip file')
+            if len(documents) > BATCH_MAX_FILES:
+                raise BatchError(f'A batch can contain at most {BATCH_MAX_FILES} PDFs')
+    except (BatchError, RequestEntityTooLarge) as e:
+        for _, upload in documents:
+            upload.discard()
+        if isinstance(e, RequestEntityTooLarge):
+            raise BatchError('A zip member is larger than its header says') from e
+        raise
+    return documents
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Convert many PDFs (or zips of PDFs) at once
+
+    Identical files are converted once, cached results are returned directly
+    and the rest run concurrently on the batch worker pool. Responds with 202
+    and a status URL, or with the finished batch when wait=true.
+    """
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No files uploaded'}), 400
+    
+    mode = request.form.get('mode') or request.args.get('mode') or PIPELINE_MODE
+    if mode not in PIPELINE_MODES:
+        return jsonify({'error': f"Unknown pipeline mode '{mode}'"}), 400
+    
+    try:
+        documents = read_batch_files(files)
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    if not documents:
+        return jsonify({'error': 'No PDF files found in the upload'}), 400
+    
+    items = []
+    first_seen = {}
+    for filename, upload in documents:
+        key = result_cache_key(upload, mode)
+        if key in first_seen:
+            upload.discard()
+            items.append({'filename': filename, 'duplicate_of': first_seen[key]})
+            continue
+        first_seen[key] = len(items)
+        cached = result_cache.get(key)
+        if cached:
+            upload.discard()
+            items.append({'filename': filename, 'result': cached, 'cached': True})
+            continue
+        # Files already being converted (by /upload or another batch) join that job
+        try:
+            # A new job owns the upload from here on
+            job, created = batch_queue.submit_once(key, run_flowchart_job, upload, mode=mode)
+        except QueueFullError:
+            upload.discard()
+            items.append({'filename': filename, 'error': 'Server is busy, please try again shortly'})
+            continue
+        if not created:
+            upload.discard()
+            uploads_coalesced_total.inc(endpoint='batch')
+        items.append({'filename': filename, 'job': job, 'coalesced': not created})
+    
+    batch = batch_queue.add_batch(Batch(items))
+    log.info("Queued batch", extra={'batch_id': batch.id, 'files': len(items), 'queued': len(batch.jobs),
+                                    'duplicates': len(items) - len(first_seen)})
+    
+    if request.args.get('wait', '').lower() in ('1', 'true', 'yes'):
+        batch.wait(JOB_TIMEOUT)
+        return jsonify(dict(batch_queue.get_batch(batch.id).to_dict(), success=True))
+    
+    data = batch.to_dict()
+    data.update(success=True, status_url=f'/batches/{batch.id}')
+    return jsonify(data), 202
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    """Per-file status and results of a batch upload, with aggregate timing"""
+    batch = batch_queue.get_batch(batch_id)
+    if not batch:
+        return jsonify({'error': 'Unknown or expired batch ID'}), 404
+    return jsonify(dict(batch.to_dict(), success=True))
+
+def find_job(job_id):
+    """Look a job up in the single-upload queue, then the batch queue"""
+    return job_queue.get(job_id) or batch_queue.get(job_id)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Poll the status and, once finished, the result of a queued upload"""
+    job = find_job(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown or expired job ID'}), 404
+    
+    data = job.to_dict()
+    data['success'] = job.status not in ('failed', 'timeout')
+    return jsonify(data)
+
+def resolve_mermaid(key):
+    """Mermaid code of a finished job or a stored Mermaid hash, else an error response"""
+    job = find_job(key)
+    if job:
+        if job.status != 'done':
+            return None, (jsonify({'error': f'Job is {job.status}'}), 409)
+        return job.result['mermaid_code'], None
+    mermaid_code = load_mermaid(key)
+    if mermaid_code is None:
+        return None, (jsonify({'error': 'Unknown job ID or Mermaid hash'}), 404)
+    return mermaid_code, None
+
+@app.route('/render/<key>.<fmt>')
+def render_flowchart(key, fmt):
+    """Flowchart image of a finished job or a stored Mermaid hash, laid out locally"""
+    if fmt not in RENDER_FORMATS:
+        return jsonify({'error': f"Unknown format '{fmt}', use svg or png"}), 404
+    
+    mermaid_code, error_response = resolve_mermaid(key)
+    if error_response:
+        return error_response
+    
+    render_key = content_hash(RENDER_VERSION, fmt, mermaid_code)
+    if request.if_none_match.contains(render_key):
+        return Response(status=304)
+    
+    output = render_cache.get(render_key)
+    if output is None:
+        try:
+            chart = parse_mermaid(mermaid_code, errors=[])
+            output = render_svg(chart) if fmt == 'svg' else render_png(chart)
+        except RenderError as e:
+            return jsonify({'error': str(e)}), 501
+        except Exception as e:
+            log.exception("Rendering failed: %s", e)
+            return jsonify({'error': f'Rendering failed: {e}'}), 500
+        render_cache.put(render_key, output)
+    
+    response = Response(output, mimetype=RENDER_FORMATS[fmt])
+    response.set_etag(render_key)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@app.route('/drawio/<key>.drawio')
+def drawio_download(key):
+    """Flowchart of a finished job or a stored Mermaid hash as a draw.io file"""
+    mermaid_code, error_response = resolve_mermaid(key)
+    if error_response:
+        return error_response
+    try:
+        xml = generate_drawio_xml(mermaid_code)
     except Exception as e:
-        print(f"❌ Error processing file: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'Error processing file: {str(e)}'}), 500
+        log.exception("draw.io export failed: %s", e)
+        return jsonify({'error': f'draw.io export failed: {e}'}), 500
+    return Response(
+        xml,
+        mimetype='application/xml',
+        headers={'Content-Disposition': f'attachment; filename="flowchart-{key[:12]}.drawio"'}
+    )
+
+@app.route('/share/<mermaid_hash>')
+def share_flowchart(mermaid_hash):
+    """Share page for charts whose Mermaid Live URL is too long to hand out directly"""
+    mermaid_code = load_mermaid(mermaid_hash)
+    if mermaid_code is None:
+        return jsonify({'error': 'Unknown or expired Mermaid hash'}), 404
+    return render_template(
+        'share.html',
+        mermaid_code=mermaid_code,
+        svg_url=f'/render/{mermaid_hash}.svg',
+        mermaid_live_url=generate_mermaid_live_url(mermaid_code)
+    )
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events stream of a job's progress and streamed LLM tokens"""
+    job = find_job(job_id)
+    if not job:
+        return jsonify({'error': 'Unknown or expired job ID'}), 404
+    
+    def generate():
+        for event, data in job.iter_events():
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 # Vercel serverless function handler
 def handler(event, context):
@@ -491,7 +1635,5 @@ if __name__ == '__main__':
     # For local development only
     port = int(os.environ.get('PORT', 8000))
     debug = os.environ.get('FLASK_ENV') != 'production'
-    print(f"🚀 Starting Flask app on port {port}")
-    print(f"🔧 Debug mode: {debug}")
-    print(f"🔑 xAI API Key configured: {'✅ YES' if XAI_API_KEY else '❌ NO'}")
+    log.info("Starting Flask app", extra={'port': port, 'debug': debug, 'xai_key_configured': bool(XAI_API_KEY)})
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
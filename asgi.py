@@ -0,0 +1,448 @@
+"""ASGI entry point with an asyncio-native upload pipeline.
+
+POST /async/upload runs the same PDF -> steps -> description -> Mermaid
+pipeline as /upload, but awaits the LLM through AsyncOpenAI instead of holding
+a worker thread per request, so a single process can keep hundreds of uploads
+waiting on xAI. Every other route (the page, /upload, /jobs, /stats, ...) is
+the unchanged Flask app mounted as WSGI.
+
+Run with:  uvicorn asgi:app
+"""
+import asyncio
+import logging
+import time
+
+from a2wsgi import WSGIMiddleware
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.multipart import parse_options_header
+
+import app as flask_app
+import logs
+from app import (
+    CHUNK_CONCURRENCY, CHUNK_SIZE, MAX_DOCUMENT_CHARS, MERGED_STEPS_MAX_CHARS, PIPELINE_MODE,
+    PIPELINE_MODES, STRUCTURED_SYSTEM_PROMPT, STRUCTURED_TEMPERATURE, XAI_API_KEY, XAI_BASE_URL, XAI_MAX_BACKOFF,
+    MERMAID_REPAIR_ATTEMPTS, MERMAID_REPAIR_MAX_TOKENS, MERMAID_REPAIR_SYSTEM_PROMPT,
+    MERMAID_REPAIR_TEMPERATURE, XAI_MODEL,
+    PipelineError, apply_mermaid_repairs, assemble_result, build_consolidate_prompt,
+    build_description_prompt, build_llm_request, build_mermaid_prompt, build_repair_prompt, build_revision_prompt,
+    build_steps_prompt, build_structured_prompt, chart_from_structured_response, content_hash,
+    extract_mermaid_code, extract_pages_from_pdf, finalize_mermaid, find_near_duplicate, llm_limiter, llm_memo,
+    llm_requests_total, offer_near_duplicate, plan_revision, record_llm_call, record_mermaid_repair,
+    repairable_mermaid_errors, request_id_for, result_cache, result_cache_key, revised_chart, run_revision,
+    serve_near_duplicate, text_fingerprint, upload_options, uploads_coalesced_total, validate_mermaid,
+)
+from chunking import map_chunks_async, reduce_step_lists_async, split_into_chunks
+from ratelimit import AsyncRateLimiter, backoff_delay, error_status, is_retryable
+from uploads import SpooledUpload
+from werkzeug.exceptions import RequestEntityTooLarge
+
+log = logging.getLogger('storyboard.asgi')
+
+# Combined size of an upload's text fields (mode, reuse, previous, ...); the file has its own cap
+FORM_FIELDS_MAX_BYTES = 64 * 1024
+
+# Initialize async xAI client
+try:
+    if not XAI_API_KEY:
+        raise ValueError("XAI_API_KEY environment variable is required")
+    async_client = AsyncOpenAI(
+        api_key=XAI_API_KEY,
+        base_url=XAI_BASE_URL,
+        max_retries=0  # Retries are handled by call_xai_api_async behind the rate limiter
+    )
+    log.info("Async xAI client initialized", extra={'base_url': XAI_BASE_URL})
+except Exception as e:
+    log.error("Failed to initialize async xAI client: %s", e)
+    async_client = None
+
+# Shares the request/token budgets of the sync limiter
+async_llm_limiter = AsyncRateLimiter(llm_limiter)
+
+async def call_xai_api_async(prompt, max_retries=3, for_mermaid=False, use_memo=True,
+                             system_prompt=None, temperature=None, max_tokens=None, stage='other'):
+    """Async call_xai_api: same memo, limits and retry policy, without blocking a thread"""
+    if not async_client:
+        log.error("Async xAI client not initialized")
+        return None
+
+    system_content, temperature, max_tokens = build_llm_request(for_mermaid, system_prompt, temperature, max_tokens)
+
+    memo_key = content_hash(system_content, prompt, XAI_MODEL, str(temperature), str(max_tokens))
+    if use_memo:
+        memoized = llm_memo.get(memo_key)
+        if memoized is not None:
+            log.debug("LLM memo hit", extra={'stage': stage})
+            llm_requests_total.inc(stage=stage, outcome='memo')
+            return memoized
+
+    prompt_tokens = (len(system_content) + len(prompt)) // 4
+    estimated_tokens = prompt_tokens + min(max_tokens, 1000)
+
+    for attempt in range(max_retries):
+        try:
+            async with async_llm_limiter.slot(estimated_tokens) as waited:
+                if waited > 1:
+                    log.info("Waited for an xAI rate limit slot", extra={'stage': stage, 'wait_s': round(waited, 3)})
+                log.debug("Calling xAI", extra={'stage': stage, 'attempt': attempt + 1, 'prompt_chars': len(prompt)})
+                call_started = time.perf_counter()
+                response = await async_client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": system_content},
+                        {"role": "user", "content": prompt}
+                    ],
+                    model=XAI_MODEL,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                content = response.choices[0].message.content
+                usage = getattr(response, 'usage', None)
+                call_seconds = time.perf_counter() - call_started
+                used_tokens = record_llm_call(stage, call_seconds, usage, prompt_tokens, content)
+
+            async_llm_limiter.record_usage(used_tokens, estimated_tokens)
+            log.info("xAI call done", extra={'stage': stage, 'attempt': attempt + 1,
+                                             'duration_s': round(call_seconds, 3), 'tokens': used_tokens})
+            if content:
+                llm_memo.put(memo_key, content)
+            return content
+
+        except Exception as e:
+            log.warning("xAI call failed: %s", e, extra={'stage': stage, 'attempt': attempt + 1,
+                                                         'status': error_status(e)})
+            llm_requests_total.inc(stage=stage, outcome='error')
+            if not is_retryable(e):
+                log.error("xAI error is not retryable", extra={'stage': stage})
+                return None
+            if attempt < max_retries - 1:
+                throttled = error_status(e) == 429
+                async_llm_limiter.record_retry(throttled=throttled)
+                delay = backoff_delay(attempt, e, max_delay=XAI_MAX_BACKOFF)
+                log.info("Retrying xAI call", extra={'stage': stage, 'delay_s': round(delay, 3), 'throttled': throttled})
+                await asyncio.sleep(delay)
+                continue
+            else:
+                log.error("All xAI retry attempts failed", extra={'stage': stage})
+                return None
+
+    return None
+
+async def extract_steps_chunked_async(pages):
+    """Async extract_steps_chunked: chunk calls run concurrently on the event loop"""
+    chunks = split_into_chunks(pages, CHUNK_SIZE)
+    stage_started = time.perf_counter()
+
+    async def extract_chunk(chunk):
+        return await call_xai_api_async(build_steps_prompt(chunk), stage='steps')
+
+    async def consolidate(text):
+        return await call_xai_api_async(build_consolidate_prompt(text), stage='consolidate')
+
+    partials = await map_chunks_async(extract_chunk, chunks, CHUNK_CONCURRENCY)
+    if not any(partials):
+        raise PipelineError('Failed to generate steps from xAI API. Please check your API key.', 500)
+
+    steps_response = await reduce_step_lists_async(partials, consolidate, MERGED_STEPS_MAX_CHARS, CHUNK_CONCURRENCY)
+    log.info("Stage done", extra={'stage': 'steps', 'duration_s': round(time.perf_counter() - stage_started, 3),
+                                  'chunks': len(chunks), 'chunks_ok': sum(1 for p in partials if p)})
+    return steps_response
+
+async def run_chain_pipeline_async(pdf_text, steps_response=None):
+    """Async run_chain_pipeline"""
+    if steps_response is None:
+        if len(pdf_text) > CHUNK_SIZE:
+            pdf_text = pdf_text[:CHUNK_SIZE] + "..."
+        steps_response = await call_xai_api_async(build_steps_prompt(pdf_text), stage='steps')
+        if not steps_response:
+            raise PipelineError('Failed to generate steps from xAI API. Please check your API key.', 500)
+
+    flowchart_response = await call_xai_api_async(build_description_prompt(steps_response), stage='description')
+    if not flowchart_response:
+        raise PipelineError('Failed to generate flowchart description from xAI API', 500)
+
+    mermaid_response = await call_xai_api_async(build_mermaid_prompt(flowchart_response), for_mermaid=True,
+                                                stage='mermaid')
+    if not mermaid_response:
+        raise PipelineError('Failed to generate mermaid code from xAI API', 500)
+
+    mermaid_code = await repair_mermaid_async(extract_mermaid_code(mermaid_response))
+    return steps_response, flowchart_response, finalize_mermaid(mermaid_code, repair=False)
+
+async def repair_mermaid_async(mermaid_code):
+    """Async repair_mermaid: LLM fixes for just the statements the local validator rejects"""
+    lines, errors = repairable_mermaid_errors(mermaid_code)
+    if not errors or MERMAID_REPAIR_ATTEMPTS <= 0:
+        return mermaid_code
+
+    initial = len(errors)
+    calls = 0
+    for attempt in range(MERMAID_REPAIR_ATTEMPTS):
+        response = await call_xai_api_async(build_repair_prompt(lines, errors),
+                                            system_prompt=MERMAID_REPAIR_SYSTEM_PROMPT,
+                                            temperature=MERMAID_REPAIR_TEMPERATURE,
+                                            max_tokens=MERMAID_REPAIR_MAX_TOKENS,
+                                            stage='repair')
+        calls += 1
+        if not response or not apply_mermaid_repairs(lines, errors, response):
+            break
+        errors = validate_mermaid('\n'.join(lines))
+        if not errors:
+            break
+
+    record_mermaid_repair(initial, len(errors), calls)
+    log.info("Mermaid repair done", extra={'fixed': initial - len(errors), 'broken': initial, 'calls': calls})
+    return '\n'.join(lines)
+
+async def run_structured_pipeline_async(pdf_text):
+    """Async run_structured_pipeline; returns None when the answer is unusable"""
+    response = await call_xai_api_async(
+        build_structured_prompt(pdf_text),
+        system_prompt=STRUCTURED_SYSTEM_PROMPT,
+        temperature=STRUCTURED_TEMPERATURE,
+        stage='structured'
+    )
+    return chart_from_structured_response(response)
+
+async def run_revision_async(revision):
+    """Async run_revision"""
+    if not revision['changes']:
+        return run_revision(revision)  # No page text changed: no LLM call
+    response = await call_xai_api_async(
+        build_revision_prompt(revision['previous'], revision['changes']),
+        system_prompt=STRUCTURED_SYSTEM_PROMPT,
+        temperature=STRUCTURED_TEMPERATURE,
+        stage='revision'
+    )
+    return revised_chart(revision, response)
+
+async def generate_flowchart_async(pdf, mode=None, reuse_similar=False, previous=None):
+    """Async generate_flowchart; PDF extraction and the cache lookups run in worker threads"""
+    mode = mode if mode in PIPELINE_MODES else PIPELINE_MODE
+    started = time.perf_counter()
+
+    pages = await asyncio.to_thread(extract_pages_from_pdf, pdf, MAX_DOCUMENT_CHARS)
+    pdf_text = ''.join(page + "\n" for page in pages) if pages else None
+    if not pdf_text or not pdf_text.strip():
+        raise PipelineError('Could not extract text from PDF', 400)
+    extracted = time.perf_counter()
+    log.info("Stage done", extra={'stage': 'extract', 'duration_s': round(extracted - started, 3),
+                                  'pages': len(pages), 'characters': len(pdf_text)})
+
+    fingerprint = await asyncio.to_thread(text_fingerprint, pdf_text)
+    similar = await asyncio.to_thread(find_near_duplicate, fingerprint, mode)
+    if similar and reuse_similar:
+        return serve_near_duplicate(similar, mode, started, extracted)
+    if previous:
+        revision = await asyncio.to_thread(plan_revision, previous, pages, fingerprint)
+        chart = revision and await run_revision_async(revision)
+        if chart:
+            return offer_near_duplicate(await asyncio.to_thread(
+                assemble_result, pdf, mode, chart, started, extracted, fingerprint, pages, revision['info']), similar)
+
+    steps_response = None
+    if len(pdf_text) > CHUNK_SIZE:
+        steps_response = await extract_steps_chunked_async(pages)
+
+    chart = None
+    pipeline_mode = mode
+    if mode == 'structured':
+        chart = await run_structured_pipeline_async(steps_response or pdf_text)
+        if chart is None:
+            log.warning("Structured generation failed, falling back to the three-step chain")
+            pipeline_mode = 'chain'
+    if chart is None:
+        chart = await run_chain_pipeline_async(pdf_text, steps_response=steps_response)
+    # URL generation and the cache write are quick, local and shared with the sync path
+    return offer_near_duplicate(await asyncio.to_thread(
+        assemble_result, pdf, mode, chart, started, extracted, fingerprint, pages, pipeline_mode=pipeline_mode), similar)
+
+async def async_upload(request):
+    """Convert an uploaded PDF and answer with the finished result (no job polling)"""
+    request_id = request_id_for(request.headers.get('x-request-id'))
+    with logs.bound(request_id=request_id):
+        response = await convert_upload(request)
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+class UploadReader:
+    """python-multipart callbacks for an upload form, fed the request body as it streams in
+
+    The 'file' part is written straight into a SpooledUpload, which hashes it
+    and raises RequestEntityTooLarge once it passes the size cap, so an
+    oversized upload is rejected without reading the rest of the body. Text
+    fields are kept in fields, other file parts are skipped.
+    """
+
+    def __init__(self, boundary):
+        self.fields = {}
+        self.upload = None
+        self._header_name = b''
+        self._header_value = b''
+        self._disposition = b''
+        self._field = None
+        self._field_bytes = 0
+        self._target = None
+        self.parser = multipart.MultipartParser(boundary, {
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+        })
+
+    def _on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        if self._header_name.lower() == b'content-disposition':
+            self._disposition = self._header_value
+        self._header_name = self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        self._disposition = b''
+        name = options.get(b'name', b'').decode('utf-8', 'replace')
+        filename = options.get(b'filename')
+        self._field = None
+        if filename is None:
+            self._field = name
+            self._target = bytearray()
+        elif name == 'file' and self.upload is None:
+            self.upload = self._target = SpooledUpload(filename=filename.decode('utf-8', 'replace'),
+                                                       **upload_options())
+        else:
+            self._target = None
+
+    def _on_part_data(self, data, start, end):
+        if self._target is None:
+            return
+        if self._field is None:
+            self._target.write(data[start:end])
+            return
+        self._field_bytes += end - start
+        if self._field_bytes > FORM_FIELDS_MAX_BYTES:
+            raise RequestEntityTooLarge('Form fields are too large')
+        self._target.extend(data[start:end])
+
+    def _on_part_end(self):
+        if self._field is not None:
+            self.fields[self._field] = self._target.decode('utf-8', 'replace')
+        self._field = self._target = None
+
+    def write(self, chunk):
+        self.parser.write(chunk)
+
+async def read_upload(request):
+    """(form fields, SpooledUpload of the 'file' part or None), parsed from the streamed request body"""
+    content_type, options = parse_options_header(request.headers.get('content-type'))
+    if content_type != b'multipart/form-data' or not options.get(b'boundary'):
+        return {}, None
+    reader = UploadReader(options[b'boundary'])
+    try:
+        async for chunk in request.stream():
+            if reader.upload is not None and reader.upload.on_disk:
+                await asyncio.to_thread(reader.write, chunk)
+            else:
+                reader.write(chunk)
+        reader.parser.finalize()
+    except BaseException:
+        if reader.upload is not None:
+            reader.upload.discard()
+        raise
+    if reader.upload is not None:
+        reader.upload.seek(0)
+    return reader.fields, reader.upload
+
+async def convert_upload(request):
+    # Parsed from the body as it arrives: the PDF goes straight into a
+    # SpooledUpload (on disk past UPLOAD_SPOOL_KB), hashed and capped at
+    # MAX_CONTENT_LENGTH while it is written
+    try:
+        form, upload = await read_upload(request)
+    except RequestEntityTooLarge:
+        return JSONResponse({'error': 'File too large'}, status_code=413)
+    except ValueError as e:  # python-multipart's MultipartParseError
+        return JSONResponse({'error': f'Malformed upload: {e}'}, status_code=400)
+    if upload is None:
+        return JSONResponse({'error': 'No file uploaded'}, status_code=400)
+    error = None
+    if not upload.filename:
+        error = 'No file selected'
+    elif not upload.filename.lower().endswith('.pdf'):
+        error = 'Please upload a PDF file'
+    mode = form.get('mode') or request.query_params.get('mode') or PIPELINE_MODE
+    if not error and mode not in PIPELINE_MODES:
+        error = f"Unknown pipeline mode '{mode}'"
+    previous = form.get('previous') or request.query_params.get('previous') or None
+    if not error and previous and await asyncio.to_thread(result_cache.get, 'pages:' + previous) is None:
+        error = 'Unknown or expired previous result'
+    if error:
+        upload.discard()
+        return JSONResponse({'error': error}, status_code=400)
+    reuse = (form.get('reuse') or request.query_params.get('reuse') or '').lower() in ('1', 'true', 'yes')
+
+    key = result_cache_key(upload, mode)
+    cached = await asyncio.to_thread(result_cache.get, key)
+    if cached:
+        upload.discard()
+        log.info("Result cache hit", extra={'upload': upload.filename})
+        return JSONResponse({'success': True, 'status': 'done', 'cached': True, 'result_key': key, 'result': cached})
+
+    flight_key = key + ':reuse' if reuse else key
+    if previous:
+        flight_key += ':previous:' + previous
+    task, coalesced = generate_once(flight_key, upload, mode, reuse_similar=reuse, previous=previous)
+    try:
+        # Shielded: a client that disconnects does not cancel the run others wait on
+        result = await asyncio.shield(task)
+    except PipelineError as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status_code)
+    except Exception as e:
+        log.exception("Async upload failed: %s", e)
+        return JSONResponse({'error': f'Processing failed: {e}'}, status_code=500)
+
+    return JSONResponse({'success': True, 'status': 'done', 'cached': False, 'coalesced': coalesced, 'result_key': key,
+                         'result': result})
+
+# Pipeline runs in flight by result cache key, for single-flight uploads. Only
+# /async/upload requests of this process join each other: they do not join
+# /upload or batch jobs, which live in the Flask app's job queues
+inflight_tasks = {}
+
+def generate_once(key, upload, mode, reuse_similar=False, previous=None):
+    """Return (task, coalesced): the running pipeline for key, or a new one that owns upload
+
+    Concurrent uploads of the same PDF share one extraction and LLM pipeline;
+    a joining upload is discarded straight away.
+    """
+    task = inflight_tasks.get(key)
+    if task is not None:
+        upload.discard()
+        uploads_coalesced_total.inc(endpoint='async_upload')
+        log.info("Joined running conversion", extra={'upload': upload.filename})
+        return task, True
+    task = asyncio.ensure_future(generate_and_discard(upload, mode, reuse_similar, previous))
+    inflight_tasks[key] = task
+    task.add_done_callback(lambda done: inflight_tasks.pop(key, None) if inflight_tasks.get(key) is done else None)
+    return task, False
+
+async def generate_and_discard(upload, mode, reuse_similar=False, previous=None):
+    with upload:
+        return await generate_flowchart_async(upload, mode, reuse_similar, previous)
+
+app = Starlette(routes=[
+    Route('/async/upload', async_upload, methods=['POST']),
+    Mount('/', app=WSGIMiddleware(flask_app.app)),
+])
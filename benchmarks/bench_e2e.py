@@ -0,0 +1,401 @@
+"""End-to-end benchmark of /upload against a local mock of the xAI API.
+
+Starts an OpenAI-compatible stand-in for xAI (configurable latency, token
+rate, error and 429 injection), points the app at it through XAI_BASE_URL,
+serves the app on a local port and drives /upload with synthetic PDFs at a
+fixed concurrency. Each upload is followed over /jobs/<id>/events until it
+finishes, so per-stage times come from the stage_start/stage_done events.
+
+Prints (or writes with --output) a JSON report with p50/p95/p99 latency,
+req/s, per-stage breakdowns and the mock's call counts, meant to be diffed
+between releases:
+
+    python benchmarks/bench_e2e.py --requests 200 --concurrency 16 --latency 0.3 --throttle-rate 0.05
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STEPS_RESPONSE = """1. Put on safety goggles and gloves
+2. Prepare the buffer solution
+3. Is the solution clear?
+   - Yes: continue with the titration
+   - No: filter the solution and check again
+4. Record the results
+5. Clean up the bench"""
+
+DESCRIPTION_RESPONSE = """The procedure starts with safety equipment, prepares the buffer and checks
+whether it is clear. A clear solution goes on to titration; otherwise it is
+filtered and checked again. Results are recorded before the bench is cleaned."""
+
+
+def mermaid_response(nodes):
+    lines = ['```mermaid', 'flowchart TD', '    N0([Start]) --> N1[Put on safety goggles]']
+    for i in range(1, nodes - 1):
+        if i % 5 == 0:
+            lines.append(f'    N{i}{{Check {i}?}} -->|Yes| N{i + 1}[Step {i + 1}]')
+            lines.append(f'    N{i} -->|No| N{i - 1}')
+        else:
+            lines.append(f'    N{i} --> N{i + 1}[Step {i + 1}]')
+    lines.append(f'    N{nodes - 1} --> End([Done])')
+    lines.append('```')
+    return '\n'.join(lines)
+
+
+def structured_response(nodes):
+    graph = {
+        'nodes': [{'id': f'n{i}', 'label': f'Step {i}', 'shape': 'diamond' if i % 5 == 4 else 'rect'}
+                  for i in range(nodes)],
+        'edges': [{'from': f'n{i}', 'to': f'n{i + 1}'} for i in range(nodes - 1)],
+    }
+    return json.dumps({'steps': STEPS_RESPONSE.split('\n'), 'description': DESCRIPTION_RESPONSE, 'graph': graph})
+
+
+class MockXAI:
+    """Settings and counters shared by the mock server's handler threads"""
+
+    def __init__(self, latency=0.2, token_rate=500.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=0.2, nodes=12, seed=0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.nodes = nodes
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'ok': 0, 'throttled': 0, 'errors': 0, 'streamed': 0,
+                       'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def count(self, **increments):
+        with self.lock:
+            for key, amount in increments.items():
+                self.counts[key] += amount
+
+    def roll(self):
+        """'throttle', 'error' or None for the next request"""
+        with self.lock:
+            value = self.random.random()
+        if value < self.throttle_rate:
+            return 'throttle'
+        if value < self.throttle_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def answer(self, messages):
+        system = messages[0]['content'] if messages else ''
+        prompt = messages[-1]['content'] if messages else ''
+        if 'JSON' in system:
+            return structured_response(self.nodes)
+        if 'Mermaid' in system and 'fix' in system:
+            return '\n'.join(f'{line.split(":")[0]}: A --> B' for line in prompt.split('\n') if line[:1].isdigit())
+        if 'Mermaid' in system:
+            return mermaid_response(self.nodes)
+        if prompt.startswith('Create a flowchart description'):
+            return DESCRIPTION_RESPONSE
+        return STEPS_RESPONSE
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            mock.count(requests=1)
+            if not self.path.endswith('/chat/completions'):
+                self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+                return
+
+            time.sleep(mock.latency)
+            outcome = mock.roll()
+            if outcome == 'throttle':
+                mock.count(throttled=1)
+                self.send_json(429, {'error': {'message': 'Rate limit exceeded', 'type': 'rate_limit'}},
+                               {'retry-after': str(mock.retry_after)})
+                return
+            if outcome == 'error':
+                mock.count(errors=1)
+                self.send_json(500, {'error': {'message': 'Injected server error', 'type': 'server_error'}})
+                return
+
+            messages = body.get('messages', [])
+            content = mock.answer(messages)
+            prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+            completion_tokens = max(1, len(content) // 4)
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                     'total_tokens': prompt_tokens + completion_tokens}
+            mock.count(ok=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            base = {'id': 'chatcmpl-bench', 'created': int(time.time()), 'model': body.get('model', 'mock')}
+
+            if not body.get('stream'):
+                if mock.token_rate:
+                    time.sleep(completion_tokens / mock.token_rate)
+                self.send_json(200, dict(base, object='chat.completion', usage=usage, choices=[{
+                    'index': 0, 'finish_reason': 'stop',
+                    'message': {'role': 'assistant', 'content': content}}]))
+                return
+
+            mock.count(streamed=1)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            def send_event(data):
+                payload = f'data: {data}\n\n'.encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(payload), payload))
+                self.wfile.flush()
+
+            pieces = [content[i:i + 16] for i in range(0, len(content), 16)]
+            for piece in pieces:
+                if mock.token_rate:
+                    time.sleep(len(piece) / 4 / mock.token_rate)
+                send_event(json.dumps(dict(base, object='chat.completion.chunk', choices=[{
+                    'index': 0, 'finish_reason': None, 'delta': {'content': piece}}])))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                send_event(json.dumps(dict(base, object='chat.completion.chunk', choices=[], usage=usage)))
+            send_event('[DONE]')
+            self.wfile.write(b'0\r\n\r\n')
+
+    return Handler
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop idle keep-alive connections; that is not a failure
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(app_or_handler, wsgi=False):
+    """Serve a handler class (or a WSGI app) on a free local port in a daemon thread"""
+    if wsgi:
+        from werkzeug.serving import make_server
+        # One access-log line per request would dominate the output and the timings
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app_or_handler, threaded=True)
+    else:
+        server = QuietHTTPServer(('127.0.0.1', 0), app_or_handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def make_corpus(count, pages, seed=0):
+    """Distinct synthetic storyboard PDFs (distinct so the result cache never short-circuits)"""
+    from extraction import make_sample_pdf
+    rng = random.Random(seed)
+    actions = ['Mix', 'Heat', 'Filter', 'Weigh', 'Record', 'Rinse', 'Label', 'Cool', 'Stir', 'Measure']
+    corpus = []
+    for doc in range(count):
+        texts = []
+        for page in range(pages):
+            lines = [f'Storyboard {doc} panel {page + 1}', 'Put on safety goggles']
+            lines += [f'{rng.choice(actions)} sample {doc}-{page}-{i} for {rng.randint(1, 60)} minutes'
+                      for i in range(rng.randint(6, 14))]
+            texts.append('\n'.join(lines))
+        corpus.append(make_sample_pdf(texts))
+    return corpus
+
+
+def run_upload(session, base_url, pdf_bytes, name, mode, timeout):
+    """Upload one PDF and follow its job; returns latency, status and per-stage seconds"""
+    started = time.perf_counter()
+    response = session.post(f'{base_url}/upload', files={'file': (name, pdf_bytes, 'application/pdf')},
+                            data={'mode': mode}, timeout=timeout)
+    data = response.json()
+    outcome = {'http_status': response.status_code, 'status': data.get('status', 'rejected'), 'stages': {}}
+    if response.status_code != 202 or not data.get('job_id'):
+        outcome['latency'] = time.perf_counter() - started
+        outcome['error'] = data.get('error')
+        return outcome
+
+    stage_started = {}
+    first_stage = None
+    event = None
+    with session.get(f"{base_url}/jobs/{data['job_id']}/events", stream=True, timeout=timeout) as events:
+        for line in events.iter_lines(decode_unicode=True):
+            if line.startswith('event:'):
+                event = line[6:].strip()
+                continue
+            if not line.startswith('data:'):
+                continue
+            now = time.perf_counter()
+            payload = json.loads(line[5:])
+            if event == 'stage_start':
+                first_stage = first_stage or now
+                stage_started[payload['stage']] = now
+            elif event == 'stage_done' and payload.get('stage') in stage_started:
+                outcome['stages'][payload['stage']] = now - stage_started.pop(payload['stage'])
+            elif event in ('done', 'failed', 'timeout'):
+                outcome['status'] = event
+                if event != 'done':
+                    outcome['error'] = payload.get('error')
+                break
+    outcome['latency'] = time.perf_counter() - started
+    outcome['stages']['queue'] = (first_stage or time.perf_counter()) - started
+    return outcome
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * q
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def summarize(values):
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4),
+        'p50': round(percentile(values, 0.50), 4),
+        'p95': round(percentile(values, 0.95), 4),
+        'p99': round(percentile(values, 0.99), 4),
+        'max': round(max(values), 4),
+    }
+
+
+def run_benchmark(base_url, corpus, concurrency, mode='chain', timeout=300):
+    """Drive /upload with every PDF in corpus, concurrency uploads in flight at once"""
+    import requests
+
+    local = threading.local()
+
+    def one(index):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            return run_upload(local.session, base_url, corpus[index], f'bench-{index}.pdf', mode, timeout)
+        except Exception as e:
+            return {'status': 'error', 'error': str(e), 'latency': None, 'stages': {}}
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, range(len(corpus))))
+    wall = time.perf_counter() - started
+
+    done = [o for o in outcomes if o['status'] == 'done']
+    statuses = {}
+    for outcome in outcomes:
+        statuses[outcome['status']] = statuses.get(outcome['status'], 0) + 1
+    stage_names = sorted({name for o in done for name in o['stages']})
+    errors = sorted({o['error'] for o in outcomes if o.get('error')})[:10]
+    return {
+        'requests': len(outcomes),
+        'statuses': statuses,
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(len(done) / wall, 3) if wall else 0.0,
+        'latency': summarize([o['latency'] for o in done]),
+        'stages': {name: summarize([o['stages'][name] for o in done if name in o['stages']]) for name in stage_names},
+        'sample_errors': errors,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=50, help='Uploads to run (default: 50)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Uploads in flight at once (default: 8)')
+    parser.add_argument('--pages', type=int, default=3, help='Pages per synthetic PDF (default: 3)')
+    parser.add_argument('--mode', choices=('chain', 'structured'), default='chain', help='Pipeline mode')
+    parser.add_argument('--latency', type=float, default=0.2, help='Mock xAI seconds before answering (default: 0.2)')
+    parser.add_argument('--token-rate', type=float, default=500.0,
+                        help='Mock xAI completion tokens per second, 0 for instant (default: 500)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls answered with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of calls answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='Retry-After seconds sent with 429s')
+    parser.add_argument('--nodes', type=int, default=12, help='Nodes in the mock flowcharts (default: 12)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    mock = MockXAI(args.latency, args.token_rate, args.error_rate, args.throttle_rate,
+                   args.retry_after, args.nodes, args.seed)
+    mock_server, mock_url = start_server(make_handler(mock))
+
+    # The app reads its configuration at import: point it at the mock and turn
+    # off everything that would answer without calling it. Settings already in
+    # the environment (e.g. XAI_MAX_CONCURRENCY) are kept
+    os.environ['XAI_BASE_URL'] = f'{mock_url}/v1'
+    os.environ['XAI_API_KEY'] = 'bench'
+    os.environ['RESULT_CACHE_PATH'] = ''
+    os.environ['LLM_MEMO_SIZE'] = '0'
+    os.environ.setdefault('XAI_REQUESTS_PER_MINUTE', '0')
+    os.environ.setdefault('JOB_WORKERS', str(args.concurrency))
+    os.environ.setdefault('JOB_QUEUE_SIZE', str(max(20, args.requests)))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import app
+
+    app_server, app_url = start_server(app.app, wsgi=True)
+    corpus = make_corpus(args.requests, args.pages, args.seed)
+    try:
+        results = run_benchmark(app_url, corpus, args.concurrency, args.mode)
+        server_stats = app.app.test_client().get('/stats').get_json()
+    finally:
+        app_server.shutdown()
+        mock_server.shutdown()
+
+    report = {
+        'benchmark': 'e2e_upload',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'app_config': {name: getattr(app, name) for name in (
+            'XAI_MAX_CONCURRENCY', 'XAI_REQUESTS_PER_MINUTE', 'XAI_TOKENS_PER_MINUTE', 'JOB_WORKERS',
+            'CHUNK_SIZE', 'CHUNK_CONCURRENCY', 'PIPELINE_MODE')},
+        'results': results,
+        'mock_xai': dict(mock.counts),
+        'xai_limiter': server_stats.get('xai_limiter'),
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        print(f"📊 Wrote {args.output}: {results['requests_per_second']} req/s, "
+              f"p95 {results['latency'].get('p95')}s")
+    else:
+        print(output)
+    return 0 if results['statuses'].get('done') == results['requests'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
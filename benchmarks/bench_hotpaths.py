@@ -0,0 +1,240 @@
+"""Micro-benchmarks of the local CPU hot paths, Flask app vs Streamlit app.
+
+Times PDF text extraction on generated PDFs (1-500 pages) and Mermaid
+post-processing on generated LLM responses (10-10,000 lines), and records
+the peak Python memory of each call (tracemalloc; allocations made inside
+PDFium or in extraction worker processes are not seen). Functions that both
+apps implement are run on the same inputs, and the report says whether
+their outputs agree.
+
+    python benchmarks/bench_hotpaths.py
+    python benchmarks/bench_hotpaths.py --json baseline.json
+    python benchmarks/bench_hotpaths.py --baseline baseline.json   # exit 1 on regressions
+
+The Streamlit functions are compiled from streamlit_app.py on their own,
+so the Streamlit page is never rendered (and Streamlit need not be installed).
+"""
+import argparse
+import ast
+import functools
+import gc
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Dropped Mermaid statements are logged one by one; keep that out of the timings
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ.setdefault('RESULT_CACHE_PATH', '')
+
+import app  # noqa: E402
+from bench_mermaid import generate_chart  # noqa: E402
+from extraction import make_sample_pdf  # noqa: E402
+
+STREAMLIT_FUNCTIONS = ('get_pdf_backend', 'extract_pages_from_pdf', 'extract_text_from_pdf', 'extract_mermaid_code', 'generate_mermaid_live_url')
+
+PAGE_WORDS = ['Mix', 'the', 'reagent', 'at', '37°C', 'for', '5 min', 'then', 'check', 'pH', 'wash', 'µL', 'sample',
+              'centrifuge', 'label', 'tubes', 'record', 'result', 'dispose', 'of', 'waste', 'wear', 'gloves']
+
+
+def _streamlit_error(message):
+    raise RuntimeError(message)
+
+
+def load_streamlit_functions(path=os.path.join(ROOT, 'streamlit_app.py')):
+    """The hot-path functions of streamlit_app.py, without running the page
+
+    Only the module's imports (except streamlit) and the named functions are
+    executed. st.cache_resource becomes functools.cache and st.error raises,
+    so a failure shows up as an error instead of an empty result.
+    """
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.Import) and any(alias.name == 'streamlit' for alias in node.names):
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)) or (
+                isinstance(node, ast.FunctionDef) and node.name in STREAMLIT_FUNCTIONS):
+            body.append(node)
+    namespace = {'st': SimpleNamespace(cache_resource=functools.cache, error=_streamlit_error)}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'), namespace)
+    return SimpleNamespace(**{name: namespace[name] for name in STREAMLIT_FUNCTIONS})
+
+
+def generate_pdf(pages, seed=0):
+    rng = random.Random(seed)
+    texts = []
+    for page in range(pages):
+        lines = [f'Panel {page + 1}: step {page + 1} of the procedure']
+        lines += [' '.join(rng.choice(PAGE_WORDS) for _ in range(rng.randint(4, 12))) for _ in range(30)]
+        texts.append('\n'.join(lines))
+    return make_sample_pdf(texts)
+
+
+def generate_response(lines, seed=0):
+    """An LLM answer of about the given size: prose, a fenced flowchart, more prose"""
+    # generate_chart's noise includes stray fences, which would end the block early
+    chart = '\n'.join(line for line in generate_chart(max(2, lines - 6), seed=seed).split('\n') if line != '```')
+    return '\n'.join([
+        "Here is the flowchart for the procedure:",
+        '',
+        '```mermaid',
+        chart,
+        '```',
+        'This represents the full procedure, including the pH decision points.',
+    ])
+
+
+def measure(func, arg, repeat, setup=None):
+    """(min seconds, median seconds, peak bytes, result) over repeat runs"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        started = time.perf_counter()
+        result = func(arg)
+        timings.append(time.perf_counter() - started)
+    # Peak memory from one separate run; tracemalloc slows the calls down
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(timings), statistics.median(timings), peak, result
+
+
+def build_cases(streamlit, page_counts, line_counts):
+    """(group, function, size, {impl: (callable, argument factory)}, setup) tuples"""
+    clear_page_cache = app.page_extractor.page_cache.clear
+    cases = []
+    for pages in page_counts:
+        pdf_bytes = generate_pdf(pages)
+        cases.append(('extraction', 'extract_text_from_pdf', pages, {
+            'app': (app.extract_text_from_pdf, lambda b=pdf_bytes: b),
+            # Streamlit hands over an UploadedFile, read with getvalue()
+            'streamlit': (lambda b: streamlit.extract_text_from_pdf(BytesIO(b)), lambda b=pdf_bytes: b),
+        }, clear_page_cache))
+    for lines in line_counts:
+        response = generate_response(lines)
+        chart = generate_chart(lines)
+        code = app.validate_and_fix_mermaid(chart)
+        cases.append(('mermaid', 'extract_mermaid_code', lines, {
+            'app': (app.extract_mermaid_code, lambda r=response: r),
+            'streamlit': (streamlit.extract_mermaid_code, lambda r=response: r),
+        }, None))
+        cases.append(('mermaid', 'validate_and_fix_mermaid', lines, {
+            'app': (app.validate_and_fix_mermaid, lambda c=chart: c),
+        }, None))
+        cases.append(('mermaid', 'finalize_mermaid', lines, {
+            'app': (lambda r: app.finalize_mermaid(r, repair=False), lambda r=response: r),
+        }, None))
+        cases.append(('mermaid', 'generate_mermaid_live_url', lines, {
+            'app': (app.generate_mermaid_live_url, lambda c=code: c),
+            'streamlit': (streamlit.generate_mermaid_live_url, lambda c=code: c),
+        }, None))
+    return cases
+
+
+def run(cases, repeat):
+    rows = []
+    for group, name, size, impls, setup in cases:
+        outputs = {}
+        for impl, (func, make_arg) in impls.items():
+            arg = make_arg()
+            try:
+                best, median, peak, result = measure(func, arg, repeat, setup)
+            except Exception as e:
+                rows.append({'group': group, 'function': name, 'impl': impl, 'size': size, 'error': str(e)})
+                continue
+            outputs[impl] = result
+            rows.append({
+                'group': group, 'function': name, 'impl': impl, 'size': size,
+                'min_ms': round(best * 1000, 3), 'median_ms': round(median * 1000, 3),
+                'peak_kib': round(peak / 1024, 1), 'output_chars': len(result or ''),
+            })
+        if len(outputs) > 1:
+            same = len({json.dumps(value) for value in outputs.values()}) == 1
+            for row in rows[-len(outputs):]:
+                row['same_output'] = same
+    return rows
+
+
+def print_table(rows):
+    unit = {'extraction': 'pages', 'mermaid': 'lines'}
+    print(f"{'function':<27} {'impl':<10} {'size':>12} {'min ms':>10} {'median ms':>10} {'peak KiB':>10}  output")
+    for row in rows:
+        size = f"{row['size']} {unit[row['group']]}"
+        if 'error' in row:
+            print(f"{row['function']:<27} {row['impl']:<10} {size:>12}  ERROR {row['error']}")
+            continue
+        same = {True: 'same', False: 'differs'}.get(row.get('same_output'), '')
+        print(f"{row['function']:<27} {row['impl']:<10} {size:>12} {row['min_ms']:>10.2f} {row['median_ms']:>10.2f} "
+              f"{row['peak_kib']:>10.1f}  {row['output_chars']} chars {same}")
+
+
+def compare(rows, baseline_rows, tolerance, floor_ms):
+    """Rows whose min time or peak memory grew past the tolerance since the baseline"""
+    baseline = {(r['function'], r['impl'], r['size']): r for r in baseline_rows if 'error' not in r}
+    regressions = []
+    for row in rows:
+        before = baseline.get((row['function'], row['impl'], row['size']))
+        if before is None or 'error' in row:
+            continue
+        for field, floor in (('min_ms', floor_ms), ('peak_kib', 64)):
+            if row[field] > before[field] * (1 + tolerance) and row[field] - before[field] > floor:
+                regressions.append(f"{row['function']} [{row['impl']}, {row['size']}] {field}: "
+                                   f"{before[field]} -> {row[field]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', default='1,10,100,500', help='PDF sizes in pages (comma-separated)')
+    parser.add_argument('--lines', default='10,100,1000,10000', help='LLM response sizes in lines (comma-separated)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (min and median reported)')
+    parser.add_argument('--only', choices=('extraction', 'mermaid'), help='Run one group of benchmarks')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Results file from an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown/growth vs the baseline')
+    args = parser.parse_args()
+
+    page_counts = [int(n) for n in args.pages.split(',') if n] if args.only != 'mermaid' else []
+    line_counts = [int(n) for n in args.lines.split(',') if n] if args.only != 'extraction' else []
+    # Start the extraction process pool (and pick the backend) before timing anything
+    app.extract_text_from_pdf(generate_pdf(max(page_counts or [1])))
+
+    rows = run(build_cases(load_streamlit_functions(), page_counts, line_counts), args.repeat)
+    print(f"PDF backend: {app.page_extractor.backend}, extraction workers: {app.page_extractor.workers}")
+    print_table(rows)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'backend': app.page_extractor.backend, 'results': rows},
+                      f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(rows, json.load(f)['results'], args.tolerance, floor_ms=1.0)
+        print(f"Regressions vs {args.baseline}: {len(regressions) or 'none'}")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1 if regressions else 0
+    return 1 if any('error' in row for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
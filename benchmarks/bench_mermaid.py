@@ -0,0 +1,204 @@
+"""Micro-benchmark of validate_and_fix_mermaid on large generated flowcharts.
+
+Compares the parser-based implementation with the earlier regex/heuristic
+one (kept below as a reference), checks that its output on realistic and
+randomly mangled charts always parses and is stable when fixed again, and
+reports the per-line cost.
+
+    python benchmarks/bench_mermaid.py --lines 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import validate_and_fix_mermaid  # noqa: E402
+from flowchart import MermaidSyntaxError, parse_mermaid  # noqa: E402
+
+
+def legacy_validate_and_fix_mermaid(mermaid_code):
+    """validate_and_fix_mermaid before the Mermaid parser (reference only)"""
+    try:
+        import re
+        
+        lines = mermaid_code.strip().split('\n')
+        fixed_lines = []
+        
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+                
+            # Skip explanatory text lines
+            if any(phrase in line.lower() for phrase in [
+                'here is', 'this is', 'the following', 'note:', 'explanation', 
+                'however', 'to better', 'we can use', 'this represents'
+            ]):
+                continue
+            
+            # Fix common Mermaid syntax issues
+            if 'flowchart' in line:
+                fixed_lines.append(line)
+                continue
+            
+            # Fix the specific |> arrow issue that causes TAGEND errors
+            line = re.sub(r'\|>', ' --> ', line)
+            line = re.sub(r'<\|', ' --> ', line)
+            
+            # Fix incomplete arrows
+            line = re.sub(r'--([^>-])', r' --> \1', line)
+            
+            # Clean up edge label syntax
+            line = re.sub(r'\|\s*([^|]*?)\s*\|(?=[A-Z])', r'|"\1"| ', line)
+            
+            # Simplify complex labels that might cause issues
+            # Replace problematic characters in labels
+            def fix_label(match):
+                node = match.group(1)
+                label = match.group(2)
+                # Remove or replace problematic characters
+                label = label.replace('|', ' or ')
+                label = label.replace('>', '')
+                label = label.replace('<', '')
+                label = label.replace(':', '')
+                label = label.replace('&', 'and')
+                label = label.replace('/', ' or ')
+                return f'{node}[{label}]'
+            
+            # Fix node labels
+            line = re.sub(r'([A-Z][0-9]*)\[([^\]]+)\]', fix_label, line)
+            
+            # Fix decision node labels
+            def fix_decision_label(match):
+                node = match.group(1)
+                label = match.group(2)
+                label = label.replace('|', ' or ')
+                label = label.replace('>', '')
+                label = label.replace('<', '')
+                label = label.replace(':', '')
+                label = label.replace('&', 'and')
+                label = label.replace('/', ' or ')
+                return f'{node}{{{label}}}'
+            
+            line = re.sub(r'([A-Z][0-9]*)\{([^\}]+)\}', fix_decision_label, line)
+            
+            # Ensure proper spacing around arrows
+            line = re.sub(r'\s*-->\s*', ' --> ', line)
+            
+            # Only add lines that look like valid Mermaid syntax
+            if ('-->' in line or 
+                line.startswith(('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K')) or
+                'flowchart' in line):
+                fixed_lines.append(line)
+        
+        # Ensure we start with flowchart directive
+        if fixed_lines and not any('flowchart' in line for line in fixed_lines[:3]):
+            fixed_lines.insert(0, 'flowchart TD')
+        
+        result = '\n'.join(fixed_lines)
+        return result.strip()
+        
+    except Exception as e:
+        print(f"Error validating Mermaid code: {e}")
+        return mermaid_code
+
+
+LABEL_WORDS = ['Mix', 'reagent', 'A/B', 'heat', 'to', '37°C', 'check', 'pH', '<7', '>8', 'wash', '&', 'rinse',
+               'Note:', 'sample', 'centrifuge', '5 min', 'label', 'tubes', 'record', 'result', 'dispose', 'waste']
+NOISE_LINES = ['Here is the flowchart:', 'This represents the full procedure.', 'However, step 3 may vary.',
+               'Note: wear gloves', '```', 'The following diagram', '%% comment', 'subgraph Prep', 'end',
+               'classDef warn fill:#f96', 'style A fill:#bbf']
+
+
+def generate_chart(lines, seed=0):
+    """A flowchart of roughly the given size, with the quirks LLMs produce"""
+    rng = random.Random(seed)
+    ids = [f'{chr(65 + i % 26)}{i // 26 or ""}' for i in range(max(2, lines))]
+    out = ['flowchart TD']
+    for i in range(1, lines):
+        source, target = rng.choice(ids[:i]), ids[i]
+        label = ' '.join(rng.choice(LABEL_WORDS) for _ in range(rng.randint(1, 5)))
+        roll = rng.random()
+        if roll < 0.35:
+            out.append(f'    {source} --> {target}[{label}]')
+        elif roll < 0.5:
+            out.append(f'    {source} -->|{rng.choice(["Yes", "No", "pH < 7", "done/failed"])}| {target}{{{label}?}}')
+        elif roll < 0.6:
+            out.append(f'    {source}|>{target}[{label}]')
+        elif roll < 0.7:
+            out.append(f'    {source}--{target}')
+        elif roll < 0.8:
+            out.append(f'    {target}[{label}]')
+        elif roll < 0.85:
+            out.append(f'{source} -- {rng.choice(["Yes", "No"])} --> {target}')
+        elif roll < 0.9:
+            out.append(rng.choice(NOISE_LINES))
+        elif roll < 0.95:
+            out.append('')
+        else:
+            out.append(f'  {source}<|{target} & {label}')
+    return '\n'.join(out)
+
+
+def mangled_chart(rng, lines=40):
+    """Random lines built from the characters the fixer rewrites"""
+    alphabet = 'AAB12KZab[]{}|<>-->:/& "\t' + 'here is'
+    return '\n'.join(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 30))) for _ in range(lines))
+
+
+def verify(samples=2000, seed=0):
+    """Return the inputs whose fixed output does not parse or changes when fixed again"""
+    rng = random.Random(seed)
+    cases = [generate_chart(rng.randint(1, 200), seed=i) for i in range(samples // 10)]
+    cases += [mangled_chart(rng) for _ in range(samples)]
+    failures = []
+    for case in cases:
+        fixed = validate_and_fix_mermaid(case)
+        try:
+            if fixed:
+                parse_mermaid(fixed)
+        except MermaidSyntaxError:
+            failures.append(case)
+            continue
+        if validate_and_fix_mermaid(fixed) != fixed:
+            failures.append(case)
+    return failures
+
+
+def best_time(func, text, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--lines', type=int, default=10000, help='Lines in the generated flowchart')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per implementation (best is reported)')
+    parser.add_argument('--verify-samples', type=int, default=2000, help='Random charts checked for valid output')
+    args = parser.parse_args()
+
+    mismatches = verify(args.verify_samples)
+    print(f"Valid, stable output: {'yes' if not mismatches else f'NO ({len(mismatches)} failures)'}")
+    if mismatches:
+        print(repr(mismatches[0]))
+
+    chart = generate_chart(args.lines)
+    lines = chart.count('\n') + 1
+    current = best_time(validate_and_fix_mermaid, chart, args.repeat)
+    legacy = best_time(legacy_validate_and_fix_mermaid, chart, args.repeat)
+    print(f"{lines} lines, best of {args.repeat}:")
+    print(f"  current  {current * 1000:8.1f} ms  {current * 1e6 / lines:6.2f} us/line")
+    print(f"  previous {legacy * 1000:8.1f} ms  {legacy * 1e6 / lines:6.2f} us/line")
+    print(f"  speedup  {legacy / current:.1f}x")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
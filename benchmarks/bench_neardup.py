@@ -0,0 +1,165 @@
+"""Benchmark of the near-duplicate index (neardup.py) at production sizes.
+
+Indexes --documents fingerprints and reports insert and lookup latency, the
+time to reload a full index from its SQLite table (as at server startup),
+the index's Python memory, and detection quality: how often lightly edited copies
+of indexed documents (a changed date, a new header, a few reworded lines) are
+found, and how often unrelated documents on the same topic are matched.
+
+    python benchmarks/bench_neardup.py
+    python benchmarks/bench_neardup.py --documents 100000 --threshold 0.85
+
+Most of the indexed documents are filler: random signatures, which behave like
+unrelated documents, so the index can be filled without generating and
+fingerprinting 100k texts. The probe documents are real generated texts.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from neardup import SIGNATURE_SIZE, NearDuplicateIndex, shingle_hashes, signature  # noqa: E402
+
+WORDS = ['mix', 'the', 'reagent', 'at', '37', 'c', 'for', '5', 'min', 'then', 'check', 'ph', 'wash', 'sample',
+         'centrifuge', 'label', 'tubes', 'record', 'result', 'dispose', 'of', 'waste', 'wear', 'gloves', 'pipette',
+         'buffer', 'incubate', 'transfer', 'plate', 'rinse', 'discard', 'supernatant', 'vortex', 'seconds', 'ice',
+         'add', 'ml', 'ul', 'and', 'to', 'each', 'well', 'until', 'dry', 'measure', 'absorbance', 'nm', 'repeat']
+
+
+def generate_document(rng, lines=60):
+    return '\n'.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))) for _ in range(lines))
+
+
+def edit_document(rng, text, kind):
+    lines = text.split('\n')
+    if kind == 'date':
+        lines.insert(0, f'Revised {rng.randint(2020, 2030)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}')
+    elif kind == 'header':
+        lines.insert(0, f'Lab {rng.randint(1, 99)} standard operating procedure, version {rng.randint(2, 9)}')
+        lines.append(f'Page footer {rng.randint(1, 999)}')
+    elif kind == 'reword':
+        for i in rng.sample(range(len(lines)), 3):
+            lines[i] = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 14)))
+    return '\n'.join(lines)
+
+
+def jaccard(a, b):
+    a, b = shingle_hashes(a), shingle_hashes(b)
+    return len(a & b) / len(a | b)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def measure_reload(entries, threshold):
+    """Seconds to open an index whose SQLite table holds the given entries"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'fingerprints.sqlite3')
+        NearDuplicateIndex(path)  # Creates the table
+        conn = sqlite3.connect(path)
+        conn.executemany('INSERT INTO fingerprints (key, tag, signature, created_at) VALUES (?, ?, ?, ?)',
+                         [(key, 'chain', sig.tobytes(), i) for i, (key, sig) in enumerate(entries)])
+        conn.commit()
+        conn.close()
+        seconds, index = timed(NearDuplicateIndex, path, threshold, len(entries))
+        assert len(index) == len(entries)
+        key, sig = entries[-1]
+        assert index.query(sig, 'chain')[0][1] == key
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--documents', type=int, default=100000, help='Documents in the index')
+    parser.add_argument('--probes', type=int, default=200, help='Real documents indexed and queried with edited copies')
+    parser.add_argument('--threshold', type=float, default=0.9, help='Similarity threshold')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    probes = [generate_document(rng) for _ in range(args.probes)]
+    fingerprint_times = []
+    probe_signatures = []
+    for text in probes:
+        seconds, sig = timed(signature, text)
+        fingerprint_times.append(seconds)
+        probe_signatures.append(sig)
+
+    index = NearDuplicateIndex(threshold=args.threshold, max_entries=args.documents)
+    fillers = max(0, args.documents - args.probes)
+    entries = [(f'filler-{i}', array('I', (rng.getrandbits(32) for _ in range(SIGNATURE_SIZE))))
+               for i in range(fillers)]
+    entries += [(f'probe-{i}', sig) for i, sig in enumerate(probe_signatures)]
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    insert_times = []
+    fill_started = time.perf_counter()
+    for key, sig in entries:
+        insert_times.append(timed(index.add, key, sig, 'chain')[0])
+    fill_seconds = time.perf_counter() - fill_started
+    memory = tracemalloc.get_traced_memory()[0] - memory_before
+    tracemalloc.stop()
+    insert_times.sort()
+    reload_seconds = measure_reload(entries, args.threshold)
+
+    report = {
+        'documents': len(index),
+        'threshold': args.threshold,
+        'index_mib': round(memory / 1024 / 1024, 1),
+        'fingerprint_ms': round(statistics.median(fingerprint_times) * 1000, 3),
+        'insert_us': {
+            'p50': round(statistics.median(insert_times) * 1e6, 1),
+            'p99': round(insert_times[int(len(insert_times) * 0.99) - 1] * 1e6, 1),
+            'max': round(insert_times[-1] * 1e6, 1),
+        },
+        'fill_s': round(fill_seconds, 2),
+        'reload_s': round(reload_seconds, 2),
+        'edits': {},
+    }
+    query_times = []
+    for kind in ('date', 'header', 'reword'):
+        found = []
+        similarities = []
+        for i, text in enumerate(probes):
+            edited = edit_document(rng, text, kind)
+            seconds, matches = timed(index.query, signature(edited), 'chain')
+            query_times.append(seconds)
+            found.append(bool(matches) and matches[0][1] == f'probe-{i}')
+            similarities.append(jaccard(text, edited))
+        report['edits'][kind] = {
+            'recall': round(sum(found) / len(found), 3),
+            'median_jaccard': round(statistics.median(similarities), 3),
+        }
+    false_matches = 0
+    for _ in range(args.probes):
+        seconds, matches = timed(index.query, signature(generate_document(rng)), 'chain')
+        query_times.append(seconds)
+        false_matches += bool(matches)
+    report['unrelated_match_rate'] = round(false_matches / args.probes, 4)
+    report['query_us'] = {
+        'p50': round(statistics.median(query_times) * 1e6, 1),
+        'p99': round(sorted(query_times)[int(len(query_times) * 0.99) - 1] * 1e6, 1),
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
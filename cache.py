@@ -0,0 +1,195 @@
+"""Caching helpers: a thread-safe in-memory LRU and a SQLite-backed result store."""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger('storyboard.cache')
+
+
+def content_hash(*parts):
+    """Return a stable SHA-256 hex digest of the given bytes/str parts"""
+    return extend_hash(hashlib.sha256(), *parts)
+
+
+def extend_hash(digest, *parts):
+    """Feed more parts into a hashlib digest the way content_hash does and return the hex digest"""
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """Size-bounded least-recently-used cache with optional TTL and hit/miss counters
+
+    max_size bounds the number of entries; max_bytes optionally also bounds the
+    total length of bytes/str values (e.g. rendered images).
+    """
+
+    def __init__(self, max_size=256, ttl=None, max_bytes=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, stored_at, size = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        size = len(value) if isinstance(value, (bytes, str)) else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._data[key] = (value, time.time(), size)
+            self.bytes += size
+            while len(self._data) > self.max_size or (self.max_bytes and self.bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        data = {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+        }
+        if self.max_bytes:
+            data['bytes'] = self.bytes
+            data['max_bytes'] = self.max_bytes
+        return data
+
+
+class ResultCache:
+    """In-memory LRU in front of an on-disk SQLite store of JSON results.
+
+    Entries older than ``ttl`` seconds are ignored and purged, and the disk
+    store is trimmed to ``max_disk_entries`` least-recently-used rows.
+    Pass ``path=None`` to keep the cache in memory only.
+    """
+
+    def __init__(self, path=None, max_memory_entries=128, max_disk_entries=10000, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.memory = LRUCache(max_size=max_memory_entries, ttl=ttl)
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS results ('
+                    'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                    'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+                )
+                self._conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results(accessed_at)')
+                self._conn.commit()
+            except sqlite3.Error as e:
+                log.warning("Result cache disk store unavailable (%s): %s", path, e)
+                self._conn = None
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self._conn is None:
+            return value
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT value, created_at FROM results WHERE key = ?', (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if self.ttl and now - row[1] > self.ttl:
+                    self._conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self._conn.commit()
+                    return None
+                self._conn.execute('UPDATE results SET accessed_at = ? WHERE key = ?', (now, key))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            log.warning("Result cache read failed: %s", e)
+            return None
+        value = json.loads(row[0])
+        self.disk_hits += 1
+        self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self._conn is None:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO results (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(value), now, now)
+                )
+                self._evict(now)
+                self._conn.commit()
+        except sqlite3.Error as e:
+            log.warning("Result cache write failed: %s", e)
+
+    def _evict(self, now):
+        if self.ttl:
+            self._conn.execute('DELETE FROM results WHERE created_at < ?', (now - self.ttl,))
+        if self.max_disk_entries:
+            self._conn.execute(
+                'DELETE FROM results WHERE key IN ('
+                'SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_disk_entries,)
+            )
+
+    def stats(self):
+        data = self.memory.stats()
+        data['disk_hits'] = self.disk_hits
+        if self._conn is not None:
+            with self._lock:
+                data['disk_size'] = self._conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return data
@@ -0,0 +1,152 @@
+"""Map-reduce helpers for documents too long for a single LLM prompt.
+
+Extracted pages are packed into chunks on page/section boundaries, step
+extraction runs on the chunks with bounded concurrency, and the partial step
+lists are merged (and, if still too long, consolidated by further LLM calls)
+before flowchart generation.
+"""
+import asyncio
+import contextvars
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Blank lines or heading-like lines ("3. Procedure", "SAFETY", "Step 4:") start a new section
+_SECTION_BREAK = re.compile(r'\n\s*\n|\n(?=\s*(?:\d+[.)]\s+[A-Z]|[A-Z][A-Z &/-]{3,}\n|Step\s+\d+))')
+_STEP_PREFIX = re.compile(r'^\s*(?:[-*•]|\d+[.)]|step\s+\d+[:.)]?)\s*', re.IGNORECASE)
+
+
+def _split_oversized(text, max_chars):
+    """Split a single page that exceeds max_chars on section, line, then hard boundaries"""
+    pieces = []
+    for section in _SECTION_BREAK.split(text):
+        if len(section) <= max_chars:
+            pieces.append(section)
+            continue
+        current = ''
+        for line in section.split('\n'):
+            while len(line) > max_chars:
+                if current:
+                    pieces.append(current)
+                    current = ''
+                pieces.append(line[:max_chars])
+                line = line[max_chars:]
+            if current and len(current) + len(line) + 1 > max_chars:
+                pieces.append(current)
+                current = line
+            else:
+                current = f'{current}\n{line}' if current else line
+        if current:
+            pieces.append(current)
+    return [piece for piece in pieces if piece.strip()]
+
+
+def split_into_chunks(pages, max_chars=6000):
+    """Pack page texts into chunks of at most max_chars, keeping pages whole where possible"""
+    chunks = []
+    current = []
+    size = 0
+    for page in pages:
+        page = (page or '').strip()
+        if not page:
+            continue
+        parts = [page] if len(page) <= max_chars else _split_oversized(page, max_chars)
+        for part in parts:
+            if current and size + len(part) + 1 > max_chars:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            current.append(part)
+            size += len(part) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+def map_chunks(func, chunks, max_concurrency=4):
+    """Apply func to every chunk with at most max_concurrency calls in flight, keeping order"""
+    if len(chunks) <= 1 or max_concurrency <= 1:
+        return [func(chunk) for chunk in chunks]
+    # Each call runs in its own copy of the caller's context, keeping the
+    # request and job IDs on log records from the pool threads
+    contexts = [contextvars.copy_context() for _ in chunks]
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+        return list(executor.map(lambda context, chunk: context.run(func, chunk), contexts, chunks))
+
+
+async def map_chunks_async(func, chunks, max_concurrency=4):
+    """Await coroutine func on every chunk with at most max_concurrency in flight, keeping order"""
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(chunk):
+        async with semaphore:
+            return await func(chunk)
+
+    return await asyncio.gather(*(run(chunk) for chunk in chunks))
+
+
+def _step_key(line):
+    return ' '.join(_STEP_PREFIX.sub('', line).lower().split())
+
+
+def merge_step_lists(partials):
+    """Concatenate partial step lists in document order, dropping repeated steps"""
+    seen = set()
+    merged = []
+    for index, partial in enumerate(partials, 1):
+        if not partial:
+            continue
+        lines = []
+        for line in partial.strip().split('\n'):
+            key = _step_key(line)
+            if key and len(key) > 3:
+                # Safety briefings and cleanup are often repeated on every page
+                if key in seen:
+                    continue
+                seen.add(key)
+            lines.append(line.rstrip())
+        if any(line.strip() for line in lines):
+            merged.append(f'Part {index}:\n' + '\n'.join(lines).strip())
+    return '\n\n'.join(merged)
+
+
+def reduce_step_lists(partials, consolidate, max_chars=8000, max_concurrency=4, max_rounds=4):
+    """Merge partial step lists, consolidating groups with consolidate(text) until they fit
+
+    consolidate is an LLM call that turns several partial procedures into a
+    single shorter one and returns None on failure. Groups are consolidated
+    concurrently; if a round does not shrink the text, the merged text is
+    truncated to max_chars as a last resort.
+    """
+    partials = [partial for partial in partials if partial]
+    merged = merge_step_lists(partials)
+    for _ in range(max_rounds):
+        if len(merged) <= max_chars or len(partials) <= 1:
+            break
+        groups = split_into_chunks(partials, max_chars)
+        reduced = map_chunks(consolidate, groups, max_concurrency)
+        reduced = [r if r else g for r, g in zip(reduced, groups)]
+        next_merged = merge_step_lists(reduced)
+        if len(next_merged) >= len(merged):
+            break
+        partials, merged = reduced, next_merged
+    if len(merged) > max_chars:
+        merged = merged[:max_chars] + '...'
+    return merged
+
+
+async def reduce_step_lists_async(partials, consolidate, max_chars=8000, max_concurrency=4, max_rounds=4):
+    """reduce_step_lists for a coroutine consolidate(text)"""
+    partials = [partial for partial in partials if partial]
+    merged = merge_step_lists(partials)
+    for _ in range(max_rounds):
+        if len(merged) <= max_chars or len(partials) <= 1:
+            break
+        groups = split_into_chunks(partials, max_chars)
+        reduced = await map_chunks_async(consolidate, groups, max_concurrency)
+        reduced = [r if r else g for r, g in zip(reduced, groups)]
+        next_merged = merge_step_lists(reduced)
+        if len(next_merged) >= len(merged):
+            break
+        partials, merged = reduced, next_merged
+    if len(merged) > max_chars:
+        merged = merged[:max_chars] + '...'
+    return merged
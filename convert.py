@@ -0,0 +1,174 @@
+"""Convert a directory of storyboard PDFs to Mermaid (.mmd) files from the command line.
+
+Uses the same extraction, xAI and Mermaid post-processing pipeline as the web
+app. Progress is recorded in a manifest in the output directory, so running the
+same command again after an interruption only converts the files that are
+missing, failed or changed.
+
+    python convert.py storyboards/ -o flowcharts/ --workers 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Only warnings from the pipeline; progress is printed below
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_FORMAT', 'text')
+
+import app  # noqa: E402
+from cache import content_hash  # noqa: E402
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def find_pdfs(input_dir, recursive=False):
+    """Relative paths of the PDFs in input_dir, sorted"""
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        paths.extend(os.path.relpath(os.path.join(root, name), input_dir)
+                     for name in files if name.lower().endswith('.pdf'))
+        if not recursive:
+            break
+    return sorted(paths)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Ignoring unreadable manifest {path}: {e}")
+        return {}
+
+
+def save_manifest(path, manifest):
+    # Write-then-rename so an interrupted run never leaves a truncated manifest
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def output_path(output_dir, relative_path):
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + '.mmd')
+
+
+def convert_file(pdf_path, mmd_path, mode=None):
+    """Convert one PDF and write its Mermaid code; returns a manifest entry"""
+    started = time.perf_counter()
+    tokens_before = app.llm_limiter.stats()['used_tokens']
+    with open(pdf_path, 'rb') as f:
+        pdf_bytes = f.read()
+    entry = {'sha256': content_hash(pdf_bytes), 'output': mmd_path}
+    try:
+        mode = mode or app.PIPELINE_MODE
+        result = app.result_cache.get(app.result_cache_key(pdf_bytes, mode))
+        entry['cached'] = result is not None
+        if result is None:
+            result = app.generate_flowchart(pdf_bytes, mode=mode)
+        os.makedirs(os.path.dirname(mmd_path) or '.', exist_ok=True)
+        with open(mmd_path, 'w') as f:
+            f.write(result['mermaid_code'] + '\n')
+        entry['status'] = 'done'
+    except Exception as e:
+        entry['status'] = 'failed'
+        entry['error'] = str(e)
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    # Exact per file in process mode; threads share the counter, so the
+    # run total is taken from the limiter instead
+    entry['tokens'] = app.llm_limiter.stats()['used_tokens'] - tokens_before
+    return entry
+
+
+def is_complete(entry, pdf_path):
+    """True if the manifest says pdf_path was converted and neither side changed since"""
+    if not entry or entry.get('status') != 'done' or not os.path.exists(entry.get('output', '')):
+        return False
+    with open(pdf_path, 'rb') as f:
+        return content_hash(f.read()) == entry.get('sha256')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert storyboard PDFs to Mermaid flowcharts')
+    parser.add_argument('input_dir', help='Directory containing PDF files')
+    parser.add_argument('-o', '--output-dir', help='Where to write .mmd files (default: input_dir)')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Files converted at once (default: 4)')
+    parser.add_argument('--processes', action='store_true',
+                        help='Use worker processes instead of threads (each process has its own xAI limits)')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Include PDFs in subdirectories')
+    parser.add_argument('--mode', choices=app.PIPELINE_MODES, default=app.PIPELINE_MODE, help='Pipeline mode')
+    parser.add_argument('--force', action='store_true', help='Convert every file, ignoring the manifest')
+    args = parser.parse_args(argv)
+
+    output_dir = args.output_dir or args.input_dir
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {} if args.force else load_manifest(manifest_path)
+
+    pdfs = find_pdfs(args.input_dir, args.recursive)
+    pending = [path for path in pdfs
+               if not is_complete(manifest.get(path), os.path.join(args.input_dir, path))]
+    print(f"📄 {len(pdfs)} PDFs found, {len(pdfs) - len(pending)} already converted, {len(pending)} to go")
+    if not pending:
+        return 0
+
+    if not app.client:
+        print("❌ xAI client not initialized - set XAI_API_KEY")
+        return 1
+
+    if args.processes:
+        # Spawned, not forked: each worker imports app itself, so it opens its own
+        # cache connections and starts its own pipeline threads instead of
+        # inheriting this process's mid-use SQLite handles and dead threads
+        executor = ProcessPoolExecutor(max_workers=max(1, args.workers),
+                                       mp_context=multiprocessing.get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    lock = threading.Lock()
+    started = time.perf_counter()
+    tokens_before = app.llm_limiter.stats()['used_tokens']
+    converted = failed = process_tokens = 0
+
+    with executor:
+        futures = {
+            executor.submit(convert_file, os.path.join(args.input_dir, path),
+                            output_path(output_dir, path), args.mode): path
+            for path in pending
+        }
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                entry = future.result()
+                with lock:
+                    manifest[path] = entry
+                    save_manifest(manifest_path, manifest)
+                process_tokens += entry['tokens']
+                if entry['status'] == 'done':
+                    converted += 1
+                    print(f"✅ [{done}/{len(pending)}] {path} ({entry['seconds']}s)")
+                else:
+                    failed += 1
+                    print(f"❌ [{done}/{len(pending)}] {path}: {entry['error']}")
+        except KeyboardInterrupt:
+            print("⏹️  Interrupted - completed files are in the manifest, rerun to resume")
+            for future in futures:
+                future.cancel()
+            raise
+
+    elapsed = time.perf_counter() - started
+    tokens = process_tokens if args.processes else app.llm_limiter.stats()['used_tokens'] - tokens_before
+    minutes = elapsed / 60 or 1e-9
+    print(f"🎉 Converted {converted} files, {failed} failed in {elapsed:.1f}s")
+    print(f"📊 Throughput: {converted / minutes:.1f} docs/min, {tokens / minutes:.0f} tokens/min ({tokens} tokens)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
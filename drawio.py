@@ -0,0 +1,115 @@
+"""draw.io (mxGraph) export of flowcharts.
+
+Node positions come from the same layered layout as the SVG renderer, so the
+diagram opens ready-arranged. draw.io also accepts a diagram in the URL
+fragment as ``#R<payload>``: the XML percent-encoded like encodeURIComponent,
+raw-deflated and base64-encoded.
+"""
+import base64
+import html
+import urllib.parse
+import zlib
+from xml.sax.saxutils import quoteattr
+
+from render import NODE_FILL, NODE_STROKE, SUBGRAPH_FILL, SUBGRAPH_STROKE, layout
+
+DRAWIO_URL = 'https://app.diagrams.net/'
+
+_BASE_STYLE = f'whiteSpace=wrap;html=1;fillColor={NODE_FILL};strokeColor={NODE_STROKE};'
+
+SHAPE_STYLES = {
+    'rect': 'rounded=0;',
+    'round': 'rounded=1;',
+    'stadium': 'rounded=1;arcSize=50;',
+    'diamond': 'rhombus;',
+    'circle': 'ellipse;aspect=fixed;',
+    'double_circle': 'ellipse;shape=doubleEllipse;aspect=fixed;',
+    'hexagon': 'shape=hexagon;perimeter=hexagonPerimeter2;fixedSize=1;',
+    'subroutine': 'shape=process;',
+    'cylinder': 'shape=cylinder3;boundedLbl=1;size=6;',
+    'parallelogram': 'shape=parallelogram;perimeter=parallelogramPerimeter;fixedSize=1;',
+    'parallelogram_alt': 'shape=parallelogram;perimeter=parallelogramPerimeter;fixedSize=1;flipH=1;',
+    'trapezoid': 'shape=trapezoid;perimeter=trapezoidPerimeter;fixedSize=1;',
+    'trapezoid_alt': 'shape=trapezoid;perimeter=trapezoidPerimeter;fixedSize=1;flipV=1;',
+    'asymmetric': 'shape=step;perimeter=stepPerimeter;fixedSize=1;',
+}
+
+_END_ARROWS = {'>': 'classic', 'o': 'oval', 'x': 'cross'}
+
+
+def _edge_style(kind):
+    style = 'edgeStyle=none;html=1;rounded=0;'
+    if '.' in kind:
+        style += 'dashed=1;'
+    if '=' in kind:
+        style += 'strokeWidth=3;'
+    style += f"endArrow={_END_ARROWS.get(kind[-1], 'none')};"
+    if kind.startswith('<'):
+        style += 'startArrow=classic;'
+    return style
+
+
+def _value(label):
+    # html=1 cells hold HTML, which is then stored in an XML attribute
+    return quoteattr(html.escape(label or ''))
+
+
+def _geometry(x, y, width, height):
+    return f'<mxGeometry x="{x:.0f}" y="{y:.0f}" width="{width:.0f}" height="{height:.0f}" as="geometry"/>'
+
+
+def to_drawio_xml(chart, name='Flowchart'):
+    """mxfile XML (uncompressed) for a Flowchart, with computed positions"""
+    result = layout(chart)
+    cells = ['<mxCell id="0"/>', '<mxCell id="1" parent="0"/>']
+
+    # Subgraph frames first so they sit behind their nodes
+    for index, (subgraph, x, y, width, height) in enumerate(result.subgraphs):
+        style = (f'rounded=0;whiteSpace=wrap;html=1;verticalAlign=top;'
+                 f'fillColor={SUBGRAPH_FILL};strokeColor={SUBGRAPH_STROKE};')
+        cells.append(f'<mxCell id="subgraph-{index}" value={_value(subgraph.label or subgraph.id)} '
+                     f'style="{style}" vertex="1" parent="1">{_geometry(x, y, width, height)}</mxCell>')
+
+    cell_ids = {}
+    for index, (node_id, node) in enumerate(chart.nodes.items()):
+        box = result.boxes[node_id]
+        cell_ids[node_id] = f'node-{index}'
+        style = SHAPE_STYLES.get(node.shape, SHAPE_STYLES['rect']) + _BASE_STYLE
+        geometry = _geometry(box.x - box.width / 2, box.y - box.height / 2, box.width, box.height)
+        cells.append(f'<mxCell id="node-{index}" value={_value(node.label or node.id)} '
+                     f'style="{style}" vertex="1" parent="1">{geometry}</mxCell>')
+
+    for index, (edge, points) in enumerate(result.edges):
+        # Inner points of the route (around long edges' dummy nodes) become waypoints
+        waypoints = ''.join(f'<mxPoint x="{x:.0f}" y="{y:.0f}"/>' for x, y in points[1:-1])
+        geometry = '<mxGeometry relative="1" as="geometry">'
+        if waypoints:
+            geometry += f'<Array as="points">{waypoints}</Array>'
+        geometry += '</mxGeometry>'
+        cells.append(f'<mxCell id="edge-{index}" value={_value(edge.label)} style="{_edge_style(edge.kind)}" '
+                     f'edge="1" parent="1" source="{cell_ids[edge.source]}" target="{cell_ids[edge.target]}">'
+                     f'{geometry}</mxCell>')
+
+    model = (f'<mxGraphModel dx="{result.width:.0f}" dy="{result.height:.0f}" grid="1" gridSize="10" '
+             f'guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="0" pageScale="1" '
+             f'math="0" shadow="0"><root>{"".join(cells)}</root></mxGraphModel>')
+    return (f'<mxfile host="storyboard-generator"><diagram id="flowchart" name={quoteattr(name)}>'
+            f'{model}</diagram></mxfile>')
+
+
+def compress_drawio(xml):
+    """draw.io's Graph.compress: encodeURIComponent, raw deflate, base64"""
+    encoded = urllib.parse.quote(xml, safe="-_.!~*'()").encode('ascii')
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    return base64.b64encode(compressor.compress(encoded) + compressor.flush()).decode('ascii')
+
+
+def decompress_drawio(payload):
+    """Inverse of compress_drawio"""
+    data = zlib.decompress(base64.b64decode(payload), -15)
+    return urllib.parse.unquote(data.decode('ascii'))
+
+
+def drawio_url(xml):
+    """app.diagrams.net URL that opens the diagram directly"""
+    return f'{DRAWIO_URL}#R{compress_drawio(xml)}'
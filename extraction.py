@@ -0,0 +1,423 @@
+"""Page-parallel PDF text extraction with pluggable backends.
+
+Text extraction is CPU-bound, so large documents are split into page batches
+handled by a process pool. Pages are yielded in order as soon as their batch
+is done, results are cached per page by a hash of the page's content stream,
+and iteration stops early once a character budget is reached so we never
+parse pages we are not going to use.
+
+Several extraction libraries are supported (PyPDF2, pypdf, pdfminer.six,
+pypdfium2); with backend='auto' a quick benchmark on a generated sample PDF
+picks the fastest one that is installed, on the first extraction rather than
+when the extractor is created.
+
+A PDF is given either as bytes or as a file path. Files are memory-mapped for
+the parsers and handed to worker processes by path, so large uploads spooled
+to disk are never copied into memory as a whole.
+"""
+import hashlib
+import importlib.util
+import logging
+import mmap
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+
+import PyPDF2
+
+from cache import LRUCache
+from metrics import pdf_extract_seconds
+
+# pdfminer logs every content stream operator at DEBUG level
+logging.getLogger('pdfminer').setLevel(logging.WARNING)
+log = logging.getLogger('storyboard.extraction')
+
+
+@contextmanager
+def open_pdf(pdf):
+    """Seekable binary stream over a PDF given as bytes or as a file path (memory-mapped)"""
+    if isinstance(pdf, (bytes, bytearray)):
+        yield BytesIO(pdf)
+        return
+    with open(pdf, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+
+class PdfBackend:
+    """Base class for text extraction backends; subclasses implement page_texts"""
+    name = None
+    module = None
+
+    def available(self):
+        return importlib.util.find_spec(self.module) is not None
+
+    def page_texts(self, pdf, indices):
+        """Return the text of each page index (an empty string for unreadable pages)"""
+        raise NotImplementedError
+
+
+class PyPDF2Backend(PdfBackend):
+    name = 'pypdf2'
+    module = 'PyPDF2'
+
+    def _reader(self, stream):
+        return PyPDF2.PdfReader(stream)
+
+    def page_texts(self, pdf, indices):
+        texts = []
+        with open_pdf(pdf) as stream:
+            reader = self._reader(stream)
+            for index in indices:
+                try:
+                    texts.append(reader.pages[index].extract_text() or '')
+                except Exception as e:
+                    log.warning("Error extracting text from PDF page %d: %s", index + 1, e)
+                    texts.append('')
+        return texts
+
+
+class PypdfBackend(PyPDF2Backend):
+    name = 'pypdf'
+    module = 'pypdf'
+
+    def _reader(self, stream):
+        import pypdf
+        return pypdf.PdfReader(stream)
+
+
+class PdfminerBackend(PdfBackend):
+    name = 'pdfminer'
+    module = 'pdfminer'
+
+    def page_texts(self, pdf, indices):
+        from pdfminer.converter import TextConverter
+        from pdfminer.layout import LAParams
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdfparser import PDFParser
+
+        wanted = set(indices)
+        last = max(indices)
+        texts = {}
+        manager = PDFResourceManager()
+        with open_pdf(pdf) as stream:
+            document = PDFDocument(PDFParser(stream))
+            for index, page in enumerate(PDFPage.create_pages(document)):
+                if index > last:
+                    break
+                if index not in wanted:
+                    continue
+                output = StringIO()
+                device = TextConverter(manager, output, laparams=LAParams())
+                try:
+                    PDFPageInterpreter(manager, device).process_page(page)
+                    texts[index] = output.getvalue().rstrip('\x0c')
+                except Exception as e:
+                    log.warning("Error extracting text from PDF page %d: %s", index + 1, e)
+                    texts[index] = ''
+                finally:
+                    device.close()
+        return [texts.get(index, '') for index in indices]
+
+
+class PdfiumBackend(PdfBackend):
+    name = 'pypdfium2'
+    module = 'pypdfium2'
+    # PDFium is not thread-safe: concurrent jobs extracting in the same process
+    # crash it. Pool workers are separate processes, so batches stay parallel
+    _lock = threading.Lock()
+
+    def page_texts(self, pdf, indices):
+        import pypdfium2
+
+        with self._lock:
+            # PDFium reads a path itself, loading pages on demand
+            document = pypdfium2.PdfDocument(pdf)
+            texts = []
+            try:
+                for index in indices:
+                    try:
+                        page = document[index]
+                        text_page = page.get_textpage()
+                        texts.append(text_page.get_text_range().replace('\r\n', '\n'))
+                        text_page.close()
+                        page.close()
+                    except Exception as e:
+                        log.warning("Error extracting text from PDF page %d: %s", index + 1, e)
+                        texts.append('')
+            finally:
+                document.close()
+        return texts
+
+
+BACKENDS = {}
+
+
+def register_backend(backend):
+    """Make an extraction backend selectable by name"""
+    BACKENDS[backend.name] = backend
+
+
+for _backend in (PyPDF2Backend(), PypdfBackend(), PdfminerBackend(), PdfiumBackend()):
+    register_backend(_backend)
+
+
+def available_backends():
+    return [name for name, backend in BACKENDS.items() if backend.available()]
+
+
+def _escape_pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def make_sample_pdf(pages):
+    """Build a minimal text-only PDF with one page per string (lines split on newlines)"""
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages))), len(pages))).encode('latin-1'),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i, text in enumerate(pages):
+        lines = ' '.join(f'({_escape_pdf_text(line)}) Tj T*' for line in text.split('\n'))
+        stream = f'BT /F1 10 Tf 40 760 Td 12 TL {lines} ET'.encode('latin-1', 'replace')
+        objects.append((
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>'
+        ).encode('latin-1'))
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+    output = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(output)
+
+
+def benchmark_backends(names=None, sample_pages=10):
+    """Time each available backend on a generated sample PDF; returns {name: seconds}"""
+    sample = make_sample_pdf([
+        '\n'.join(f'Sample step {line} on page {page}: add 5 mL of solution and stir.' for line in range(40))
+        for page in range(sample_pages)
+    ])
+    indices = list(range(sample_pages))
+    timings = {}
+    for name in names or available_backends():
+        backend = BACKENDS[name]
+        try:
+            # Warm up first so one-off import costs do not skew the comparison
+            backend.page_texts(sample, indices[:1])
+            started = time.perf_counter()
+            texts = backend.page_texts(sample, indices)
+            elapsed = time.perf_counter() - started
+        except Exception as e:
+            log.warning("PDF backend %s failed the benchmark: %s", name, e)
+            continue
+        # A backend that returns no text is not a usable choice however fast it is
+        if all('Sample step' in text for text in texts):
+            timings[name] = elapsed
+    return timings
+
+
+def select_backend(preferred='auto'):
+    """Resolve 'auto' to the fastest installed backend, or validate an explicit choice"""
+    if preferred != 'auto':
+        if preferred in BACKENDS and BACKENDS[preferred].available():
+            return preferred, {}
+        log.warning("PDF backend '%s' is not available, selecting automatically", preferred)
+    timings = benchmark_backends()
+    if not timings:
+        return PyPDF2Backend.name, timings
+    fastest = min(timings, key=timings.get)
+    log.info("PDF backend benchmark: using %s", fastest,
+             extra={'benchmark_ms': {name: round(seconds * 1000) for name, seconds in timings.items()}})
+    return fastest, timings
+
+
+def _extract_pages(backend_name, pdf, indices):
+    """Extract the given page indices with a backend (runs in a worker process); returns (texts, seconds)"""
+    started = time.perf_counter()
+    texts = BACKENDS[backend_name].page_texts(pdf, indices)
+    return texts, time.perf_counter() - started
+
+
+def _stored_data(stream):
+    # The stream's bytes as stored in the file (usually compressed): hashing
+    # them identifies the content without decoding it
+    stream = stream.get_object()
+    data = getattr(stream, '_data', None)
+    return data if data is not None else stream.get_data()
+
+
+def page_fingerprint(page, backend_name=''):
+    """Hash of a page's content streams and font resources, or None if unavailable
+
+    Two pages with the same drawing operators and fonts extract to the same
+    text, which lets re-exported or partially edited PDFs reuse earlier work.
+    Streams are hashed as stored, without decompressing them.
+    """
+    try:
+        digest = hashlib.sha256()
+        digest.update(backend_name.encode('utf-8'))
+        contents = page.get('/Contents')
+        contents = contents.get_object() if contents is not None else []
+        for stream in (contents if isinstance(contents, list) else [contents]):
+            digest.update(_stored_data(stream))
+        resources = page.get('/Resources')
+        fonts = resources.get_object().get('/Font') if resources is not None else None
+        if fonts is not None:
+            fonts = fonts.get_object()
+            for name in sorted(fonts):
+                font = fonts[name].get_object()
+                digest.update(f"{name}:{font.get('/BaseFont')}:{font.get('/Encoding')}".encode('utf-8'))
+                to_unicode = font.get('/ToUnicode')
+                if to_unicode is not None:
+                    digest.update(_stored_data(to_unicode))
+        return digest.hexdigest()
+    except Exception:
+        return None
+
+
+def _pool_context():
+    # Not fork: the pool is started inside a server process whose job, logging
+    # and cache threads may hold locks that a forked child would inherit held.
+    # The fork server preloads only this module, not the app that started it
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class PageExtractor:
+    """Extracts PDF pages in order, in parallel for large documents, with a per-page cache"""
+
+    def __init__(self, backend='auto', workers=2, parallel_min_pages=16, pages_per_task=8, cache_size=2048):
+        self.preferred_backend = backend
+        self._backend = None
+        self.benchmark = {}
+        self._backend_lock = threading.Lock()
+        self.workers = workers
+        self.parallel_min_pages = parallel_min_pages
+        self.pages_per_task = pages_per_task
+        self.page_cache = LRUCache(max_size=cache_size)
+        self._pool = None
+        self._pool_failed = False
+        self._timings = {}
+        self._timings_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        """The backend in use, benchmarked on first access when 'auto'"""
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend, self.benchmark = select_backend(self.preferred_backend)
+        return self._backend
+
+    def _record(self, pages, seconds):
+        pdf_extract_seconds.observe(seconds, backend=self.backend)
+        with self._timings_lock:
+            timing = self._timings.setdefault(self.backend, {'calls': 0, 'pages': 0, 'seconds': 0.0})
+            timing['calls'] += 1
+            timing['pages'] += pages
+            timing['seconds'] += seconds
+
+    def _extract_local(self, pdf, indices):
+        texts, seconds = _extract_pages(self.backend, pdf, indices)
+        self._record(len(indices), seconds)
+        return texts
+
+    def _get_pool(self):
+        # Some platforms (e.g. serverless sandboxes) cannot start processes;
+        # fall back to in-process extraction there
+        if self._pool is None and not self._pool_failed and self.workers > 1:
+            try:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+            except (OSError, NotImplementedError) as e:
+                log.warning("PDF extraction process pool unavailable, extracting in-process: %s", e)
+                self._pool_failed = True
+        return self._pool
+
+    def _extract_batch(self, pdf, indices, pool):
+        if pool is None or len(indices) == 1:
+            return self._extract_local(pdf, indices)
+        size = -(-len(indices) // self.workers)
+        batches = [indices[i:i + size] for i in range(0, len(indices), size)]
+        try:
+            # A path is sent to the workers instead of the whole file
+            futures = [pool.submit(_extract_pages, self.backend, pdf, batch) for batch in batches]
+            texts = []
+            for batch, future in zip(batches, futures):
+                batch_texts, seconds = future.result()
+                self._record(len(batch), seconds)
+                texts.extend(batch_texts)
+            return texts
+        except Exception as e:
+            log.warning("Parallel PDF extraction failed, extracting in-process: %s", e)
+            self._pool = None
+            self._pool_failed = True
+            return self._extract_local(pdf, indices)
+
+    def iter_pages(self, pdf, max_chars=None):
+        """Yield the text of each page in order, stopping once max_chars have been yielded"""
+        # PyPDF2 only locates each page's streams for the cache key, whichever
+        # backend extracts the text; nothing is decoded
+        with open_pdf(pdf) as stream:
+            reader = PyPDF2.PdfReader(stream)
+            total = len(reader.pages)
+            pool = self._get_pool() if total >= self.parallel_min_pages else None
+            # Small documents are extracted one page at a time so early stop is exact
+            window = self.workers * self.pages_per_task if pool else 1
+            produced = 0
+            for start in range(0, total, window):
+                indices = list(range(start, min(start + window, total)))
+                keys = {index: page_fingerprint(reader.pages[index], self.backend) for index in indices}
+                texts = {}
+                for index in indices:
+                    if keys[index]:
+                        cached = self.page_cache.get(keys[index])
+                        if cached is not None:
+                            texts[index] = cached
+                missing = [index for index in indices if index not in texts]
+                if missing:
+                    for index, text in zip(missing, self._extract_batch(pdf, missing, pool)):
+                        texts[index] = text
+                        if keys[index]:
+                            self.page_cache.put(keys[index], text)
+                for index in indices:
+                    yield texts[index]
+                    produced += len(texts[index])
+                    if max_chars and produced >= max_chars:
+                        return
+
+    def extract_pages(self, pdf, max_chars=None):
+        """Return the list of page texts (pdf is bytes or a file path), or None if the PDF cannot be read"""
+        try:
+            return list(self.iter_pages(pdf, max_chars))
+        except Exception as e:
+            log.warning("Error extracting text from PDF: %s", e)
+            return None
+
+    def stats(self):
+        with self._timings_lock:
+            timings = {
+                name: dict(timing, ms_per_page=round(timing['seconds'] * 1000 / timing['pages'], 3) if timing['pages'] else 0.0)
+                for name, timing in self._timings.items()
+            }
+        return {
+            'backend': self._backend or self.preferred_backend,
+            'benchmark_ms': {name: round(seconds * 1000, 1) for name, seconds in self.benchmark.items()},
+            'backend_timings': timings,
+            'workers': self.workers,
+            'parallel': self._pool is not None,
+            'page_cache': self.page_cache.stats(),
+        }
@@ -0,0 +1,571 @@
+"""In-memory flowchart graph, Mermaid parsing and Mermaid serialization."""
+import re
+from dataclasses import dataclass, field
+
+# Mermaid node shape -> (opening, closing) delimiters
+SHAPES = {
+    'rect': ('[', ']'),
+    'round': ('(', ')'),
+    'stadium': ('([', '])'),
+    'circle': ('((', '))'),
+    'double_circle': ('(((', ')))'),
+    'diamond': ('{', '}'),
+    'hexagon': ('{{', '}}'),
+    'subroutine': ('[[', ']]'),
+    'cylinder': ('[(', ')]'),
+    'asymmetric': ('>', ']'),
+    'parallelogram': ('[/', '/]'),
+    'parallelogram_alt': ('[\\', '\\]'),
+    'trapezoid': ('[/', '\\]'),
+    'trapezoid_alt': ('[\\', '/]'),
+}
+
+SHAPE_ALIASES = {
+    'decision': 'diamond',
+    'rhombus': 'diamond',
+    'process': 'rect',
+    'step': 'rect',
+    'rectangle': 'rect',
+    'start': 'stadium',
+    'end': 'stadium',
+    'terminal': 'stadium',
+    'database': 'cylinder',
+    'io': 'parallelogram',
+}
+
+DIRECTIONS = ('TD', 'TB', 'BT', 'LR', 'RL')
+
+# Keywords that cannot be used as bare node IDs
+RESERVED_IDS = {'end', 'graph', 'flowchart', 'subgraph', 'style', 'class', 'classDef',
+                'click', 'linkStyle', 'direction', 'call', 'href'}
+
+# Statements kept verbatim: they style the chart but do not change the graph
+STYLE_KEYWORDS = ('classDef', 'class', 'style', 'linkStyle', 'click')
+
+_INVALID_ID_CHARS = re.compile(r'[^A-Za-z0-9_]')
+_SAFE_LABEL = re.compile(r'^[A-Za-z0-9 _.,?!\'-]*$')
+
+# Parser tokens, matched at the current position of a statement
+_HEADER = re.compile(r'(?:flowchart|graph)(?:\s+(\w+))?\s*;?\s*$')
+_SUBGRAPH = re.compile(r'subgraph(?:\s+(.*?))?\s*;?\s*$')
+_SUBGRAPH_TITLE = re.compile(r'(\w+)\s*\[\s*"?(.*?)"?\s*\]$')
+_DIRECTION = re.compile(r'direction\s+(\w+)\s*;?\s*$')
+_KEYWORD = re.compile(r'(\w+)\b')
+_WHITESPACE = re.compile(r'\s*')
+_NODE_ID = re.compile(r'\w+')
+_CSS_CLASS = re.compile(r':::(\w+)')
+# -->, --->, ---, -.->, -.-, ==>, ===, --o, --x, <-->, ...
+_LINK = re.compile(r'(<?)(-{2,}|={2,}|-\.+-)(>|[ox](?!\w))?')
+# "A -- text --> B" style links: opener, then the matching closer after the text
+_TEXT_LINK_OPEN = re.compile(r'(<?)(--|==|-\.)(?=\s)')
+_TEXT_LINK_CLOSE = {
+    '--': re.compile(r'\s(-{2,}>|-{3,}|--[ox](?!\w))'),
+    '==': re.compile(r'\s(={2,}>|={3,})'),
+    '-.': re.compile(r'\s(\.-+>|\.-+)'),
+}
+_EDGE_LABEL = re.compile(r'\|\s*("?)(.*?)\1\s*\|')
+# What can follow a node: the end of the statement, "&", a link or a CSS class
+_AFTER_NODE = re.compile(r'\s*(?:$|[;&<=-]|:::)')
+
+# Shape openings by first character, longest first so "((" is not read as "("
+_OPENINGS = {}
+for _opening in sorted({opening for opening, _ in SHAPES.values()}, key=len, reverse=True):
+    _OPENINGS.setdefault(_opening[0], []).append(_opening)
+_SHAPES_BY_OPENING = {}
+for _shape, (_opening, _closing) in SHAPES.items():
+    _SHAPES_BY_OPENING.setdefault(_opening, []).append((_closing, _shape))
+
+
+class MermaidSyntaxError(ValueError):
+    """A Mermaid flowchart statement that could not be parsed"""
+
+    def __init__(self, message, line_number=None, line=None):
+        super().__init__(f'line {line_number}: {message}' if line_number else message)
+        self.message = message
+        self.line_number = line_number
+        self.line = line
+
+
+def normalize_id(raw_id):
+    """Turn an arbitrary identifier into a valid Mermaid node ID"""
+    node_id = _INVALID_ID_CHARS.sub('_', str(raw_id).strip())
+    if not node_id or not node_id[0].isalpha():
+        node_id = 'N' + node_id
+    if node_id in RESERVED_IDS:
+        node_id = node_id.capitalize() + '_'
+    return node_id
+
+
+def quote_label(label):
+    """Quote a label when it contains characters Mermaid would misparse"""
+    label = ' '.join(str(label).split())
+    if _SAFE_LABEL.match(label):
+        return label
+    return '"' + label.replace('"', '#quot;') + '"'
+
+
+@dataclass
+class Node:
+    id: str
+    label: str = ''
+    shape: str = 'rect'
+
+    def to_mermaid(self):
+        if not self.label and self.shape == 'rect':
+            return self.id
+        opening, closing = SHAPES.get(self.shape, SHAPES['rect'])
+        return f'{self.id}{opening}{quote_label(self.label or self.id)}{closing}'
+
+
+@dataclass
+class Edge:
+    source: str
+    target: str
+    label: str = ''
+    kind: str = '-->'
+
+    def to_mermaid(self):
+        if self.label:
+            return f'{self.source} {self.kind}|{quote_label(self.label)}| {self.target}'
+        return f'{self.source} {self.kind} {self.target}'
+
+
+@dataclass
+class Subgraph:
+    id: str
+    label: str = ''
+    nodes: list = field(default_factory=list)
+    parent: str = None
+    direction: str = None
+
+
+@dataclass
+class Flowchart:
+    direction: str = 'TD'
+    nodes: dict = field(default_factory=dict)
+    edges: list = field(default_factory=list)
+    subgraphs: dict = field(default_factory=dict)
+    styles: list = field(default_factory=list)
+
+    def add_node(self, node_id, label='', shape=None):
+        """Add a node, or fill in the label/shape of an existing one"""
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self.nodes[node_id] = Node(node_id, label, shape or 'rect')
+        else:
+            if label:
+                node.label = label
+            if shape:
+                node.shape = shape
+        return node
+
+    def add_edge(self, source, target, label='', kind='-->'):
+        self.add_node(source)
+        self.add_node(target)
+        edge = Edge(source, target, label, kind)
+        self.edges.append(edge)
+        return edge
+
+    def _subgraph_lines(self, subgraph, indent):
+        title = f'{subgraph.id}[{quote_label(subgraph.label)}]' if subgraph.label else subgraph.id
+        lines = [f'{indent}subgraph {title}']
+        if subgraph.direction:
+            lines.append(f'{indent}    direction {subgraph.direction}')
+        lines.extend(f'{indent}    {self.nodes[node_id].to_mermaid()}'
+                     for node_id in subgraph.nodes if node_id in self.nodes)
+        for child in self.subgraphs.values():
+            if child.parent == subgraph.id:
+                lines.extend(self._subgraph_lines(child, indent + '    '))
+        lines.append(f'{indent}end')
+        return lines
+
+    def to_mermaid(self):
+        """Serialize the graph to Mermaid flowchart syntax"""
+        lines = [f'flowchart {self.direction}']
+        grouped = {node_id for subgraph in self.subgraphs.values() for node_id in subgraph.nodes}
+        # Bare references to a subgraph (e.g. "A --> Prep") are not nodes of their own
+        lines.extend('    ' + node.to_mermaid() for node in self.nodes.values()
+                     if node.id not in grouped and not (node.id in self.subgraphs and node.to_mermaid() == node.id))
+        for subgraph in self.subgraphs.values():
+            if subgraph.parent is None:
+                lines.extend(self._subgraph_lines(subgraph, '    '))
+        lines.extend('    ' + edge.to_mermaid() for edge in self.edges)
+        lines.extend('    ' + style for style in self.styles)
+        return '\n'.join(lines)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a flowchart from {"nodes": [...], "edges": [...]} as returned by the LLM"""
+        direction = str(data.get('direction', 'TD')).upper()
+        chart = cls(direction=direction if direction in DIRECTIONS else 'TD')
+        ids = {}
+        for raw in data.get('nodes') or []:
+            if not isinstance(raw, dict) or raw.get('id') in (None, ''):
+                continue
+            node_id = ids.setdefault(str(raw['id']), normalize_id(raw['id']))
+            chart.add_node(node_id, str(raw.get('label') or ''), _shape_of(raw))
+        for raw in data.get('edges') or []:
+            if not isinstance(raw, dict):
+                continue
+            source = raw.get('from', raw.get('source'))
+            target = raw.get('to', raw.get('target'))
+            if source in (None, '') or target in (None, ''):
+                continue
+            source = ids.setdefault(str(source), normalize_id(source))
+            target = ids.setdefault(str(target), normalize_id(target))
+            chart.add_edge(source, target, str(raw.get('label') or ''))
+        return chart
+
+    def remove_node(self, node_id):
+        """Remove a node with its edges, subgraph membership and styles"""
+        if self.nodes.pop(node_id, None) is None:
+            return False
+        self.edges = [edge for edge in self.edges if node_id not in (edge.source, edge.target)]
+        for subgraph in self.subgraphs.values():
+            if node_id in subgraph.nodes:
+                subgraph.nodes.remove(node_id)
+        self.styles = [style for style in self.styles if node_id not in style.replace(',', ' ').split()[1:]]
+        return True
+
+    def apply_patch(self, patch):
+        """Apply {"remove_nodes", "nodes", "remove_edges", "edges"} changes as returned by the LLM
+
+        "nodes" adds nodes or relabels existing ones (keeping their shape unless
+        one is given) and "edges" adds edges that are not there yet. IDs are
+        normalized like in from_dict, so existing IDs refer to existing nodes.
+        Returns the number of changes applied.
+        """
+        applied = 0
+        for raw in _patch_list(patch, 'remove_nodes'):
+            if raw not in (None, '') and not isinstance(raw, (dict, list)):
+                applied += self.remove_node(normalize_id(raw))
+        for raw in _patch_list(patch, 'remove_edges'):
+            ends = _edge_ends(raw)
+            if ends:
+                before = len(self.edges)
+                self.edges = [edge for edge in self.edges if (edge.source, edge.target) != ends]
+                applied += before - len(self.edges)
+        for raw in _patch_list(patch, 'nodes'):
+            if not isinstance(raw, dict) or raw.get('id') in (None, ''):
+                continue
+            shape = _shape_of(raw) if raw.get('shape') else None
+            self.add_node(normalize_id(raw['id']), str(raw.get('label') or ''), shape)
+            applied += 1
+        existing = {(edge.source, edge.target, edge.label) for edge in self.edges}
+        for raw in _patch_list(patch, 'edges'):
+            ends = _edge_ends(raw)
+            label = str(raw.get('label') or '') if ends else ''
+            if ends and ends + (label,) not in existing:
+                self.add_edge(*ends, label)
+                existing.add(ends + (label,))
+                applied += 1
+        return applied
+
+
+def _shape_of(raw):
+    shape = str(raw.get('shape') or 'rect').lower()
+    shape = SHAPE_ALIASES.get(shape, shape)
+    return shape if shape in SHAPES else 'rect'
+
+
+def _patch_list(patch, name):
+    items = patch.get(name)
+    return items if isinstance(items, list) else []
+
+
+def _edge_ends(raw):
+    """(source, target) IDs of an LLM edge {"from", "to"}, or None"""
+    if not isinstance(raw, dict):
+        return None
+    source = raw.get('from', raw.get('source'))
+    target = raw.get('to', raw.get('target'))
+    if source in (None, '') or target in (None, ''):
+        return None
+    return normalize_id(source), normalize_id(target)
+
+
+class _StatementParser:
+    """Parses node/link statements of one line into a chart, left to right in a single pass"""
+
+    def __init__(self, chart, subgraph_stack, line, line_number, lenient, overwritten=None):
+        self.chart = chart
+        self.subgraph_stack = subgraph_stack
+        self.line = line
+        self.line_number = line_number
+        self.lenient = lenient
+        # node ID -> (label, shape) before this statement changed it, for a rollback
+        self.overwritten = overwritten if overwritten is not None else {}
+        self.pos = 0
+        # closing delimiter -> its next index (or -1), so labels are found in one scan
+        self._next_closing = {}
+
+    def error(self, message):
+        return MermaidSyntaxError(message, self.line_number, self.line)
+
+    def skip_space(self):
+        self.pos = _WHITESPACE.match(self.line, self.pos).end()
+
+    def parse(self):
+        """Parse every ;-separated statement on the line"""
+        while True:
+            self.skip_space()
+            if self.pos >= len(self.line):
+                return
+            self.parse_chain()
+            self.skip_space()
+            if self.pos < len(self.line):
+                if self.line[self.pos] != ';':
+                    raise self.error(f"unexpected '{self.line[self.pos:self.pos + 10]}'")
+                self.pos += 1
+
+    def parse_chain(self):
+        """node_group (link node_group)*"""
+        sources = self.parse_node_group()
+        while True:
+            self.skip_space()
+            link = self.parse_link()
+            if link is None:
+                return
+            kind, label = link
+            self.skip_space()
+            targets = self.parse_node_group()
+            for source in sources:
+                for target in targets:
+                    self.chart.add_edge(source, target, label, kind)
+            sources = targets
+
+    def parse_node_group(self):
+        """node ('&' node)*"""
+        node_ids = [self.parse_node()]
+        while True:
+            self.skip_space()
+            if not self.line.startswith('&', self.pos):
+                return node_ids
+            self.pos += 1
+            self.skip_space()
+            node_ids.append(self.parse_node())
+
+    def parse_node(self):
+        match = _NODE_ID.match(self.line, self.pos)
+        if not match:
+            raise self.error(f"expected a node ID at '{self.line[self.pos:self.pos + 10]}'")
+        raw_id = match.group()
+        if raw_id in RESERVED_IDS and not self.lenient:
+            raise self.error(f"'{raw_id}' cannot be used as a node ID")
+        node_id = normalize_id(raw_id) if raw_id in RESERVED_IDS or not raw_id[0].isalpha() else raw_id
+        self.pos = match.end()
+        label, shape = self.parse_shape()
+        node = self.chart.nodes.get(node_id)
+        is_new = node is None
+        if not is_new and (label or shape):
+            self.overwritten.setdefault(node_id, (node.label, node.shape))
+        self.chart.add_node(node_id, label, shape)
+        if is_new and self.subgraph_stack:
+            self.subgraph_stack[-1].nodes.append(node_id)
+        css_class = _CSS_CLASS.match(self.line, self.pos)
+        if css_class:
+            self.chart.styles.append(f'class {node_id} {css_class.group(1)}')
+            self.pos = css_class.end()
+        return node_id
+
+    def parse_shape(self):
+        """Return (label, shape) for a shape right after a node ID, or ('', None)"""
+        line, pos = self.line, self.pos
+        openings = _OPENINGS.get(line[pos:pos + 1])
+        if not openings:
+            return '', None
+        for opening in openings:
+            if not line.startswith(opening, pos):
+                continue
+            start = pos + len(opening)
+            for closing, shape in _SHAPES_BY_OPENING[opening]:
+                label, end = self.read_label(start, closing)
+                if end is not None:
+                    self.pos = end
+                    return label, shape
+        raise self.error(f"unclosed node shape '{line[pos:pos + 10]}'")
+
+    def read_label(self, start, closing):
+        """(label, end) if the text from start is closed by closing, else ('', None)"""
+        line = self.line
+        if line.startswith('"', start):
+            quote_end = line.find('"', start + 1)
+            if quote_end != -1 and line.startswith(closing, quote_end + 1):
+                return line[start + 1:quote_end].replace('#quot;', '"'), quote_end + 1 + len(closing)
+        end = self._next_closing.get(closing)
+        if end is None or end != -1 and end < start:
+            end = self._next_closing[closing] = line.find(closing, start)
+        if end == -1:
+            return '', None
+        if self.lenient:
+            # Brackets inside an unquoted label ("B(Heat (optional) sample)"):
+            # extend the label to a closing the statement can go on after;
+            # it is quoted when written out again
+            while not _AFTER_NODE.match(line, end + len(closing)):
+                later = line.find(closing, end + 1)
+                if later == -1:
+                    break
+                end = self._next_closing[closing] = later
+        return line[start:end].strip(), end + len(closing)
+
+    def parse_link(self):
+        """Return (kind, label) for a link at the current position, or None"""
+        line = self.line
+        text_link = _TEXT_LINK_OPEN.match(line, self.pos)
+        if text_link:
+            start, opener = text_link.group(1), text_link.group(2)
+            close = _TEXT_LINK_CLOSE[opener].search(line, text_link.end())
+            if close:
+                label = line[text_link.end():close.start()].strip().strip('"')
+                self.pos = close.end()
+                return start + self.text_link_kind(opener, close.group(1)), label
+            if not self.lenient:
+                raise self.error(f"link '{opener}' is never closed")
+            # LLMs often write "A -- B" for "A --> B"
+            self.pos = text_link.end()
+            return '-->', ''
+        link = _LINK.match(line, self.pos)
+        if not link:
+            return None
+        self.pos = link.end()
+        kind = link.group(0)
+        if kind.lstrip('<') in ('--', '=='):
+            if not self.lenient:
+                raise self.error(f"incomplete link '{kind}'")
+            kind += '>'
+        label = ''
+        self.skip_space()
+        edge_label = _EDGE_LABEL.match(line, self.pos)
+        if edge_label:
+            label = edge_label.group(2).strip()
+            self.pos = edge_label.end()
+        return kind, label
+
+    @staticmethod
+    def text_link_kind(opener, closer):
+        # "-- text -->" is the same link as "-->|text|"
+        if opener == '-.':
+            return '-' + closer
+        return closer
+
+
+def _parse_keyword_statement(chart, subgraph_stack, line, line_number):
+    """Handle header, subgraph, end, direction and style statements; False if line is none of these"""
+    keyword = _KEYWORD.match(line)
+    word = keyword.group(1) if keyword else ''
+    if word in ('flowchart', 'graph'):
+        header = _HEADER.match(line)
+        if not header:
+            raise MermaidSyntaxError('malformed flowchart header', line_number, line)
+        direction = (header.group(1) or 'TD').upper()
+        if direction not in DIRECTIONS:
+            raise MermaidSyntaxError(f"unknown direction '{header.group(1)}'", line_number, line)
+        chart.direction = direction
+        return True
+    if word == 'subgraph':
+        title = (_SUBGRAPH.match(line).group(1) or '').strip().strip('"')
+        named = _SUBGRAPH_TITLE.match(title)
+        if named:
+            subgraph_id, label = named.group(1), named.group(2)
+        else:
+            subgraph_id, label = normalize_id(title or f'subgraph{len(chart.subgraphs) + 1}'), ''
+            if title and title != subgraph_id:
+                label = title
+        parent = subgraph_stack[-1].id if subgraph_stack else None
+        subgraph = chart.subgraphs.setdefault(subgraph_id, Subgraph(subgraph_id, label, parent=parent))
+        subgraph_stack.append(subgraph)
+        return True
+    if word == 'end' and line.rstrip(' ;') == 'end':
+        if not subgraph_stack:
+            raise MermaidSyntaxError("'end' without a matching subgraph", line_number, line)
+        subgraph_stack.pop()
+        return True
+    if word == 'direction' and subgraph_stack:
+        direction = _DIRECTION.match(line)
+        if not direction or direction.group(1).upper() not in DIRECTIONS:
+            raise MermaidSyntaxError('malformed direction statement', line_number, line)
+        subgraph_stack[-1].direction = direction.group(1).upper()
+        return True
+    if word in STYLE_KEYWORDS:
+        chart.styles.append(line.rstrip(';').strip())
+        return True
+    return False
+
+
+def _checkpoint(chart, subgraph_stack):
+    # The last item is filled in by the statement parser with the attributes
+    # of the existing nodes it relabels or reshapes
+    return (len(chart.nodes), len(chart.edges), len(chart.styles), list(subgraph_stack),
+            {subgraph_id: len(subgraph.nodes) for subgraph_id, subgraph in chart.subgraphs.items()}, {})
+
+
+def _rollback(chart, subgraph_stack, checkpoint):
+    """Undo the nodes, edges, subgraphs and label changes of a statement that failed half-way"""
+    nodes, edges, styles, stack, members, overwritten = checkpoint
+    for node_id in list(chart.nodes)[nodes:]:
+        del chart.nodes[node_id]
+    for node_id, (label, shape) in overwritten.items():
+        if node_id in chart.nodes:
+            chart.nodes[node_id].label, chart.nodes[node_id].shape = label, shape
+    del chart.edges[edges:]
+    del chart.styles[styles:]
+    subgraph_stack[:] = stack
+    for subgraph_id in list(chart.subgraphs):
+        if subgraph_id not in members:
+            del chart.subgraphs[subgraph_id]
+        else:
+            del chart.subgraphs[subgraph_id].nodes[members[subgraph_id]:]
+
+
+def parse_mermaid(text, errors=None):
+    """Parse Mermaid flowchart text into a Flowchart
+
+    Raises MermaidSyntaxError on the first invalid statement. When an errors
+    list is given, parsing is lenient instead: invalid lines are skipped and
+    their MermaidSyntaxErrors appended to the list (nothing from a failed
+    line is kept), and common LLM slips ("A -- B", reserved words as node
+    IDs, brackets inside unquoted labels) are repaired.
+    """
+    chart = Flowchart()
+    subgraph_stack = []
+    seen_header = errors is not None  # A missing header is only an error in strict mode
+    for line_number, raw_line in enumerate(text.split('\n'), 1):
+        line = raw_line.strip()
+        if not line or line.startswith('%%') or line.startswith('```'):
+            continue
+        checkpoint = _checkpoint(chart, subgraph_stack) if errors is not None else None
+        try:
+            if not seen_header:
+                keyword = _KEYWORD.match(line)
+                if not keyword or keyword.group(1) not in ('flowchart', 'graph'):
+                    raise MermaidSyntaxError("expected 'flowchart <direction>' header", line_number, line)
+            if _parse_keyword_statement(chart, subgraph_stack, line, line_number):
+                seen_header = True
+                continue
+            _StatementParser(chart, subgraph_stack, line, line_number, errors is not None,
+                             checkpoint[-1] if checkpoint else None).parse()
+        except MermaidSyntaxError as e:
+            if errors is None:
+                raise
+            _rollback(chart, subgraph_stack, checkpoint)
+            errors.append(e)
+    if subgraph_stack:
+        error = MermaidSyntaxError(f"subgraph '{subgraph_stack[-1].id}' is never closed")
+        if errors is None:
+            raise error
+        errors.append(error)
+    return chart
+
+
+def is_mermaid_statement(line):
+    """True if line is a statement of a flowchart body (header excluded), allowing repairable slips"""
+    line = line.strip()
+    chart = Flowchart()
+    # Track an open subgraph so a lone "end" is accepted
+    subgraph_stack = [Subgraph('_')]
+    try:
+        if not _parse_keyword_statement(chart, subgraph_stack, line, 1):
+            _StatementParser(chart, subgraph_stack, line, 1, True).parse()
+    except MermaidSyntaxError:
+        return False
+    return bool(line)
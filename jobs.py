@@ -0,0 +1,415 @@
+"""Bounded in-process job queue for long-running flowchart generation.
+
+Uploads are turned into jobs that a fixed pool of worker threads picks up, so
+web workers return immediately and LLM throughput is sized independently of the
+number of gunicorn workers. The public surface (submit / get / stats) is kept
+small on purpose so the in-memory store can be swapped for a local Redis one.
+
+Each job also keeps an append-only event log (stage progress, streamed tokens)
+that clients can follow while the job runs. Token events are dropped once the
+job finishes, as its result holds the full output. A reaper thread times out
+jobs past their deadline and forgets finished ones after result_ttl, whether
+or not anyone polls them.
+
+Jobs can be submitted under a key (e.g. the hash of the uploaded PDF): while a
+job for that key is unfinished, submitting the same key again returns it
+instead of starting another one (single-flight). Queues built with the same
+SingleFlight also return each other's jobs.
+"""
+import contextvars
+import logging
+import queue
+import threading
+import time
+import uuid
+
+log = logging.getLogger('storyboard.jobs')
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job"""
+
+
+class JobTimeoutError(Exception):
+    """Raised by a job that has run past its deadline"""
+
+
+TERMINAL_STATUSES = ('done', 'failed', 'timeout')
+
+
+class Job:
+    """A single unit of work, its current status and its event log"""
+
+    def __init__(self, func, args, kwargs, timeout, key=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.func = func
+        # Runs in a copy of the submitter's context (request ID for the logs)
+        self.context = contextvars.copy_context()
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.deadline = None
+        self.events = []
+        self.tokens_trimmed = False
+        self._events_changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in TERMINAL_STATUSES
+
+    def emit(self, event, data=None):
+        """Append an event to the job's log and wake up any listeners"""
+        with self._events_changed:
+            self.events.append((event, data or {}))
+            self._events_changed.notify_all()
+
+    def finish(self, status, data=None):
+        """Move the job to a terminal status, recording it as the final event"""
+        with self._events_changed:
+            if self.finished:
+                return False
+            self.finished_at = time.time()
+            self.status = status
+            # Streamed output is only useful while the job runs; the result has all of it
+            self.events = [event for event in self.events if event[0] != 'token']
+            self.tokens_trimmed = True
+            self.events.append((status, data or {}))
+            self._events_changed.notify_all()
+        return True
+
+    def iter_events(self, heartbeat=15):
+        """Yield (event, data) pairs from the start of the log until the job finishes.
+
+        Yields (None, None) every ``heartbeat`` seconds without new events so
+        callers can keep idle connections alive. Token events not yet read when
+        the job finishes are skipped.
+        """
+        index = 0
+        kept = 0  # Non-token events yielded: the position in the log once tokens are trimmed
+        trimmed = False
+        while True:
+            with self._events_changed:
+                if index >= len(self.events) and not self.finished:
+                    self._events_changed.wait(heartbeat)
+                if self.tokens_trimmed and not trimmed:
+                    index, trimmed = kept, True
+                pending = self.events[index:]
+                finished = self.finished
+            index += len(pending)
+            for event in pending:
+                kept += event[0] != 'token'
+                yield event
+            if finished and index >= len(self.events):
+                return
+            if not pending:
+                yield None, None
+
+    def wait(self, timeout=None):
+        """Block until the job finishes or timeout seconds pass; returns job.finished"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._events_changed:
+            while not self.finished:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self._events_changed.wait(remaining)
+            return self.finished
+
+    def expired(self):
+        """Return True once a running job has passed its deadline"""
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def check_deadline(self):
+        """Raise JobTimeoutError if the job ran out of time"""
+        if self.expired():
+            raise JobTimeoutError(f'Job exceeded {self.timeout}s timeout')
+
+    def to_dict(self):
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.status == 'done':
+            data['result'] = self.result
+        elif self.status in ('failed', 'timeout'):
+            data['error'] = self.error
+        return data
+
+
+class Batch:
+    """Several files submitted together, each backed by a job, a cached result or an earlier duplicate
+
+    items are dicts with at least 'filename'; they carry either a 'job', a
+    finished 'result', an 'error', or 'duplicate_of' (index of the item with
+    identical content).
+    """
+
+    def __init__(self, items):
+        self.id = uuid.uuid4().hex
+        self.items = items
+        self.created_at = time.time()
+
+    @property
+    def jobs(self):
+        return [item['job'] for item in self.items if item.get('job')]
+
+    @property
+    def finished(self):
+        return all(job.finished for job in self.jobs)
+
+    @property
+    def finished_at(self):
+        if not self.finished:
+            return None
+        return max([job.finished_at for job in self.jobs] or [self.created_at])
+
+    def wait(self, timeout=None):
+        """Block until every job of the batch finishes or timeout seconds pass"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for job in self.jobs:
+            remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+            if not job.wait(remaining):
+                return False
+        return True
+
+    def _item_dict(self, item):
+        source = self.items[item['duplicate_of']] if item.get('duplicate_of') is not None else item
+        job = source.get('job')
+        data = {'filename': item['filename'], 'cached': bool(source.get('cached'))}
+        if item.get('duplicate_of') is not None:
+            data['duplicate_of'] = item['duplicate_of']
+        if item.get('coalesced'):
+            data['coalesced'] = True
+        if job:
+            data.update(job.to_dict())
+            if job.started_at and job.finished_at:
+                data['seconds'] = round(job.finished_at - job.started_at, 3)
+        elif 'result' in source:
+            data.update(status='done', result=source['result'])
+        else:
+            data.update(status='failed', error=source.get('error'))
+        return data
+
+    def to_dict(self):
+        files = [self._item_dict(item) for item in self.items]
+        statuses = [f['status'] for f in files]
+        finished_at = self.finished_at
+        busy = [job.finished_at - job.started_at for job in self.jobs if job.started_at and job.finished_at]
+        wall = (finished_at or time.time()) - self.created_at
+        return {
+            'batch_id': self.id,
+            'status': 'done' if finished_at else 'running',
+            'created_at': self.created_at,
+            'finished_at': finished_at,
+            'counts': {status: statuses.count(status) for status in set(statuses)},
+            'timings': {
+                'wall': round(wall, 3),
+                'sum_of_files': round(sum(busy), 3),
+                'max_file': round(max(busy), 3) if busy else 0.0,
+            },
+            'files': files,
+        }
+
+
+class SingleFlight:
+    """Unfinished jobs by key, for one queue or several that coalesce with each other
+
+    submit_lock is held from the lookup to the submit, so two identical
+    submissions to any of the sharing queues start a single job.
+    """
+
+    def __init__(self):
+        self.submit_lock = threading.Lock()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def find(self, key):
+        """Return the unfinished job submitted under key, or None"""
+        with self._lock:
+            job = self._jobs.get(key)
+        # An overdue job is about to be timed out by its queue's reaper
+        return job if job and not job.finished and not job.expired() else None
+
+    def add(self, job):
+        with self._lock:
+            self._jobs[job.key] = job
+
+    def forget(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+
+class JobQueue:
+    """Fixed-size worker pool reading from a bounded FIFO queue"""
+
+    def __init__(self, workers=2, max_queue=20, job_timeout=300, result_ttl=3600, reap_interval=5, flights=None):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.result_ttl = result_ttl
+        self.reap_interval = reap_interval
+        self.flights = flights if flights is not None else SingleFlight()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._jobs = {}
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = 0
+
+    def _ensure_started(self):
+        # Workers are started lazily so importing the app (CLI, tests,
+        # serverless handlers) does not spawn threads nobody uses
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._reaper, name='job-reaper', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(job, *args, **kwargs) and return the new Job"""
+        return self._submit(None, func, args, kwargs)
+
+    def submit_once(self, key, func, *args, **kwargs):
+        """Single-flight submit: return (job, False) if an unfinished job was submitted under key, else (new job, True)
+
+        The job found may belong to another queue sharing this one's flights.
+        """
+        with self.flights.submit_lock:
+            job = self.find(key)
+            if job:
+                return job, False
+            return self._submit(key, func, args, kwargs), True
+
+    def find(self, key):
+        """Return the unfinished job submitted under key (to any queue sharing flights), or None"""
+        return self.flights.find(key)
+
+    def _submit(self, key, func, args, kwargs):
+        self._ensure_started()
+        self._purge_expired()
+        job = Job(func, args, kwargs, self.job_timeout, key)
+        with self._lock:
+            self._jobs[job.id] = job
+        if key is not None:
+            self.flights.add(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+                self._forget(job)
+            raise QueueFullError('Job queue is full, please retry later')
+        return job
+
+    def _forget(self, job):
+        if job.key is not None:
+            self.flights.forget(job)
+
+    def get(self, job_id):
+        """Return the Job for job_id or None if unknown/expired"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job and job.status == 'running' and job.expired():
+            self._fail(job, 'timeout', f'Job exceeded {job.timeout}s timeout')
+        return job
+
+    def add_batch(self, batch):
+        """Track a batch built from jobs of this queue so it can be looked up by ID"""
+        with self._lock:
+            self._batches[batch.id] = batch
+        return batch
+
+    def get_batch(self, batch_id):
+        """Return the Batch for batch_id or None if unknown/expired"""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch:
+            for job in batch.jobs:
+                self.get(job.id)  # Marks overdue jobs as timed out
+        return batch
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            running = self._running
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize(),
+            'queue_capacity': self._queue.maxsize,
+            'running': running,
+            'tracked_jobs': len(statuses),
+            'tracked_batches': len(self._batches),
+            'failed': statuses.count('failed') + statuses.count('timeout'),
+        }
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.result_ttl
+        with self._lock:
+            overdue = [job for job in self._jobs.values() if job.status == 'running' and job.expired()]
+        for job in overdue:
+            # Listeners and batches see the timeout now; the worker's eventual result is discarded
+            self._fail(job, 'timeout', f'Job exceeded {job.timeout}s timeout')
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+            expired = [batch_id for batch_id, batch in self._batches.items()
+                       if batch.finished_at and batch.finished_at < cutoff]
+            for batch_id in expired:
+                del self._batches[batch_id]
+
+    def _fail(self, job, status, error):
+        if not job.finished:
+            job.error = error
+            job.finish(status, {'error': error})
+
+    def _reaper(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self._purge_expired()
+            except Exception as e:
+                log.exception("Job reaper failed: %s", e)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                self._running += 1
+            job.status = 'running'
+            job.started_at = time.time()
+            job.deadline = time.monotonic() + job.timeout if job.timeout else None
+            try:
+                result = job.context.run(job.func, job, *job.args, **job.kwargs)
+                job.check_deadline()
+                if not job.finished:
+                    job.result = result
+                    job.finish('done', {'result': result})
+            except JobTimeoutError as e:
+                self._fail(job, 'timeout', str(e))
+            except Exception as e:
+                log.exception("Job failed: %s", e, extra={'job_id': job.id})
+                self._fail(job, 'failed', str(e))
+            finally:
+                # Drop references to the uploaded bytes as soon as we are done
+                job.args = job.kwargs = job.context = None
+                with self._lock:
+                    self._running -= 1
+                    self._forget(job)
+                self._queue.task_done()
@@ -0,0 +1,38 @@
+"""Links that open generated Mermaid code in external editors.
+
+Mermaid Live reads its editor state from the URL fragment as
+``pako:<payload>``: the state JSON deflated with zlib (what pako.deflate
+produces) and encoded as URL-safe base64 without padding.
+"""
+import base64
+import json
+import zlib
+
+MERMAID_LIVE_EDIT_URL = 'https://mermaid.live/edit'
+MERMAID_LIVE_CONFIG = json.dumps({'theme': 'default'}, indent=2)
+
+
+def pako_encode(state):
+    """Encode a state dict the way Mermaid Live's serializer does"""
+    data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(zlib.compress(data, 9)).decode('ascii').rstrip('=')
+
+
+def pako_decode(payload):
+    """Inverse of pako_encode; accepts payloads with or without padding"""
+    data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+    return json.loads(zlib.decompress(data))
+
+
+def mermaid_live_state(mermaid_code):
+    return {
+        'code': mermaid_code,
+        'mermaid': MERMAID_LIVE_CONFIG,
+        'autoSync': True,
+        'updateDiagram': True,
+    }
+
+
+def mermaid_live_url(mermaid_code):
+    """Mermaid Live editor URL with the code embedded as a pako payload"""
+    return f'{MERMAID_LIVE_EDIT_URL}#pako:{pako_encode(mermaid_live_state(mermaid_code))}'
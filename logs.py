@@ -0,0 +1,155 @@
+"""Structured logging: JSON lines written off the request path.
+
+Loggers hand records to a bounded in-memory queue; a single listener thread
+formats and writes them, so request threads never wait on stdout. When the
+queue is full, records are dropped and counted. Request and job IDs come from
+context variables and are attached to every record logged while they are
+bound, so a slow request can be followed across stages and worker threads.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+CONTEXT_FIELDS = ('request_id', 'job_id')
+_context = {name: contextvars.ContextVar(name, default=None) for name in CONTEXT_FIELDS}
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def bind(**fields):
+    """Set context fields (e.g. job_id) for the current context; returns reset tokens"""
+    return {name: _context[name].set(value) for name, value in fields.items()}
+
+
+def unbind(tokens):
+    for name, token in tokens.items():
+        _context[name].reset(token)
+
+
+@contextmanager
+def bound(**fields):
+    tokens = bind(**fields)
+    try:
+        yield
+    finally:
+        unbind(tokens)
+
+
+def current(name):
+    return _context[name].get()
+
+
+def extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, context and extra fields"""
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(extra_fields(record))
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for local development, with the fields appended"""
+
+    def format(self, record):
+        fields = ' '.join(f'{key}={value}' for key, value in extra_fields(record).items() if value is not None)
+        line = (f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} "
+                f"{record.name}: {record.getMessage()}{' ' + fields if fields else ''}")
+        return f'{line}\n{record.exc_text}' if record.exc_text else line
+
+
+class ContextQueueHandler(QueueHandler):
+    """QueueHandler that stamps context fields and never blocks the caller"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve everything that depends on the calling thread (message
+        # arguments, traceback, context variables) before handing off
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for name, var in _context.items():
+            value = var.get()
+            if value is not None and not hasattr(record, name):
+                setattr(record, name, value)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+_output = None
+
+
+def _start_listener():
+    global _listener
+    _handler.queue = queue.Queue(_handler.queue.maxsize)
+    _listener = QueueListener(_handler.queue, _output, respect_handler_level=True)
+    _listener.start()
+
+
+def setup_logging(level='INFO', fmt='json', queue_size=10000, stream=None):
+    """Route all logging through the queue to stream (stdout by default); safe to call again"""
+    global _handler, _output
+    root = logging.getLogger()
+    if _handler is not None:
+        root.setLevel(level)
+        return _handler
+    _output = logging.StreamHandler(stream or sys.stdout)
+    _output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    _handler = ContextQueueHandler(queue.Queue(queue_size))
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _start_listener()
+    # Forked workers (gunicorn --preload) do not inherit the listener thread
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(stop_logging)
+    return _handler
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.stop()
+
+
+def stats():
+    if _handler is None:
+        return {'configured': False}
+    return {'configured': True, 'queued': _handler.queue.qsize(), 'dropped': _handler.dropped}
@@ -0,0 +1,177 @@
+"""Minimal Prometheus metrics: counters, gauges and histograms in text format.
+
+Updates are a dict lookup and an add under a lock, cheap enough for the hot
+path. Values that other components already count (cache hits, queue depth,
+limiter state) are read through callbacks at scrape time instead of being
+tracked twice.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        try:
+            if len(labels) == len(self.labelnames):
+                return tuple([str(labels[name]) for name in self.labelnames])
+        except KeyError:
+            pass
+        raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+
+    def _samples(self):
+        """(suffix, label values, extra labels, value) tuples"""
+        if self.callback:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [('', key if isinstance(key, tuple) else (key,), (), value) for key, value in values.items()]
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_label_text(self.labelnames, key, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count; callback metrics report a counter kept elsewhere"""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram of observed values (e.g. seconds)"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (non-cumulative), overflow last, then sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            states = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in states:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def expose(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        parts = []
+        for metric in metrics:
+            try:
+                parts.append(metric.expose())
+            except Exception as e:
+                # A failing callback must not take the whole scrape down
+                parts.append(f'# {metric.name} unavailable: {_escape(e)}')
+        return '\n'.join(parts) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Shared with extraction.py, which observes it without importing the app
+pdf_extract_seconds = Histogram('storyboard_pdf_extract_seconds', 'PDF text extraction time per page batch',
+                                ['backend'], buckets=(0.001,) + DEFAULT_BUCKETS)
@@ -0,0 +1,316 @@
+"""Near-duplicate detection for extracted document text: MinHash signatures + LSH index.
+
+A document's fingerprint is a MinHash signature of its word 3-grams, so two
+documents that differ by a date or a header line get signatures that agree
+in roughly the fraction of 3-grams they share (their Jaccard similarity).
+Signatures use one-permutation hashing: every 3-gram is hashed once and
+lands in one of SIGNATURE_SIZE buckets, instead of being hashed once per
+permutation, which keeps it cheap in pure Python.
+
+The index splits each signature into BANDS bands and keeps, per band, a sorted
+array of band hashes; a document is a candidate when any band matches, and
+candidates are then scored on the whole signature. Lookups cost a few binary
+searches whatever the number of documents, and 100k documents take a few
+tens of MB. Reloading from SQLite builds each band's arrays with one sort.
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+log = logging.getLogger('storyboard.neardup')
+
+SIGNATURE_SIZE = 64
+# 16 bands of 4 rows make documents down to about 0.5 similar likely candidates
+# (revised versions as well as near-duplicates); scoring on the full signature
+# then applies the threshold
+BANDS = 16
+ROWS = SIGNATURE_SIZE // BANDS
+WORDS_PER_BAND = ROWS // 2  # Signature values are 32-bit
+SHINGLE_SIZE = 3
+
+_MASK64 = (1 << 64) - 1
+_EMPTY = 1 << 32
+_WORD_RE = re.compile(r'\w+')
+
+
+def normalize_words(text):
+    """Case-folded words of the text, ignoring punctuation, layout and Unicode variants"""
+    return _WORD_RE.findall(unicodedata.normalize('NFKC', text).casefold())
+
+
+def _mix(x):
+    # splitmix64 finalizer: spreads the combined word hashes over all 64 bits
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    """Stable 64-bit hashes of the word n-grams of the text (a set)"""
+    words = normalize_words(text)
+    word_hashes = {}
+    hashed = []
+    for word in words:
+        h = word_hashes.get(word)
+        if h is None:
+            h = word_hashes[word] = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+        hashed.append(h)
+    if len(hashed) < size:
+        return {_mix(sum(hashed) & _MASK64)} if hashed else set()
+    shingles = set()
+    for i in range(len(hashed) - size + 1):
+        x = 0
+        for h in hashed[i:i + size]:
+            x = (x * 0x100000001B3 + h) & _MASK64
+        shingles.add(_mix(x))
+    return shingles
+
+
+def signature(text):
+    """MinHash signature (array of SIGNATURE_SIZE 32-bit ints) of the text, or None if it has no words"""
+    minima = [_EMPTY] * SIGNATURE_SIZE
+    bucket_mask = SIGNATURE_SIZE - 1
+    for h in shingle_hashes(text):
+        bucket = h & bucket_mask
+        value = h >> 32
+        if value < minima[bucket]:
+            minima[bucket] = value
+    if all(value == _EMPTY for value in minima):
+        return None
+    # Densify: an empty bucket borrows the next filled bucket's minimum, offset by the distance,
+    # so short documents still compare bucket by bucket
+    for i in range(SIGNATURE_SIZE):
+        if minima[i] != _EMPTY:
+            continue
+        for distance in range(1, SIGNATURE_SIZE):
+            value = minima[(i + distance) % SIGNATURE_SIZE]
+            if value != _EMPTY:
+                minima[i] = (value + distance * 0x9E3779B1) & 0xFFFFFFFF
+                break
+    return array('I', minima)
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of the documents behind two signatures"""
+    return sum(1 for x, y in zip(a, b) if x == y) / SIGNATURE_SIZE
+
+
+def _words(sig):
+    """The signature (or several, concatenated) as 64-bit words, WORDS_PER_BAND per band"""
+    words = array('Q')
+    words.frombytes(sig.tobytes())
+    return words
+
+
+def _band_key(values):
+    # XOR of the band's words: equal bands get equal keys, and the rare unequal
+    # bands that share one only cost a full-signature comparison
+    key = 0
+    for value in values:
+        key ^= value
+    return key
+
+
+def _band_hashes(sig):
+    words = _words(sig)
+    return [_band_key(words[start:start + WORDS_PER_BAND]) for start in range(0, len(words), WORDS_PER_BAND)]
+
+
+class NearDuplicateIndex:
+    """Signatures of earlier documents, searchable for ones above a similarity threshold
+
+    Each entry maps a key (the result cache key of that document's flowchart)
+    to a signature and a tag (the generation mode); queries only match entries
+    with the same tag. The oldest entries are dropped past max_entries. With a
+    path the entries are also kept in a SQLite table and reloaded at startup.
+    """
+
+    def __init__(self, path=None, threshold=0.9, max_entries=100000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.queries = 0
+        self.hits = 0
+        self._slots = OrderedDict()  # key -> slot, oldest first
+        self._keys = []
+        self._tags = []
+        self._free = []
+        self._signatures = array('I')
+        self._bands = [(array('Q'), array('I')) for _ in range(BANDS)]
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS fingerprints ('
+                    'key TEXT PRIMARY KEY, tag TEXT NOT NULL, signature BLOB NOT NULL, created_at REAL NOT NULL)'
+                )
+                self._conn.commit()
+                self._load()
+            except sqlite3.Error as e:
+                log.warning("Near-duplicate index disk store unavailable (%s): %s", path, e)
+                self._conn = None
+
+    def _load(self):
+        rows = self._conn.execute(
+            'SELECT key, tag, signature FROM fingerprints ORDER BY created_at DESC LIMIT ?', (self.max_entries,)
+        ).fetchall()
+        # Slots first, then each band's sorted arrays in one sort: inserting
+        # rows one by one would shift the arrays for every row
+        for key, tag, blob in reversed(rows):
+            sig = array('I')
+            sig.frombytes(blob)
+            if len(sig) == SIGNATURE_SIZE:
+                self._store(key, sig, tag)
+        self._build_bands()
+        if len(rows) < self.max_entries:
+            return  # Every row was loaded
+        self._conn.execute(
+            'DELETE FROM fingerprints WHERE key NOT IN ('
+            'SELECT key FROM fingerprints ORDER BY created_at DESC LIMIT ?)', (self.max_entries,)
+        )
+        self._conn.commit()
+
+    def add(self, key, sig, tag=''):
+        if sig is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._remove(key)
+            self._insert(key, sig, tag)
+            evicted = []
+            while len(self._slots) > self.max_entries:
+                oldest = next(iter(self._slots))
+                self._remove(oldest)
+                evicted.append(oldest)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO fingerprints (key, tag, signature, created_at) VALUES (?, ?, ?, ?)',
+                    (key, tag, sig.tobytes(), time.time())
+                )
+                self._conn.executemany('DELETE FROM fingerprints WHERE key = ?', [(k,) for k in evicted])
+                self._conn.commit()
+            except sqlite3.Error as e:
+                log.warning("Near-duplicate index write failed: %s", e)
+
+    def remove(self, key):
+        with self._lock:
+            if not self._remove(key) or self._conn is None:
+                return
+            try:
+                self._conn.execute('DELETE FROM fingerprints WHERE key = ?', (key,))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                log.warning("Near-duplicate index write failed: %s", e)
+
+    def query(self, sig, tag='', threshold=None):
+        """(similarity, key) of entries with this tag at or above the threshold, most similar first
+
+        threshold overrides the index's own; only lookups at the index's threshold count in stats().
+        """
+        if sig is None:
+            return []
+        counted = threshold is None
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            self.queries += counted
+            candidates = set()
+            for (keys, slots), h in zip(self._bands, _band_hashes(sig)):
+                i = bisect_left(keys, h)
+                while i < len(keys) and keys[i] == h:
+                    candidates.add(slots[i])
+                    i += 1
+            matches = []
+            for slot in candidates:
+                if self._tags[slot] != tag:
+                    continue
+                score = similarity(sig, self._signatures[slot * SIGNATURE_SIZE:(slot + 1) * SIGNATURE_SIZE])
+                if score >= threshold:
+                    matches.append((score, self._keys[slot]))
+            if matches and counted:
+                self.hits += 1
+        return sorted(matches, reverse=True)
+
+    def _build_bands(self):
+        """Rebuild every band's sorted arrays from the stored signatures at once"""
+        words = _words(self._signatures)
+        stride = BANDS * WORDS_PER_BAND
+        live = [key is not None for key in self._keys]
+        shift = len(self._keys).bit_length()
+        mask = (1 << shift) - 1
+        for band in range(BANDS):
+            # _band_key of every slot at once: the band's word columns XORed as big integers
+            combined = 0
+            for word in range(WORDS_PER_BAND):
+                combined ^= int.from_bytes(words[band * WORDS_PER_BAND + word::stride].tobytes(), 'little')
+            keys = array('Q')
+            keys.frombytes(combined.to_bytes(len(self._keys) * keys.itemsize, 'little'))
+            # (key, slot) packed into one int, so a plain sort orders them by key
+            packed = sorted([key << shift | slot for slot, key in enumerate(keys) if live[slot]])
+            self._bands[band] = (array('Q', [value >> shift for value in packed]),
+                                 array('I', [value & mask for value in packed]))
+
+    def _insert(self, key, sig, tag):
+        slot = self._store(key, sig, tag)
+        for (keys, slots), h in zip(self._bands, _band_hashes(sig)):
+            i = bisect_left(keys, h)
+            keys.insert(i, h)
+            slots.insert(i, slot)
+
+    def _store(self, key, sig, tag):
+        """Put the entry in a free or new slot (without indexing its bands) and return the slot"""
+        if self._free:
+            slot = self._free.pop()
+            self._signatures[slot * SIGNATURE_SIZE:(slot + 1) * SIGNATURE_SIZE] = sig
+            self._keys[slot] = key
+            self._tags[slot] = tag
+        else:
+            slot = len(self._keys)
+            self._signatures.extend(sig)
+            self._keys.append(key)
+            self._tags.append(tag)
+        self._slots[key] = slot
+        return slot
+
+    def _remove(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return False
+        sig = self._signatures[slot * SIGNATURE_SIZE:(slot + 1) * SIGNATURE_SIZE]
+        for (keys, slots), h in zip(self._bands, _band_hashes(sig)):
+            i = bisect_left(keys, h)
+            while i < len(keys) and keys[i] == h:
+                if slots[i] == slot:
+                    del keys[i]
+                    del slots[i]
+                    break
+                i += 1
+        self._keys[slot] = None
+        self._tags[slot] = None
+        self._free.append(slot)
+        return True
+
+    def __len__(self):
+        return len(self._slots)
+
+    def stats(self):
+        return {
+            'size': len(self._slots),
+            'max_size': self.max_entries,
+            'threshold': self.threshold,
+            'queries': self.queries,
+            'hits': self.hits,
+            'misses': self.queries - self.hits,
+        }
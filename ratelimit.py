@@ -0,0 +1,241 @@
+"""Client-side limits for outbound LLM calls.
+
+A concurrency semaphore plus requests-per-minute and tokens-per-minute token
+buckets sit in front of every xAI call, so bursts of uploads queue locally
+instead of turning into a storm of 429s. Retries back off exponentially with
+jitter and honor the server's Retry-After header.
+"""
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at rate_per_minute"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount=1):
+        """Take amount tokens if available; returns 0 on success, else the seconds to wait"""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1):
+        """Block until amount tokens are available and take them"""
+        while True:
+            wait = self.try_take(amount)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, amount=1):
+        """Like acquire, but yields to the event loop while waiting"""
+        while True:
+            wait = self.try_take(amount)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount):
+        """Debit (positive) or credit (negative) tokens after the real cost is known"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """Concurrency cap plus optional request and token rate limits"""
+
+    def __init__(self, max_concurrency=4, requests_per_minute=0, tokens_per_minute=0):
+        self.max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self.used_tokens = 0
+
+    def _start_waiting(self):
+        with self._lock:
+            self.waiting += 1
+
+    def _acquired(self, started):
+        waited = time.monotonic() - started
+        with self._lock:
+            self.waiting -= 1
+            self.in_flight += 1
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def _abandoned(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def _released(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @contextmanager
+    def slot(self, estimated_tokens=0):
+        """Wait for a free slot and rate budget; yields the seconds spent waiting"""
+        started = time.monotonic()
+        self._start_waiting()
+        if self._semaphore:
+            self._semaphore.acquire()
+        try:
+            if self.requests:
+                self.requests.acquire(1)
+            if self.tokens and estimated_tokens:
+                self.tokens.acquire(estimated_tokens)
+        except BaseException:
+            if self._semaphore:
+                self._semaphore.release()
+            self._abandoned()
+            raise
+        waited = self._acquired(started)
+        try:
+            yield waited
+        finally:
+            self._released()
+            if self._semaphore:
+                self._semaphore.release()
+
+    def record_usage(self, actual_tokens, estimated_tokens):
+        """Correct the token bucket once the real usage of a call is known"""
+        with self._lock:
+            self.used_tokens += actual_tokens or 0
+        if self.tokens and actual_tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def record_retry(self, throttled=False):
+        with self._lock:
+            self.retries += 1
+            if throttled:
+                self.throttled += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'acquired': self.acquired,
+                'avg_wait_ms': round(self.total_wait * 1000 / self.acquired, 1) if self.acquired else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+                'retries': self.retries,
+                'throttled': self.throttled,
+                'used_tokens': self.used_tokens,
+            }
+
+
+class AsyncRateLimiter:
+    """Event-loop flavour of a RateLimiter
+
+    Rate budgets and statistics are shared with the wrapped (threaded) limiter,
+    so sync and async callers together stay within the provider's limits. The
+    concurrency cap is a separate asyncio semaphore of the same size, created
+    lazily on the running loop.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self._semaphore = None
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens=0):
+        """Await a free slot and rate budget; yields the seconds spent waiting"""
+        limiter = self.limiter
+        if self._semaphore is None and limiter.max_concurrency:
+            self._semaphore = asyncio.Semaphore(limiter.max_concurrency)
+        started = time.monotonic()
+        limiter._start_waiting()
+        if self._semaphore:
+            await self._semaphore.acquire()
+        try:
+            if limiter.requests:
+                await limiter.requests.acquire_async(1)
+            if limiter.tokens and estimated_tokens:
+                await limiter.tokens.acquire_async(estimated_tokens)
+        except BaseException:
+            if self._semaphore:
+                self._semaphore.release()
+            limiter._abandoned()
+            raise
+        waited = limiter._acquired(started)
+        try:
+            yield waited
+        finally:
+            limiter._released()
+            if self._semaphore:
+                self._semaphore.release()
+
+    def record_usage(self, actual_tokens, estimated_tokens):
+        self.limiter.record_usage(actual_tokens, estimated_tokens)
+
+    def record_retry(self, throttled=False):
+        self.limiter.record_retry(throttled)
+
+    def stats(self):
+        return self.limiter.stats()
+
+
+def error_status(error):
+    """HTTP status code of an API error, or None for connection-level failures"""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def is_retryable(error):
+    """Only throttling, timeouts, server errors and connection failures are worth retrying"""
+    status = error_status(error)
+    return status is None or status in (408, 409, 429) or status >= 500
+
+
+def retry_after_seconds(error):
+    """Seconds requested by a Retry-After / retry-after-ms header, if present"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        # HTTP-date values are rare for API rate limits; fall back to backoff
+        return None
+    return None
+
+
+def backoff_delay(attempt, error=None, base=1.0, max_delay=30.0):
+    """Delay before retry number attempt (0-based): Retry-After if given, else full-jitter exponential backoff"""
+    requested = retry_after_seconds(error) if error is not None else None
+    if requested is not None:
+        return min(max(requested, 0.0), max_delay)
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
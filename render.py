@@ -0,0 +1,440 @@
+"""Local SVG/PNG rendering of flowcharts, without a browser or Mermaid itself.
+
+The parsed Flowchart is laid out with a simple layered (Sugiyama-style)
+algorithm: cycles are broken, nodes are assigned to ranks by longest path,
+long edges get dummy nodes, rank order is improved with barycenter sweeps and
+nodes are pulled towards their parents. PNG output needs the optional
+cairosvg package.
+"""
+from dataclasses import dataclass, field
+from xml.sax.saxutils import escape
+
+# Rough metrics of the default sans-serif font at FONT_SIZE
+FONT_SIZE = 14
+CHAR_WIDTH = 7.5
+LINE_HEIGHT = 18
+WRAP_CHARS = 28
+NODE_PADDING_X = 16
+NODE_PADDING_Y = 12
+NODE_GAP = 40
+RANK_GAP = 60
+MARGIN = 20
+SUBGRAPH_PADDING = 14
+ORDERING_SWEEPS = 4
+
+NODE_FILL = '#ECECFF'
+NODE_STROKE = '#9370DB'
+EDGE_STROKE = '#333333'
+SUBGRAPH_FILL = '#FFFFDE'
+SUBGRAPH_STROKE = '#AAAA33'
+
+
+class RenderError(Exception):
+    """Raised when a chart cannot be rendered in the requested format"""
+
+
+@dataclass
+class Box:
+    x: float  # center
+    y: float
+    width: float
+    height: float
+    lines: list = field(default_factory=list)
+    shape: str = 'rect'
+
+
+@dataclass
+class Layout:
+    width: float
+    height: float
+    boxes: dict
+    edges: list  # (Edge, [(x, y), ...])
+    subgraphs: list  # (Subgraph, x, y, width, height)
+
+
+def wrap_label(label, width=WRAP_CHARS):
+    """Greedy word wrap of a label into lines of at most width characters"""
+    lines = []
+    current = ''
+    for word in label.split():
+        if current and len(current) + 1 + len(word) > width:
+            lines.append(current)
+            current = word
+        else:
+            current = f'{current} {word}' if current else word
+    if current:
+        lines.append(current)
+    return lines or ['']
+
+
+def _node_box(node):
+    lines = wrap_label(node.label or node.id)
+    width = max(len(line) for line in lines) * CHAR_WIDTH + 2 * NODE_PADDING_X
+    height = len(lines) * LINE_HEIGHT + 2 * NODE_PADDING_Y
+    if node.shape == 'diamond':
+        width, height = width * 1.5, height * 1.5
+    elif node.shape in ('circle', 'double_circle'):
+        width = height = max(width, height)
+    elif node.shape in ('hexagon', 'parallelogram', 'parallelogram_alt', 'trapezoid', 'trapezoid_alt', 'asymmetric'):
+        width += 2 * NODE_PADDING_X
+    return Box(0, 0, width, height, lines, node.shape)
+
+
+def _acyclic_edges(chart):
+    """(source, target) pairs with back edges reversed, via iterative DFS in insertion order"""
+    successors = {node_id: [] for node_id in chart.nodes}
+    for edge in chart.edges:
+        if edge.source != edge.target:
+            successors[edge.source].append(edge.target)
+    state = {}
+    reversed_pairs = set()
+    for root in chart.nodes:
+        if root in state:
+            continue
+        state[root] = 'open'
+        stack = [(root, iter(successors[root]))]
+        while stack:
+            node_id, children = stack[-1]
+            for child in children:
+                if state.get(child) == 'open':
+                    reversed_pairs.add((node_id, child))
+                elif child not in state:
+                    state[child] = 'open'
+                    stack.append((child, iter(successors[child])))
+                    break
+            else:
+                state[node_id] = 'done'
+                stack.pop()
+    pairs = []
+    for edge in chart.edges:
+        if edge.source == edge.target:
+            continue
+        if (edge.source, edge.target) in reversed_pairs:
+            pairs.append((edge.target, edge.source, True))
+        else:
+            pairs.append((edge.source, edge.target, False))
+    return pairs
+
+
+def _assign_ranks(node_ids, pairs):
+    """Longest-path ranking over the acyclic edge set (Kahn's algorithm)"""
+    successors = {node_id: [] for node_id in node_ids}
+    indegree = {node_id: 0 for node_id in node_ids}
+    for source, target, _ in pairs:
+        successors[source].append(target)
+        indegree[target] += 1
+    rank = {node_id: 0 for node_id in node_ids}
+    ready = [node_id for node_id in node_ids if indegree[node_id] == 0]
+    while ready:
+        node_id = ready.pop()
+        for target in successors[node_id]:
+            rank[target] = max(rank[target], rank[node_id] + 1)
+            indegree[target] -= 1
+            if indegree[target] == 0:
+                ready.append(target)
+    return rank
+
+
+def _order_ranks(ranks, upper, lower):
+    """Reduce crossings with alternating down/up barycenter sweeps"""
+    position = {}
+    for rank in ranks:
+        for index, node_id in enumerate(rank):
+            position[node_id] = index
+
+    def sweep(rank, neighbours):
+        def barycenter(node_id):
+            linked = neighbours.get(node_id)
+            if not linked:
+                return position[node_id]
+            return sum(position[n] for n in linked) / len(linked)
+        rank.sort(key=barycenter)
+        for index, node_id in enumerate(rank):
+            position[node_id] = index
+
+    for sweep_number in range(ORDERING_SWEEPS):
+        if sweep_number % 2 == 0:
+            for rank in ranks[1:]:
+                sweep(rank, upper)
+        else:
+            for rank in reversed(ranks[:-1]):
+                sweep(rank, lower)
+
+
+def _place(ranks, boxes, upper):
+    """Assign x (centered on parents where room allows) and y per rank, top-down"""
+    y = MARGIN
+    for rank in ranks:
+        rank_height = max(boxes[node_id].height for node_id in rank)
+        cursor = MARGIN
+        desired = []
+        for node_id in rank:
+            box = boxes[node_id]
+            parents = upper.get(node_id)
+            if parents and all(boxes[p].x for p in parents):
+                desired.append(sum(boxes[p].x for p in parents) / len(parents))
+            else:
+                desired.append(cursor + box.width / 2)
+            cursor += box.width + NODE_GAP
+        # Keep order and gaps, pushing right only when nodes would overlap
+        previous_right = MARGIN - NODE_GAP
+        for node_id, want in zip(rank, desired):
+            box = boxes[node_id]
+            box.x = max(want, previous_right + NODE_GAP + box.width / 2)
+            previous_right = box.x + box.width / 2
+        for node_id in rank:
+            boxes[node_id].y = y + rank_height / 2
+        y += rank_height + RANK_GAP
+
+
+def _clip(box, toward):
+    """Point where the segment from the box center to toward leaves the box"""
+    dx, dy = toward[0] - box.x, toward[1] - box.y
+    if not dx and not dy:
+        return box.x, box.y
+    half_w, half_h = box.width / 2, box.height / 2
+    if box.shape == 'diamond':
+        scale = 1 / (abs(dx) / half_w + abs(dy) / half_h)
+    elif box.shape in ('circle', 'double_circle'):
+        scale = half_w / (dx * dx + dy * dy) ** 0.5
+    else:
+        scale = min(half_w / abs(dx) if dx else float('inf'), half_h / abs(dy) if dy else float('inf'))
+    return box.x + dx * scale, box.y + dy * scale
+
+
+def layout(chart):
+    """Compute node boxes, edge polylines and subgraph frames for a Flowchart"""
+    horizontal = chart.direction in ('LR', 'RL')
+    boxes = {node_id: _node_box(node) for node_id, node in chart.nodes.items()}
+    if horizontal:
+        for box in boxes.values():
+            box.width, box.height = box.height, box.width
+
+    pairs = _acyclic_edges(chart)
+    rank_of = _assign_ranks(list(boxes), pairs)
+
+    # Long edges are split by dummy nodes so they take part in ordering
+    upper, lower = {}, {}
+    chains = []
+    for index, (source, target, was_reversed) in enumerate(pairs):
+        chain = [source]
+        for rank in range(rank_of[source] + 1, rank_of[target]):
+            dummy = f'\0dummy{index}_{rank}'
+            boxes[dummy] = Box(0, 0, 1, 1, [], 'dummy')
+            rank_of[dummy] = rank
+            chain.append(dummy)
+        chain.append(target)
+        for a, b in zip(chain, chain[1:]):
+            upper.setdefault(b, []).append(a)
+            lower.setdefault(a, []).append(b)
+        chains.append((chain, was_reversed))
+
+    ranks = [[] for _ in range(max(rank_of.values(), default=0) + 1)]
+    for node_id in boxes:
+        ranks[rank_of[node_id]].append(node_id)
+    _order_ranks(ranks, upper, lower)
+    _place(ranks, boxes, upper)
+
+    width = max((box.x + box.width / 2 for box in boxes.values()), default=0) + MARGIN
+    height = max((box.y + box.height / 2 for box in boxes.values()), default=0) + MARGIN
+
+    # Edge routes through their dummies, clipped to the node outlines
+    drawable = [edge for edge in chart.edges if edge.source != edge.target]
+    routes = []
+    for edge, (chain, was_reversed) in zip(drawable, chains):
+        if was_reversed:
+            chain = chain[::-1]
+        points = [(boxes[n].x, boxes[n].y) for n in chain]
+        points[0] = _clip(boxes[chain[0]], points[1])
+        points[-1] = _clip(boxes[chain[-1]], points[-2])
+        routes.append((edge, points))
+    for edge in chart.edges:
+        if edge.source == edge.target:
+            box = boxes[edge.source]
+            right, top = box.x + box.width / 2, box.y - box.height / 4
+            routes.append((edge, [(right, top), (right + 25, top), (right + 25, box.y + box.height / 4),
+                                  (right, box.y + box.height / 4)]))
+
+    for node_id in [n for n in boxes if n.startswith('\0dummy')]:
+        del boxes[node_id]
+
+    if horizontal or chart.direction == 'BT':
+        def transform(point):
+            x, y = point
+            if horizontal:
+                x, y = y, x
+            if chart.direction == 'RL':
+                x = height - x
+            elif chart.direction == 'BT':
+                y = height - y
+            return x, y
+        for box in boxes.values():
+            box.x, box.y = transform((box.x, box.y))
+            if horizontal:
+                box.width, box.height = box.height, box.width
+        routes = [(edge, [transform(p) for p in points]) for edge, points in routes]
+        if horizontal:
+            width, height = height, width
+
+    frames = _subgraph_frames(chart, boxes)
+    if frames:
+        width = max(width, max(x + w for _, x, _, w, _ in frames) + MARGIN)
+        height = max(height, max(y + h for _, _, y, _, h in frames) + MARGIN)
+    return Layout(width, height, boxes, routes, frames)
+
+
+def _subgraph_frames(chart, boxes):
+    """Bounding frames of subgraphs around their (nested) member nodes, outermost first"""
+    children = {}
+    for subgraph in chart.subgraphs.values():
+        children.setdefault(subgraph.parent, []).append(subgraph)
+    frames = []
+
+    def frame(subgraph, depth):
+        members = [boxes[n] for n in subgraph.nodes if n in boxes]
+        extents = [(b.x - b.width / 2, b.y - b.height / 2, b.x + b.width / 2, b.y + b.height / 2) for b in members]
+        index = len(frames)
+        frames.append(None)
+        for child in children.get(subgraph.id, []):
+            child_frame = frame(child, depth + 1)
+            if child_frame:
+                _, x, y, w, h = child_frame
+                extents.append((x, y, x + w, y + h))
+        if not extents:
+            frames.pop(index)
+            return None
+        pad = SUBGRAPH_PADDING
+        left = min(e[0] for e in extents) - pad
+        top = min(e[1] for e in extents) - pad - LINE_HEIGHT
+        right = max(e[2] for e in extents) + pad
+        bottom = max(e[3] for e in extents) + pad
+        frames[index] = (subgraph, max(left, 0), max(top, 0), right - max(left, 0), bottom - max(top, 0))
+        return frames[index]
+
+    for subgraph in children.get(None, []):
+        frame(subgraph, 0)
+    return [f for f in frames if f]
+
+
+def _shape_svg(box):
+    x, y, w, h = box.x - box.width / 2, box.y - box.height / 2, box.width, box.height
+    style = f'fill="{NODE_FILL}" stroke="{NODE_STROKE}" stroke-width="1.5"'
+    cx, cy = box.x, box.y
+    shape = box.shape
+    if shape == 'round':
+        return f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" rx="8" {style}/>'
+    if shape == 'stadium':
+        return f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" rx="{h / 2:.1f}" {style}/>'
+    if shape == 'circle':
+        return f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{w / 2:.1f}" {style}/>'
+    if shape == 'double_circle':
+        return (f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{w / 2:.1f}" {style}/>'
+                f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{w / 2 - 4:.1f}" {style}/>')
+    if shape == 'subroutine':
+        return (f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" {style}/>'
+                f'<path d="M{x + 8:.1f},{y:.1f} V{y + h:.1f} M{x + w - 8:.1f},{y:.1f} V{y + h:.1f}" '
+                f'stroke="{NODE_STROKE}" stroke-width="1.5"/>')
+    if shape == 'cylinder':
+        ry = 6
+        return (f'<path d="M{x:.1f},{y + ry:.1f} A{w / 2:.1f},{ry} 0 0 0 {x + w:.1f},{y + ry:.1f} '
+                f'V{y + h - ry:.1f} A{w / 2:.1f},{ry} 0 0 1 {x:.1f},{y + h - ry:.1f} Z '
+                f'M{x:.1f},{y + ry:.1f} A{w / 2:.1f},{ry} 0 0 1 {x + w:.1f},{y + ry:.1f}" {style}/>')
+    slant = min(16, w / 4)
+    points = {
+        'diamond': [(cx, y), (x + w, cy), (cx, y + h), (x, cy)],
+        'hexagon': [(x + slant, y), (x + w - slant, y), (x + w, cy), (x + w - slant, y + h), (x + slant, y + h), (x, cy)],
+        'parallelogram': [(x + slant, y), (x + w, y), (x + w - slant, y + h), (x, y + h)],
+        'parallelogram_alt': [(x, y), (x + w - slant, y), (x + w, y + h), (x + slant, y + h)],
+        'trapezoid': [(x + slant, y), (x + w - slant, y), (x + w, y + h), (x, y + h)],
+        'trapezoid_alt': [(x, y), (x + w, y), (x + w - slant, y + h), (x + slant, y + h)],
+        'asymmetric': [(x, y), (x + w, y), (x + w, y + h), (x, y + h), (x + slant, cy)],
+    }.get(shape)
+    if points:
+        return f'<polygon points="{" ".join(f"{px:.1f},{py:.1f}" for px, py in points)}" {style}/>'
+    return f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" {style}/>'
+
+
+def _text_svg(lines, cx, cy):
+    top = cy - (len(lines) - 1) * LINE_HEIGHT / 2
+    spans = ''.join(f'<tspan x="{cx:.1f}" y="{top + i * LINE_HEIGHT:.1f}">{escape(line)}</tspan>'
+                    for i, line in enumerate(lines))
+    return f'<text text-anchor="middle" dominant-baseline="central">{spans}</text>'
+
+
+def _edge_svg(edge, points):
+    kind = edge.kind
+    attributes = f'fill="none" stroke="{EDGE_STROKE}" stroke-width="{3 if "=" in kind else 1.5}"'
+    if '.' in kind:
+        attributes += ' stroke-dasharray="4 4"'
+    end = {'>': 'arrow', 'o': 'circle', 'x': 'cross'}.get(kind[-1])
+    if end:
+        attributes += f' marker-end="url(#{end})"'
+    if kind.startswith('<'):
+        attributes += ' marker-start="url(#arrow-start)"'
+    path = 'M' + ' L'.join(f'{x:.1f},{y:.1f}' for x, y in points)
+    svg = f'<path d="{path}" {attributes}/>'
+    if edge.label:
+        middle = len(points) // 2
+        (x1, y1), (x2, y2) = points[middle - 1], points[middle]
+        lx, ly = (x1 + x2) / 2, (y1 + y2) / 2
+        lines = wrap_label(edge.label)
+        w = max(len(line) for line in lines) * CHAR_WIDTH + 8
+        h = len(lines) * LINE_HEIGHT + 4
+        svg += (f'<rect x="{lx - w / 2:.1f}" y="{ly - h / 2:.1f}" width="{w:.1f}" height="{h:.1f}" fill="#ffffff" opacity="0.9"/>'
+                + _text_svg(lines, lx, ly))
+    return svg
+
+
+_MARKERS = (
+    '<defs>'
+    '<marker id="arrow" viewBox="0 0 10 10" refX="9" refY="5" markerWidth="8" markerHeight="8" orient="auto">'
+    f'<path d="M0,0 L10,5 L0,10 z" fill="{EDGE_STROKE}"/></marker>'
+    '<marker id="arrow-start" viewBox="0 0 10 10" refX="1" refY="5" markerWidth="8" markerHeight="8" orient="auto">'
+    f'<path d="M10,0 L0,5 L10,10 z" fill="{EDGE_STROKE}"/></marker>'
+    '<marker id="circle" viewBox="0 0 10 10" refX="5" refY="5" markerWidth="7" markerHeight="7">'
+    f'<circle cx="5" cy="5" r="4" fill="{EDGE_STROKE}"/></marker>'
+    '<marker id="cross" viewBox="0 0 10 10" refX="5" refY="5" markerWidth="8" markerHeight="8">'
+    f'<path d="M1,1 L9,9 M9,1 L1,9" stroke="{EDGE_STROKE}" stroke-width="2"/></marker>'
+    '</defs>'
+)
+
+
+def render_svg(chart):
+    """Render a Flowchart as a standalone SVG document (str)"""
+    result = layout(chart)
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{result.width:.0f}" height="{result.height:.0f}" '
+        f'viewBox="0 0 {result.width:.1f} {result.height:.1f}" font-family="Helvetica, Arial, sans-serif" '
+        f'font-size="{FONT_SIZE}">',
+        _MARKERS,
+        f'<rect width="100%" height="100%" fill="#ffffff"/>',
+    ]
+    for subgraph, x, y, w, h in result.subgraphs:
+        parts.append(f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" '
+                     f'fill="{SUBGRAPH_FILL}" stroke="{SUBGRAPH_STROKE}"/>')
+        parts.append(_text_svg([subgraph.label or subgraph.id], x + w / 2, y + LINE_HEIGHT / 2 + 4))
+    for edge, points in result.edges:
+        parts.append(_edge_svg(edge, points))
+    for box in result.boxes.values():
+        parts.append(_shape_svg(box))
+        parts.append(_text_svg(box.lines, box.x, box.y))
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def png_available():
+    try:
+        import cairosvg  # noqa: F401
+    except (ImportError, OSError):
+        # OSError: cairosvg installed but the cairo library is missing
+        return False
+    return True
+
+
+def render_png(chart, scale=2):
+    """Render a Flowchart as PNG bytes; needs the optional cairosvg package"""
+    try:
+        import cairosvg
+    except (ImportError, OSError) as e:
+        raise RenderError(f'PNG rendering needs cairosvg: {e}')
+    return cairosvg.svg2png(bytestring=render_svg(chart).encode('utf-8'), scale=scale)
@@ -0,0 +1,118 @@
+"""Page-level differences between two versions of a document's extracted text.
+
+Pages are aligned with difflib, so inserted or removed pages do not mark every
+later page as changed, and only the changed lines of the changed pages are
+kept (as a unified diff with a little context). This is what is sent to the
+LLM when a revised PDF updates an existing flowchart; the LLM answers with
+edits to the previous step list by line number, applied here.
+"""
+import difflib
+from dataclasses import dataclass
+
+
+@dataclass
+class PageChange:
+    old_start: int  # 0-based page ranges, end exclusive
+    old_end: int
+    new_start: int
+    new_end: int
+    diff: str
+
+    def describe(self):
+        """'Pages 3-4 (previously page 3)'-style heading, 1-based"""
+        new = _page_range(self.new_start, self.new_end)
+        old = _page_range(self.old_start, self.old_end)
+        if not new:
+            return f'Removed {old.lower()}'
+        if not old:
+            return f'Added {new.lower()}'
+        return new if new == old else f'{new} (previously {old.lower()})'
+
+
+def _page_range(start, end):
+    if end <= start:
+        return ''
+    return f'Page {start + 1}' if end - start == 1 else f'Pages {start + 1}-{end}'
+
+
+def normalize_page(text):
+    """Page text with whitespace collapsed and blank lines dropped, so layout noise is not a change"""
+    return '\n'.join(' '.join(line.split()) for line in (text or '').split('\n') if line.strip())
+
+
+def diff_pages(old_pages, new_pages, context=1):
+    """[PageChange] for the pages that differ between two versions, in document order"""
+    old = [normalize_page(page) for page in old_pages]
+    new = [normalize_page(page) for page in new_pages]
+    changes = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            continue
+        old_lines = '\n'.join(old[i1:i2]).split('\n') if i2 > i1 else []
+        new_lines = '\n'.join(new[j1:j2]).split('\n') if j2 > j1 else []
+        # Skip the ---/+++ file headers
+        lines = list(difflib.unified_diff(old_lines, new_lines, lineterm='', n=context))[2:]
+        if lines:
+            changes.append(PageChange(i1, i2, j1, j2, '\n'.join(lines)))
+    return changes
+
+
+def format_changes(changes):
+    """The changes as text for a prompt: a heading per changed page range, then its diff"""
+    return '\n\n'.join(f'{change.describe()}:\n{change.diff}' for change in changes)
+
+
+def changed_pages(changes):
+    """1-based numbers of the pages of the new version that were added or changed"""
+    return [page + 1 for change in changes for page in range(change.new_start, change.new_end)]
+
+
+def number_lines(text):
+    """The text's non-blank lines, each prefixed with its line number, for a prompt"""
+    return '\n'.join(f'{number}: {line}' for number, line in enumerate((text or '').split('\n'), 1) if line.strip())
+
+
+def _line_number(value, count, lowest=1):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if lowest <= number <= count else None
+
+
+def apply_step_edits(text, edits):
+    """Apply {"remove_steps", "replace_steps", "insert_steps"} line edits from the LLM
+
+    Line numbers refer to the lines of text as shown by number_lines;
+    insertions are placed after the given line (0 for the start). Edits that
+    refer to lines that do not exist are skipped. Returns (text, edits applied).
+    """
+    lines = (text or '').split('\n')
+    count = len(lines)
+    replaced = {}
+    inserted = {}
+    applied = 0
+    removed = {number for number in (_line_number(value, count) for value in _edit_list(edits, 'remove_steps'))
+               if number}
+    applied += len(removed)
+    for edit in _edit_list(edits, 'replace_steps'):
+        number = _line_number(edit.get('line'), count) if isinstance(edit, dict) else None
+        if number and number not in removed and edit.get('text'):
+            replaced[number] = str(edit['text'])
+            applied += 1
+    for edit in _edit_list(edits, 'insert_steps'):
+        number = _line_number(edit.get('after'), count, lowest=0) if isinstance(edit, dict) else None
+        if number is not None and edit.get('text'):
+            inserted.setdefault(number, []).append(str(edit['text']))
+            applied += 1
+    result = list(inserted.get(0, []))
+    for number, line in enumerate(lines, 1):
+        if number not in removed:
+            result.append(replaced.get(number, line))
+        result.extend(inserted.get(number, []))
+    return '\n'.join(result), applied
+
+
+def _edit_list(edits, name):
+    items = edits.get(name)
+    return items if isinstance(items, list) else []
@@ -1,10 +1,20 @@
 import streamlit as st
 import PyPDF2
 import os
-import base64
 import re
 from openai import OpenAI
 from io import BytesIO
+from chunking import split_into_chunks, map_chunks, reduce_step_lists
+from extraction import BACKENDS, select_backend
+from flowchart import is_mermaid_statement, parse_mermaid
+from drawio import drawio_url, to_drawio_xml
+from links import mermaid_live_url
+
+# call_xai_api truncates prompts to 4000 characters: keep chunks and the
+# merged step list small enough to fit alongside the prompt templates
+CHUNK_SIZE = 3400
+CHUNK_CONCURRENCY = 4
+MERGED_STEPS_MAX_CHARS = 3400
 
 # Page configuration
 st.set_page_config(
@@ -124,13 +134,19 @@ def init_xai_client():
         st.error("Please check your API key in the Streamlit secrets.")
         return None
 
-def extract_text_from_pdf(pdf_file):
-    """Extract text from uploaded PDF file with robust encoding handling"""
+@st.cache_resource
+def get_pdf_backend():
+    """Pick the PDF extraction backend once per server (fastest installed when 'auto')"""
+    backend, _ = select_backend(os.getenv('EXTRACT_BACKEND', 'auto'))
+    return BACKENDS[backend]
+
+def extract_pages_from_pdf(pdf_file):
+    """Extract the text of each page of an uploaded PDF file with robust encoding handling"""
     try:
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            page_text = page.extract_text()
+        pdf_bytes = pdf_file.getvalue()
+        page_count = len(PyPDF2.PdfReader(BytesIO(pdf_bytes)).pages)
+        pages = []
+        for page_text in get_pdf_backend().page_texts(pdf_bytes, list(range(page_count))):
             if page_text:
                 # More aggressive text cleaning to handle encoding issues
                 import unicodedata
@@ -150,26 +166,32 @@ def extract_text_from_pdf(pdf_file):
                 # Clean up multiple spaces and normalize
                 page_text = re.sub(r'\s+', ' ', page_text).strip()
                 
-                text += page_text + "\n"
-        
-        # Final cleanup
-        text = text.strip()
-        if not text:
-            return None
-            
-        # Ensure the text is safe for API transmission
-        text = text.encode('ascii', 'ignore').decode('ascii')
+                # Ensure the text is safe for API transmission
+                page_text = page_text.encode('ascii', 'ignore').decode('ascii')
+                if page_text:
+                    pages.append(page_text)
         
-        return text if text else None
+        return pages if pages else None
         
     except Exception as e:
         st.error(f"Error extracting text from PDF: {e}")
         return None
 
-def call_xai_api(client, prompt, for_mermaid=False):
-    """Make API call to xAI API with robust error handling"""
+def extract_text_from_pdf(pdf_file):
+    """Extract text from uploaded PDF file, one line per page"""
+    pages = extract_pages_from_pdf(pdf_file)
+    return '\n'.join(pages) if pages else None
+
+def call_xai_api(client, prompt, for_mermaid=False, errors=None):
+    """Make API call to xAI API with robust error handling
+
+    Errors are shown with st.error, or appended to errors when given: calls
+    made from pool threads have no Streamlit script context, so the caller
+    shows them from the main thread instead.
+    """
     if not client:
         return None
+    report = errors.append if errors is not None else st.error
     
     # Ultra-aggressive text cleaning to prevent encoding errors
     try:
@@ -195,7 +217,7 @@ def call_xai_api(client, prompt, for_mermaid=False):
             clean_prompt = clean_prompt[:4000] + "..."
             
     except Exception as e:
-        st.error(f"Error cleaning prompt: {e}")
+        report(f"Error cleaning prompt: {e}")
         # Fallback: use only printable ASCII characters
         clean_prompt = ''.join(char for char in prompt if ord(char) < 128 and char.isprintable())
     
@@ -239,7 +261,7 @@ Create a comprehensive procedure that follows the natural flow described in the
         )
         return response.choices[0].message.content
     except Exception as e:
-        st.error(f"xAI API Error: {e}")
+        report(f"xAI API Error: {e}")
         # Try one more time with even simpler text
         try:
             simple_prompt = "Create a laboratory procedure flowchart from the provided document content."
@@ -254,9 +276,26 @@ Create a comprehensive procedure that follows the natural flow described in the
             )
             return response.choices[0].message.content
         except Exception as e2:
-            st.error(f"Final Groq API attempt failed: {e2}")
+            report(f"Final Groq API attempt failed: {e2}")
             return None
 
+def build_steps_prompt(content):
+    """Step 1 prompt: extract an organized procedure from storyboard text"""
+    return f"""Analyze this laboratory storyboard content and extract a clear, organized procedure.
+
+Requirements:
+- Use only information from the storyboard content provided
+- Start with safety procedures if mentioned
+- Include all steps in logical order: Safety → Setup → Main Procedure → Cleanup
+- Preserve any decision points or alternative methods mentioned
+- Include observations only if specifically mentioned in the storyboard
+- Be detailed but practical
+
+Storyboard content:
+{content}
+
+Extract a comprehensive procedure that follows the natural flow described in the storyboard."""
+
 def extract_mermaid_code(response_text):
     """Extract only the Mermaid code from response"""
     lines = response_text.split('\n')
@@ -265,22 +304,20 @@ def extract_mermaid_code(response_text):
     
     for line in lines:
         stripped = line.strip()
-        if 'flowchart TD' in stripped:
+        if stripped.startswith(('flowchart', 'graph')):
             in_flowchart = True
             mermaid_lines = [stripped]
             continue
         
-        if in_flowchart:
-            if (stripped and (
-                '-->' in stripped or
-                stripped.startswith(('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K')) or
-                any(char in stripped for char in ['[', ']', '{', '}'])
-            )):
-                mermaid_lines.append(stripped)
-            elif not stripped or any(phrase in stripped.lower() for phrase in ['however', 'this', 'here']):
+        if in_flowchart and stripped:
+            # Stop at the first line that is not Mermaid (explanatory text, closing fence)
+            if not is_mermaid_statement(stripped):
                 break
+            mermaid_lines.append(stripped)
     
-    return '\n'.join(mermaid_lines) if mermaid_lines else response_text.strip()
+    if not mermaid_lines:
+        return response_text.strip()
+    return parse_mermaid('\n'.join(mermaid_lines), errors=[]).to_mermaid()
 
 def generate_mermaid_live_url(mermaid_code):
     """Generate Mermaid Live Editor URL"""
@@ -289,8 +326,7 @@ def generate_mermaid_live_url(mermaid_code):
         if clean_code.startswith('```mermaid'):
             clean_code = clean_code.replace('```mermaid', '').replace('```', '').strip()
         
-        encoded = base64.b64encode(clean_code.encode('utf-8')).decode('utf-8')
-        return f"https://mermaid.live/edit#pako:{encoded}"
+        return mermaid_live_url(clean_code)
     except Exception:
         return "https://mermaid.live/"
 
@@ -341,36 +377,43 @@ def main():
                 
                 # Step 1: Extract text
                 st.info("📄 Extracting text from PDF...")
-                pdf_text = extract_text_from_pdf(uploaded_file)
+                pages = extract_pages_from_pdf(uploaded_file)
                 
-                if not pdf_text:
+                if not pages:
                     st.error("❌ Could not extract text from PDF. Please check if the PDF contains readable text.")
                     st.stop()
                 
-                # Limit text size
-                if len(pdf_text) > 6000:
-                    pdf_text = pdf_text[:6000] + "..."
-                
-                st.success(f"✅ Extracted {len(pdf_text)} characters from PDF")
+                st.success(f"✅ Extracted {sum(len(page) for page in pages)} characters from {len(pages)} pages")
                 
                 # Step 2: Generate steps
                 st.info("🤖 Step 1: Generating procedure steps...")
-                step1_prompt = f"""Analyze this laboratory storyboard content and extract a clear, organized procedure.
-
-Requirements:
-- Use only information from the storyboard content provided
-- Start with safety procedures if mentioned
-- Include all steps in logical order: Safety → Setup → Main Procedure → Cleanup
-- Preserve any decision points or alternative methods mentioned
-- Include observations only if specifically mentioned in the storyboard
-- Be detailed but practical
-
-Storyboard content:
-{pdf_text}
+                
+                # call_xai_api caps prompts at 4000 characters, so long documents are
+                # split into page chunks whose steps are extracted in parallel and merged
+                chunks = split_into_chunks(pages, CHUNK_SIZE)
+                if len(chunks) > 1:
+                    st.info(f"🧩 Long document: extracting steps from {len(chunks)} chunks...")
+                
+                # Chunk and merge calls run in pool threads, where st.error is
+                # dropped; their errors are collected and shown below
+                chunk_errors = []
+                
+                def consolidate(text):
+                    return call_xai_api(client, f"""Combine these partial procedures, extracted from consecutive parts of one laboratory storyboard, into a single organized procedure. Keep the original order, remove duplicated safety, setup and cleanup steps, and preserve decision points.
 
-Extract a comprehensive procedure that follows the natural flow described in the storyboard."""
+Partial procedures:
+{text}""", errors=chunk_errors)
                 
-                steps_response = call_xai_api(client, step1_prompt)
+                partials = map_chunks(
+                    lambda chunk: call_xai_api(client, build_steps_prompt(chunk), errors=chunk_errors),
+                    chunks,
+                    CHUNK_CONCURRENCY
+                )
+                steps_response = None
+                if any(partials):
+                    steps_response = reduce_step_lists(partials, consolidate, MERGED_STEPS_MAX_CHARS, CHUNK_CONCURRENCY)
+                for message in dict.fromkeys(chunk_errors):
+                    st.error(message)
                 if not steps_response:
                     st.error("❌ Failed to generate steps. Please check your API key.")
                     st.stop()
@@ -444,8 +487,9 @@ Generate clean Mermaid code that represents this flowchart."""
                 with tab4:
                     st.subheader("Visualize Flowchart")
                     mermaid_url = generate_mermaid_live_url(mermaid_code)
+                    drawio_xml = to_drawio_xml(parse_mermaid(mermaid_code, errors=[]))
                     
-                    col1, col2 = st.columns(2)
+                    col1, col2, col3 = st.columns(3)
                     with col1:
                         st.link_button(
                             "🌊 Open in Mermaid Live",
@@ -455,12 +499,20 @@ Generate clean Mermaid code that represents this flowchart."""
                     
                     with col2:
                         st.link_button(
-                            "🎨 Open Draw.io",
-                            "https://app.diagrams.net/?splash=0&ui=kennedy&iconfont=1&p=mermaiddiagram",
-                            help="Open Draw.io and paste the Mermaid code"
+                            "🎨 Open in Draw.io",
+                            drawio_url(drawio_xml),
+                            help="Open the flowchart as an editable Draw.io diagram"
+                        )
+                    
+                    with col3:
+                        st.download_button(
+                            "💾 Download .drawio",
+                            drawio_xml,
+                            file_name="flowchart.drawio",
+                            mime="application/xml"
                         )
                     
-                    st.info("💡 **Tip**: Click 'Mermaid Live' for instant visualization, or use Draw.io by pasting the Mermaid code above.")
+                    st.info("💡 **Tip**: Click 'Mermaid Live' for instant visualization, or open the ready-arranged diagram in Draw.io.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,36 @@
+from flowchart import parse_mermaid
+
+
+def test_lenient_parse_keeps_labels_with_brackets():
+    errors = []
+    chart = parse_mermaid('flowchart TD\nC --> E(Heat (optional) sample)\nF[Mix [A] and B] --> C', errors)
+    assert errors == []
+    assert chart.nodes['E'].label == 'Heat (optional) sample'
+    assert chart.nodes['F'].label == 'Mix [A] and B'
+    assert [(edge.source, edge.target) for edge in chart.edges] == [('C', 'E'), ('F', 'C')]
+    assert 'E("Heat (optional) sample")' in chart.to_mermaid()
+
+
+def test_lenient_parse_recovers_unbalanced_closing_bracket():
+    errors = []
+    chart = parse_mermaid('flowchart TD\nA(Heat) sample) --> B', errors)
+    assert errors == []
+    assert chart.nodes['A'].label == 'Heat) sample'
+    assert len(chart.edges) == 1
+
+
+def test_failed_statement_restores_existing_node():
+    errors = []
+    chart = parse_mermaid('flowchart TD\nA[Old]\nA[New] --> B(Heat (x) y', errors)
+    assert len(errors) == 1
+    assert (chart.nodes['A'].label, chart.nodes['A'].shape) == ('Old', 'rect')
+    assert 'B' not in chart.nodes
+    assert chart.edges == []
+
+
+def test_failed_statement_restores_shape():
+    errors = []
+    chart = parse_mermaid('flowchart TD\nA[Old] --> B\nA{New} --> C(unclosed', errors)
+    assert len(errors) == 1
+    assert (chart.nodes['A'].label, chart.nodes['A'].shape) == ('Old', 'rect')
+    assert [(edge.source, edge.target) for edge in chart.edges] == [('A', 'B')]
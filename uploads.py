@@ -0,0 +1,150 @@
+"""Uploaded files spooled to disk and hashed while they arrive.
+
+The multipart parser writes each uploaded file into a SpooledUpload: small
+files stay in memory, larger ones go to a temp file, so memory per in-flight
+upload stays flat whatever the size cap. The SHA-256 of the content is
+computed during the write, so the result cache can be checked without
+reading the file again. Jobs take over the upload (detach) and remove the
+temp file when they finish; the PDF parser reads the file memory-mapped.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from cache import extend_hash
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class SpooledUpload:
+    """Writable, then readable, file for one upload, hashed and size-capped as it is written
+
+    Past spool_size bytes the content moves from memory to a temp file in
+    directory. Writing more than max_size bytes raises RequestEntityTooLarge
+    (413) straight away, without reading the rest of the upload.
+    """
+
+    def __init__(self, max_size=None, spool_size=1024 * 1024, directory=None, filename=None):
+        self.max_size = max_size
+        self.spool_size = spool_size
+        self.directory = directory
+        self.filename = filename
+        self.size = 0
+        self.path = None
+        self.hasher = hashlib.sha256()
+        self._buffer = BytesIO()
+        self._file = None
+        self._detached = False
+        self._closed = False
+
+    @property
+    def _stream(self):
+        return self._file if self._file is not None else self._buffer
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge(f'Uploaded file is larger than {self.max_size // (1024 * 1024)}MB')
+        self.hasher.update(data)
+        if self._file is None and self.size > self.spool_size:
+            self._rollover()
+        return self._stream.write(data)
+
+    def _rollover(self):
+        fd, self.path = tempfile.mkstemp(prefix='upload-', suffix='.pdf', dir=self.directory)
+        self._file = os.fdopen(fd, 'w+b')
+        self._file.write(self._buffer.getvalue())
+        self._buffer = None
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def readline(self, size=-1):
+        return self._stream.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self._stream.seek(offset, whence)
+
+    def tell(self):
+        return self._stream.tell()
+
+    def flush(self):
+        self._stream.flush()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def on_disk(self):
+        return self._file is not None
+
+    @property
+    def source(self):
+        """The content for the PDF parser: bytes when in memory, else the temp file path"""
+        if self._file is None:
+            return self._buffer.getvalue()
+        self._file.flush()
+        return self.path
+
+    def content_hash(self, *parts):
+        """content_hash(content, *parts) without reading the content again"""
+        digest = self.hasher.copy()
+        digest.update(b'\0')
+        return extend_hash(digest, *parts)
+
+    def detach(self):
+        """Keep the content after the request closes its files; the new owner calls discard()"""
+        self._detached = True
+        self.flush()
+        self.seek(0)
+        return self
+
+    def close(self):
+        # Werkzeug closes uploaded files when the request ends
+        if not self._detached:
+            self.discard()
+
+    def discard(self):
+        """Drop the content and delete the temp file"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+
+
+def spool(stream, filename=None, **options):
+    """Copy a readable stream (e.g. a zip member or an ASGI upload) into a SpooledUpload"""
+    upload = SpooledUpload(filename=filename, **options)
+    try:
+        shutil.copyfileobj(stream, upload, COPY_CHUNK_SIZE)
+    except BaseException:
+        upload.discard()
+        raise
+    upload.seek(0)
+    return upload